@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from fastapi import Request
+from jose import JWTError, jwt
+
+from cache import TTLCache
+
+if TYPE_CHECKING:
+    import httpx
+
+logger = logging.getLogger(__name__)
+
+ASYMMETRIC_ALGORITHMS = ("RS256", "ES256")
+
+
+class TokenVerifier:
+    """
+    Verifies Supabase access tokens locally instead of asking Supabase on every request.
+
+    HS256 tokens are checked against the project's JWT secret, asymmetric tokens against
+    the project's JWKS, which is cached and refreshed every `jwks_ttl` seconds. Verified
+    claims are kept in a bounded TTL cache that never outlives the token's `exp`.
+    `remote_verify` (e.g. `supabase.auth.get_user`) is an opt-in extra check for revoked
+    sessions and runs in a worker thread so it never blocks the event loop.
+    """
+
+    def __init__(
+        self,
+        jwt_secret: Optional[str] = None,
+        jwks_url: Optional[str] = None,
+        audience: str = "authenticated",
+        cache_size: int = 10_000,
+        cache_ttl: float = 300,
+        jwks_ttl: float = 600,
+        jwks_min_refresh_interval: float = 30,
+        remote_verify: Optional[Callable[[str], Any]] = None,
+        http_client: Optional["httpx.AsyncClient"] = None,
+    ):
+        self.jwt_secret = jwt_secret
+        self.jwks_url = jwks_url
+        self.audience = audience
+        self.jwks_ttl = jwks_ttl
+        self.jwks_min_refresh_interval = jwks_min_refresh_interval
+        self.remote_verify = remote_verify
+        self._http_client = http_client
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._jwks: List[Dict[str, Any]] = []
+        self._jwks_fetched_at: Optional[float] = None
+        self._jwks_lock = asyncio.Lock()
+
+    async def verify(self, token: str) -> Dict[str, Any]:
+        """
+        Return the claims of a valid token, raising JWTError otherwise.
+        """
+        claims = self._cache.get(token)
+        if claims is not None:
+            return claims
+
+        claims = await self._decode(token)
+
+        if self.remote_verify is not None:
+            await self._verify_remotely(token)
+
+        ttl = min(self._cache.ttl, claims.get("exp", float("inf")) - time.time())
+        self._cache.set(token, claims, ttl=ttl)
+        return claims
+
+    async def _decode(self, token: str) -> Dict[str, Any]:
+        header = jwt.get_unverified_header(token)
+        algorithm = header.get("alg")
+
+        if algorithm == "HS256":
+            if not self.jwt_secret:
+                raise JWTError("No JWT secret configured for HS256 tokens")
+            key: Any = self.jwt_secret
+        elif algorithm in ASYMMETRIC_ALGORITHMS:
+            key = await self._get_signing_key(header.get("kid"))
+        else:
+            raise JWTError(f"Unsupported token algorithm {algorithm}")
+
+        return jwt.decode(token, key, algorithms=[algorithm], audience=self.audience)
+
+    async def _get_signing_key(self, kid: Optional[str]) -> Dict[str, Any]:
+        if self._jwks_is_stale():
+            await self._refresh_jwks()
+
+        key = self._find_key(kid)
+        if key is None and self._jwks_can_refresh():
+            # The key set may have been rotated since we last fetched it
+            await self._refresh_jwks()
+            key = self._find_key(kid)
+
+        if key is None:
+            raise JWTError("No matching signing key")
+        return key
+
+    def _find_key(self, kid: Optional[str]) -> Optional[Dict[str, Any]]:
+        for key in self._jwks:
+            if key.get("kid") == kid:
+                return key
+        return None
+
+    def _jwks_is_stale(self) -> bool:
+        return self._jwks_fetched_at is None or time.monotonic() - self._jwks_fetched_at >= self.jwks_ttl
+
+    def _jwks_can_refresh(self) -> bool:
+        return self._jwks_fetched_at is None or time.monotonic() - self._jwks_fetched_at >= self.jwks_min_refresh_interval
+
+    async def _refresh_jwks(self) -> None:
+        if not self.jwks_url:
+            raise JWTError("No JWKS URL configured")
+        # Imported here, on the first refresh, as it takes a noticeable part of startup
+        import httpx
+
+        async with self._jwks_lock:
+            # Another request may have refreshed the keys while we waited for the lock
+            if self._jwks_fetched_at is not None and not self._jwks_can_refresh():
+                return
+
+            try:
+                if self._http_client is not None:
+                    response = await self._http_client.get(self.jwks_url)
+                else:
+                    async with httpx.AsyncClient(timeout=5) as client:
+                        response = await client.get(self.jwks_url)
+                response.raise_for_status()
+                self._jwks = response.json().get("keys", [])
+            except httpx.HTTPError as e:
+                logger.warning("Error occurred when fetching JWKS", extra={"error": repr(e)})
+                if not self._jwks:
+                    raise JWTError("Could not fetch signing keys")
+            finally:
+                self._jwks_fetched_at = time.monotonic()
+
+    async def _verify_remotely(self, token: str) -> None:
+        # Imported lazily so the supabase client is only needed when the fallback is enabled
+        from gotrue.errors import AuthApiError
+
+        try:
+            user = await asyncio.to_thread(self.remote_verify, token)
+        except AuthApiError:
+            raise JWTError("Token rejected by Supabase")
+        if user is None:
+            raise JWTError("Token rejected by Supabase")
+
+
+def get_current_user_id(request: Request) -> str:
+    """
+    FastAPI dependency returning the id (`sub` claim) of the user AuthMiddleware authenticated.
+    """
+    return request.state.user["sub"]
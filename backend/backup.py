@@ -0,0 +1,164 @@
+"""
+NDJSON export and import of a user's messages, one JSON object per line. Both directions
+stream: memory use depends on the batch size, not on how many messages there are.
+"""
+import json
+import logging
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from pydantic import ValidationError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from contracts import ImportedMessage
+from crud_message import import_messages
+from models import Conversation, MessageModel
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched from the server-side cursor, and lines written to the response, at a time
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+# Messages inserted per transaction on import
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 1000))
+MAX_IMPORT_LINE_BYTES = 1_000_000
+# Failed lines described in the import result; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+EXPORT_COLUMNS = (
+    MessageModel.id,
+    MessageModel.conversation_id,
+    MessageModel.author,
+    MessageModel.content,
+    MessageModel.status,
+    MessageModel.created_at,
+)
+
+
+class ImportLineTooLong(ValueError):
+    pass
+
+
+async def export_messages(
+    user_id: str,
+    session: AsyncSession,
+    conversation_id: Optional[int] = None,
+    batch_size: int = EXPORT_BATCH_SIZE,
+) -> AsyncIterator[str]:
+    """
+    Yield the user's live messages, oldest first, as NDJSON in chunks of `batch_size` lines.
+    Rows come from a server-side cursor, so only one batch is ever held in memory.
+    """
+    statement = (
+        select(*EXPORT_COLUMNS)
+        .where(MessageModel.user_id == user_id, MessageModel.deleted_at.is_(None))
+        .order_by(MessageModel.id)
+        .execution_options(yield_per=batch_size)
+    )
+    if conversation_id is not None:
+        statement = statement.where(MessageModel.conversation_id == conversation_id)
+
+    result = await session.stream(statement)
+    try:
+        async for rows in result.partitions():
+            yield "".join(
+                json.dumps({
+                    "id": row.id,
+                    "conversation_id": row.conversation_id,
+                    "author": row.author,
+                    "message": row.content,
+                    "status": row.status,
+                    "created_at": row.created_at.isoformat(),
+                }) + "\n"
+                for row in rows
+            )
+    finally:
+        await result.close()
+        # Ends the read transaction so the connection goes back to the pool
+        await session.commit()
+
+
+async def iter_lines(chunks: AsyncIterator[bytes], max_line_bytes: int = MAX_IMPORT_LINE_BYTES) -> AsyncIterator[bytes]:
+    """
+    Split a byte stream into lines without buffering more than one line.
+    """
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+        if len(buffer) > max_line_bytes:
+            raise ImportLineTooLong(f"Lines must be shorter than {max_line_bytes} bytes")
+    if buffer:
+        yield buffer
+
+
+async def import_ndjson(
+    chunks: AsyncIterator[bytes],
+    user_id: str,
+    session: AsyncSession,
+    batch_size: int = IMPORT_BATCH_SIZE,
+) -> Dict[str, Any]:
+    """
+    Import NDJSON messages in the export format into new conversations: every distinct
+    conversation_id in the input becomes a new conversation of the user's, and lines without
+    one share a single new conversation. Each batch is inserted and committed before more of
+    the body is read, so a fast client is slowed to the speed of the database. A failure part
+    way through keeps the batches already committed.
+    """
+    conversations: Dict[Optional[int], int] = {}
+    batch: List[Dict[str, Any]] = []
+    imported = 0
+    failed = 0
+    errors: List[Dict[str, Any]] = []
+
+    def reject(line_number: int, detail: str) -> None:
+        nonlocal failed
+        failed += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({"line": line_number, "detail": detail})
+
+    async def flush() -> None:
+        nonlocal imported
+        new_keys = {m["conversation_id"] for m in batch} - conversations.keys()
+        if new_keys:
+            created = {key: Conversation(user_id=user_id) for key in new_keys}
+            session.add_all(created.values())
+            await session.flush()
+            conversations.update({key: conversation.id for key, conversation in created.items()})
+
+        for message in batch:
+            message["conversation_id"] = conversations[message["conversation_id"]]
+        results = await import_messages(batch, user_id, session)
+        await session.commit()
+        imported += sum(1 for r in results if r["status"] == 200)
+        batch.clear()
+
+    line_number = 0
+    async for line in iter_lines(chunks):
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            message = ImportedMessage.model_validate_json(line)
+        except ValidationError as e:
+            reject(line_number, e.errors(include_url=False)[0]["msg"])
+            continue
+        if not message.message.strip():
+            reject(line_number, "Message cannot be empty")
+            continue
+
+        batch.append({
+            "author": message.author,
+            "content": message.message,
+            "conversation_id": message.conversation_id,
+            "created_at": message.created_at,
+        })
+        if len(batch) >= batch_size:
+            await flush()
+
+    if batch:
+        await flush()
+    logger.info("Messages imported", extra={"imported": imported, "failed": failed})
+    return {"imported": imported, "failed": failed, "errors": errors}
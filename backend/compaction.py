@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Optional
+
+from sqlalchemy import and_, delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from crud_conversation import bump_versions
+from instrumentation import stage
+from metrics import Counter
+from models import IdempotencyKey, MessageModel
+
+logger = logging.getLogger(__name__)
+
+MESSAGES_PURGED = Counter("messages_purged_total", "Messages permanently removed by compaction", labelnames=("reason",))
+
+# Days a soft-deleted message is kept before it is purged
+PURGE_AFTER_DAYS = float(os.getenv("MESSAGE_PURGE_AFTER_DAYS", 30))
+# Days any message is kept at all; unset keeps live messages forever
+RETENTION_DAYS = float(os.getenv("MESSAGE_RETENTION_DAYS", 0)) or None
+COMPACTION_BATCH_SIZE = int(os.getenv("COMPACTION_BATCH_SIZE", 500))
+# Seconds between compaction runs; 0 disables the background task
+COMPACTION_INTERVAL_SECONDS = float(os.getenv("COMPACTION_INTERVAL_SECONDS", 3600))
+
+
+async def compact_messages(
+    session_factory: Callable[[], AsyncSession],
+    purge_after: timedelta = timedelta(days=PURGE_AFTER_DAYS),
+    retention: Optional[timedelta] = timedelta(days=RETENTION_DAYS) if RETENTION_DAYS else None,
+    batch_size: int = COMPACTION_BATCH_SIZE,
+    archive: Optional[Callable[[List[MessageModel]], Awaitable[None]]] = None,
+    now: Optional[datetime] = None,
+) -> int:
+    """
+    Purge messages soft-deleted more than `purge_after` ago and, when `retention` is set, every
+    message older than it. Rows are removed `batch_size` at a time, each batch in its own short
+    transaction, so compaction never holds locks for long. `archive` is awaited with each batch
+    before it is deleted. Returns the number of messages purged.
+    """
+    now = now or datetime.now(timezone.utc)
+    # Repeats the partial index's predicate so the planner can pick ix_message_deleted_at
+    conditions = [("deleted", and_(MessageModel.deleted_at.is_not(None), MessageModel.deleted_at < now - purge_after))]
+    if retention is not None:
+        conditions.append(("expired", MessageModel.created_at < now - retention))
+
+    purged = 0
+    for reason, condition in conditions:
+        while True:
+            async with session_factory() as session:
+                statement = (
+                    select(MessageModel)
+                    .where(condition)
+                    .order_by(MessageModel.id)
+                    .limit(batch_size)
+                    # Skip rows another compactor (e.g. in another worker) is already handling
+                    .with_for_update(skip_locked=True)
+                )
+                batch = list((await session.scalars(statement)).all())
+                if not batch:
+                    break
+
+                if archive is not None:
+                    await archive(batch)
+                await session.execute(
+                    delete(MessageModel)
+                    .where(MessageModel.id.in_([m.id for m in batch]))
+                    .execution_options(synchronize_session=False)
+                )
+                if reason == "expired":
+                    # Live messages are going, so cached copies of their conversations are stale
+                    await bump_versions({m.conversation_id for m in batch}, session)
+                await session.commit()
+
+            purged += len(batch)
+            MESSAGES_PURGED.inc(len(batch), reason=reason)
+            if len(batch) < batch_size:
+                break
+            # Let request handlers run between batches
+            await asyncio.sleep(0)
+
+    if purged:
+        logger.info("Compacted messages", extra={"purged": purged})
+    return purged
+
+
+async def purge_idempotency_keys(session_factory: Callable[[], AsyncSession], now: Optional[datetime] = None) -> int:
+    """
+    Delete expired idempotency keys, including claims abandoned by requests that never finished.
+    """
+    async with session_factory() as session:
+        result = await session.execute(
+            delete(IdempotencyKey)
+            .where(IdempotencyKey.expires_at < (now or datetime.now(timezone.utc)))
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+    return result.rowcount
+
+
+async def run_compaction(session_factory: Callable[[], AsyncSession], interval: float = COMPACTION_INTERVAL_SECONDS) -> None:
+    """
+    Run compact_messages and purge_idempotency_keys every `interval` seconds until cancelled.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            with stage("compaction"):
+                await compact_messages(session_factory)
+                await purge_idempotency_keys(session_factory)
+        except Exception:
+            logger.exception("Error compacting messages")
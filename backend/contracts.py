@@ -1,26 +1,44 @@
-from typing import Tuple
+from datetime import datetime
+from typing import Any, Dict, List, Literal, Optional, Sequence, Tuple
 from pydantic import BaseModel
 
 from models import MessageModel
 
 class PostMessage(BaseModel):
     message: str
+    conversation_id: Optional[int] = None # Starts a new conversation when omitted
 
 class MessageContract(BaseModel):
     id: int
     author: str
     message: str
+    conversation_id: Optional[int] = None
+    status: str = "complete"
 
     @classmethod
     def from_model(
         self,
         message_model: MessageModel
-    ) -> "MessageExchange":
+    ) -> "MessageContract":
         """
         Alternative constructor to create MessageContract from MessageModel.
+        Rows from the database are trusted, so they are not validated again.
         """
-        
-        return MessageContract(id=message_model.id, author=message_model.author, message=message_model.content)
+        return self.model_construct(**self.dump_model(message_model))
+
+    @staticmethod
+    def dump_model(message_model: MessageModel) -> Dict[str, Any]:
+        """
+        The contract's JSON-ready fields, read straight off the row. Used by the hot paths,
+        which return it in an ORJSONResponse rather than building and re-validating models.
+        """
+        return {
+            "id": message_model.id,
+            "author": message_model.author,
+            "message": message_model.content,
+            "conversation_id": message_model.conversation_id,
+            "status": message_model.status
+        }
 
 class MessageExchange(BaseModel):
     exchange: Tuple[MessageContract, MessageContract]
@@ -40,4 +58,51 @@ class MessageExchange(BaseModel):
             MessageContract.from_model(message_models[0]),
             MessageContract.from_model(message_models[1])
         )
-        return self(exchange=message_contracts)
+        return self.model_construct(exchange=message_contracts)
+
+    @staticmethod
+    def dump_models(message_models: Tuple[MessageModel, MessageModel]) -> Dict[str, Any]:
+        return {"exchange": [MessageContract.dump_model(m) for m in message_models]}
+
+class MessagePage(BaseModel):
+    messages: List[MessageContract]
+    next_cursor: Optional[str] = None # Pass back as `cursor` to fetch the next, older page
+
+    @staticmethod
+    def dump_models(message_models: Sequence[MessageModel], next_cursor: Optional[str]) -> Dict[str, Any]:
+        dump_model = MessageContract.dump_model
+        return {"messages": [dump_model(m) for m in message_models], "next_cursor": next_cursor}
+
+class MessageEdit(BaseModel):
+    id: int
+    message: str
+
+class ImportedMessage(BaseModel):
+    author: Literal["user", "chatbot"]
+    message: str
+    conversation_id: Optional[int] = None # Goes into a new conversation when omitted
+    created_at: Optional[datetime] = None # Keeps the original timestamp of imported chat logs
+
+class MessageBatch(BaseModel):
+    edits: List[MessageEdit] = []
+    deletes: List[int] = []
+    imports: List[ImportedMessage] = []
+
+class BatchItemResult(BaseModel):
+    id: Optional[int] = None
+    status: int # HTTP status the item would have had as a single request
+    detail: Optional[str] = None
+
+class BatchResult(BaseModel):
+    edits: List[BatchItemResult]
+    deletes: List[BatchItemResult]
+    imports: List[BatchItemResult]
+
+class ImportLineError(BaseModel):
+    line: int
+    detail: str
+
+class ImportResult(BaseModel):
+    imported: int
+    failed: int
+    errors: List[ImportLineError] # The first failures only; `failed` counts them all
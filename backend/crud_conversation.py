@@ -0,0 +1,71 @@
+import logging
+from typing import Dict, Iterable, Optional
+from fastapi import HTTPException
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+from models import Conversation
+
+logger = logging.getLogger(__name__)
+
+async def get_conversation(conversation_id: int, user_id: str, session: AsyncSession) -> Conversation:
+    """
+    Fetch a conversation owned by user_id, raising 404 if it does not exist or belongs to someone else.
+    """
+    conversation = await session.get(Conversation, conversation_id)
+    if conversation is None or conversation.user_id != user_id or conversation.deleted_at is not None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Could not find a conversation with id {conversation_id}"
+        )
+    return conversation
+
+async def get_or_create_conversation(conversation_id: Optional[int], user_id: str, session: AsyncSession) -> Conversation:
+    """
+    Return the user's conversation, or start a new one when no id is given.
+    """
+    try:
+        if conversation_id is not None:
+            conversation = await get_conversation(conversation_id, user_id, session)
+        else:
+            conversation = Conversation(user_id=user_id)
+            session.add(conversation)
+
+        # Ends the transaction so no pooled connection is held while the reply is generated
+        await session.commit()
+        return conversation
+
+    except HTTPException as e:
+        logger.warning("Error getting conversation", extra={"conversation_id": conversation_id, "detail": e.detail})
+        raise e
+
+    except Exception as e:
+        logger.exception("Unexpected error getting conversation", extra={"conversation_id": conversation_id})
+        raise HTTPException(
+            status_code=500,
+            detail="An unexpected error occurred. Please try again later."
+        )
+
+async def bump_versions(conversation_ids: Iterable[Optional[int]], session: AsyncSession) -> Dict[int, int]:
+    """
+    Increment the version of each conversation whose messages are being written, in the
+    caller's transaction, and return the new versions. Conversations already loaded in the
+    session get the new version too, so the session reads its own writes from the cache.
+    Does not commit.
+    """
+    ids = {conversation_id for conversation_id in conversation_ids if conversation_id is not None}
+    if not ids:
+        return {}
+    statement = (
+        update(Conversation)
+        .where(Conversation.id.in_(ids))
+        .values(version=Conversation.version + 1)
+        .returning(Conversation.id, Conversation.version)
+        .execution_options(synchronize_session=False)
+    )
+    versions = dict((await session.execute(statement)).tuples().all())
+    for conversation_id, version in versions.items():
+        conversation = session.identity_map.get(session.identity_key(Conversation, conversation_id))
+        if conversation is not None:
+            set_committed_value(conversation, "version", version)
+    return versions
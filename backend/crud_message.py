@@ -1,8 +1,29 @@
-from select import select
-from typing import List
+import base64
+import binascii
+import json
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 from fastapi import HTTPException
+from sqlalchemy import insert, select, tuple_, update
 from sqlalchemy.ext.asyncio import AsyncSession
-from models import MessageModel
+from crud_conversation import bump_versions
+from message_cache import CachedMessage, message_cache, message_sort_key
+from models import Conversation, MessageModel
+
+logger = logging.getLogger(__name__)
+
+def _write_through(versions: Dict[int, int], upserts: List[MessageModel] = (), removed: List[Tuple[int, int]] = ()) -> None:
+    """
+    Apply committed message writes to the conversation cache. `removed` holds (id, conversation_id) pairs.
+    """
+    for conversation_id, version in versions.items():
+        message_cache.write_through(
+            conversation_id,
+            version,
+            upserts=[m for m in upserts if m.conversation_id == conversation_id],
+            removed_ids=[message_id for message_id, c in removed if c == conversation_id],
+        )
 
 async def create_messages(messages: List[dict], session: AsyncSession) -> List[MessageModel]:
     """
@@ -12,70 +33,362 @@ async def create_messages(messages: List[dict], session: AsyncSession) -> List[M
         messages_models = [
             MessageModel(
                 author=m["author"],
-                content=m["content"]
+                content=m["content"],
+                conversation_id=m.get("conversation_id"),
+                user_id=m.get("user_id"),
+                status=m.get("status", "complete"),
+                reply_to_id=m.get("reply_to_id")
             ) for m in messages]
         session.add_all(messages_models)
+        versions = await bump_versions((m.conversation_id for m in messages_models), session)
         await session.commit()
-        print(f"Messages created: {messages_models}\n")
+        _write_through(versions, upserts=messages_models)
+        logger.info("Messages created", extra={"message_ids": [m.id for m in messages_models]})
         return messages_models
 
     except Exception as e:
-        print(f"Unexpected error creating messages: {e}\n")
+        logger.exception("Unexpected error creating messages")
         raise HTTPException(
             status_code=500,
             detail="An unexpected error occurred. Please try again later."
         )
 
-async def update_message(message_id: int, new_content: str, session: AsyncSession) -> MessageModel:
+async def create_reply(user_message: MessageModel, content: str, session: AsyncSession, status: str = "complete") -> MessageModel:
     """
-    Update message with message_id in the database, returning 200 on success.
+    Store the chatbot's reply to user_message and set the exchange's status, in one commit.
     """
     try:
-        # Update the message content
-        db_message = await session.get(MessageModel, message_id)
+        reply = MessageModel(
+            author="chatbot",
+            content=content,
+            conversation_id=user_message.conversation_id,
+            user_id=user_message.user_id,
+            reply_to_id=user_message.id
+        )
+        user_message.status = status
+        session.add_all([user_message, reply])
+        versions = await bump_versions([user_message.conversation_id], session)
+        await session.commit()
+        _write_through(versions, upserts=[user_message, reply])
+        logger.info("Reply created", extra={"message_id": reply.id, "reply_to_id": reply.reply_to_id, "status": status})
+        return reply
+
+    except Exception as e:
+        logger.exception("Unexpected error creating reply")
+        raise HTTPException(
+            status_code=500,
+            detail="An unexpected error occurred. Please try again later."
+        )
+
+async def set_message_status(message: MessageModel, status: str, session: AsyncSession) -> MessageModel:
+    try:
+        message.status = status
+        session.add(message)
+        versions = await bump_versions([message.conversation_id], session)
+        await session.commit()
+        _write_through(versions, upserts=[message])
+        return message
+
+    except Exception as e:
+        logger.exception("Unexpected error updating message status", extra={"message_id": message.id})
+        raise HTTPException(
+            status_code=500,
+            detail="An unexpected error occurred. Please try again later."
+        )
+
+async def update_message(message_id: int, new_content: str, user_id: str, session: AsyncSession) -> MessageModel:
+    """
+    Update the user's message with message_id in the database, raising 404 if it is not theirs.
+    Messages stored before accounts existed are theirs once migrations.py has given them an owner.
+    """
+    try:
+        # Update the message content in one UPDATE ... RETURNING, skipping deleted messages
+        statement = (
+            update(MessageModel)
+            .where(MessageModel.id == message_id, MessageModel.user_id == user_id, MessageModel.deleted_at.is_(None))
+            .values(content=new_content, updated_at=datetime.now(timezone.utc))
+            .returning(MessageModel)
+            .execution_options(populate_existing=True)
+        )
+        db_message = await session.scalar(statement)
         if db_message == None:
             raise HTTPException(
                 status_code=404,
                 detail=f"Could not find a message with id {message_id}"
             )
-        db_message.content = new_content
+        versions = await bump_versions([db_message.conversation_id], session)
         await session.commit()
-        await session.refresh(db_message)
-        print(f"Message with id: {message_id} updated!\n")
+        _write_through(versions, upserts=[db_message])
+        logger.info("Message updated", extra={"message_id": message_id})
         return db_message
     
     except HTTPException as e:
-        print(f"Unexpected error creating messages: {e}\n")
+        logger.warning("Message not found", extra={"message_id": message_id, "detail": e.detail})
         raise e
 
     except Exception as e:
-        print(f"Unexpected error creating messages: {e}\n")
+        logger.exception("Unexpected error changing message", extra={"message_id": message_id})
         raise HTTPException(
             status_code=500,
             detail="An unexpected error occurred. Please try again later."
         )
     
 
-async def delete_message(message_id: int, session: AsyncSession) -> bool:
+async def delete_message(message_id: int, user_id: str, session: AsyncSession) -> bool:
+    """
+    Soft delete one of the user's messages with a single UPDATE of deleted_at, raising 404 if it
+    is not theirs. Compaction purges it later.
+    """
     try:
-        db_message = await session.get(MessageModel, message_id)
-        if db_message == None:
+        statement = (
+            update(MessageModel)
+            .where(MessageModel.id == message_id, MessageModel.user_id == user_id, MessageModel.deleted_at.is_(None))
+            .values(deleted_at=datetime.now(timezone.utc))
+            .returning(MessageModel.id, MessageModel.conversation_id)
+            .execution_options(synchronize_session=False)
+        )
+        deleted = (await session.execute(statement)).first()
+        if deleted is None:
             raise HTTPException(
                 status_code=404,
                 detail=f"Could not find a message with id {message_id}"
             )
-        await session.delete(db_message)
+        versions = await bump_versions([deleted.conversation_id], session)
         await session.commit()
-        print(f"Message with id: {message_id} deleted!\n")
+        _write_through(versions, removed=[tuple(deleted)])
+        logger.info("Message deleted", extra={"message_id": message_id})
         return True
     
     except HTTPException as e:
-        print(f"Unexpected error creating messages: {e}\n")
+        logger.warning("Message not found", extra={"message_id": message_id, "detail": e.detail})
         raise e
 
     except Exception as e:
-        print(f"Unexpected error creating messages: {e}\n")
+        logger.exception("Unexpected error changing message", extra={"message_id": message_id})
+        raise HTTPException(
+            status_code=500,
+            detail="An unexpected error occurred. Please try again later."
+        )
+
+def _item_result(item_id: Optional[int], status: int = 200, detail: Optional[str] = None) -> Dict[str, Any]:
+    return {"id": item_id, "status": status, "detail": detail}
+
+async def _owned_message_ids(message_ids: List[int], user_id: str, session: AsyncSession) -> Dict[int, Optional[int]]:
+    """
+    Map the ids of the user's live messages among message_ids to their conversation ids.
+    """
+    if not message_ids:
+        return {}
+    statement = select(MessageModel.id, MessageModel.conversation_id).where(
+        MessageModel.id.in_(message_ids),
+        MessageModel.user_id == user_id,
+        MessageModel.deleted_at.is_(None)
+    )
+    return dict((await session.execute(statement)).tuples().all())
+
+async def update_messages(edits: List[dict], user_id: str, session: AsyncSession) -> List[Dict[str, Any]]:
+    """
+    Apply edits ({"id", "content"}) to the user's messages with a single executemany UPDATE.
+    Does not commit; the caller owns the transaction.
+    """
+    owned = await _owned_message_ids([e["id"] for e in edits], user_id, session)
+    results = []
+    rows = []
+    now = datetime.now(timezone.utc)
+    for edit in edits:
+        if not edit["content"].strip():
+            results.append(_item_result(edit["id"], 400, "Message cannot be empty"))
+        elif edit["id"] not in owned:
+            results.append(_item_result(edit["id"], 404, f"Could not find a message with id {edit['id']}"))
+        else:
+            rows.append({"id": edit["id"], "content": edit["content"], "updated_at": now})
+            results.append(_item_result(edit["id"]))
+
+    if rows:
+        # Bulk UPDATE by primary key, sent as one executemany
+        await session.execute(update(MessageModel), rows)
+        await bump_versions((owned[row["id"]] for row in rows), session)
+    return results
+
+async def delete_messages(message_ids: List[int], user_id: str, session: AsyncSession) -> List[Dict[str, Any]]:
+    """
+    Soft delete the user's messages with a single UPDATE ... WHERE id IN (...).
+    Does not commit; the caller owns the transaction.
+    """
+    deleted = set()
+    if message_ids:
+        statement = (
+            update(MessageModel)
+            .where(
+                MessageModel.id.in_(message_ids),
+                MessageModel.user_id == user_id,
+                MessageModel.deleted_at.is_(None)
+            )
+            .values(deleted_at=datetime.now(timezone.utc))
+            .returning(MessageModel.id, MessageModel.conversation_id)
+            .execution_options(synchronize_session=False)
+        )
+        deleted_rows = (await session.execute(statement)).tuples().all()
+        deleted = {message_id for message_id, _ in deleted_rows}
+        await bump_versions((conversation_id for _, conversation_id in deleted_rows), session)
+    return [
+        _item_result(message_id) if message_id in deleted
+        else _item_result(message_id, 404, f"Could not find a message with id {message_id}")
+        for message_id in message_ids
+    ]
+
+async def import_messages(messages: List[dict], user_id: str, session: AsyncSession) -> List[Dict[str, Any]]:
+    """
+    Insert imported messages ({"author", "content", "conversation_id", "created_at"}) with one
+    executemany INSERT. Messages without a conversation_id go into a new conversation.
+    Does not commit; the caller owns the transaction.
+    """
+    conversation_ids = {m["conversation_id"] for m in messages if m.get("conversation_id") is not None}
+    owned = set()
+    if conversation_ids:
+        statement = select(Conversation.id).where(
+            Conversation.id.in_(conversation_ids),
+            Conversation.user_id == user_id,
+            Conversation.deleted_at.is_(None)
+        )
+        owned = set((await session.scalars(statement)).all())
+
+    now = datetime.now(timezone.utc)
+    results: List[Optional[Dict[str, Any]]] = []
+    rows = []
+    for message in messages:
+        conversation_id = message.get("conversation_id")
+        if not message["content"].strip():
+            results.append(_item_result(None, 400, "Message cannot be empty"))
+        elif conversation_id is not None and conversation_id not in owned:
+            results.append(_item_result(None, 404, f"Could not find a conversation with id {conversation_id}"))
+        else:
+            rows.append({
+                "author": message["author"],
+                "content": message["content"],
+                "conversation_id": conversation_id,
+                "user_id": user_id,
+                "created_at": message.get("created_at") or now,
+            })
+            results.append(None)
+
+    # Only started once a message is accepted into it, so rejected imports leave no empty conversation
+    if any(row["conversation_id"] is None for row in rows):
+        new_conversation = Conversation(user_id=user_id)
+        session.add(new_conversation)
+        await session.flush()
+        for row in rows:
+            if row["conversation_id"] is None:
+                row["conversation_id"] = new_conversation.id
+
+    if rows:
+        statement = insert(MessageModel).returning(MessageModel.id, sort_by_parameter_order=True)
+        ids = iter((await session.scalars(statement, rows)).all())
+        await bump_versions((row["conversation_id"] for row in rows), session)
+        results = [result if result is not None else _item_result(next(ids)) for result in results]
+    return results
+
+async def apply_batch(
+    edits: List[dict],
+    deletes: List[int],
+    imports: List[dict],
+    user_id: str,
+    session: AsyncSession
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Apply bulk edits, deletes and imports in one transaction, returning a result per item.
+    Items that are invalid or not found are reported and skipped; any other error rolls back the whole batch.
+    """
+    try:
+        results = {
+            "edits": await update_messages(edits, user_id, session),
+            "deletes": await delete_messages(deletes, user_id, session),
+            "imports": await import_messages(imports, user_id, session),
+        }
+        await session.commit()
+        logger.info("Batch applied", extra={"edits": len(edits), "deletes": len(deletes), "imports": len(imports)})
+        return results
+
+    except Exception as e:
+        await session.rollback()
+        logger.exception("Unexpected error applying batch")
         raise HTTPException(
             status_code=500,
             detail="An unexpected error occurred. Please try again later."
-        )
\ No newline at end of file
+        )
+
+def encode_cursor(message: Union[MessageModel, CachedMessage]) -> str:
+    raw = json.dumps([message.created_at.isoformat(), message.id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        created_at, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(message_id)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def get_messages_page(
+    conversation_id: int,
+    session: AsyncSession,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    version: Optional[int] = None
+) -> Tuple[Sequence[Union[MessageModel, CachedMessage]], Optional[str]]:
+    """
+    Return one page of a conversation's messages, newest first, and the cursor for the next (older) page.
+
+    Uses keyset pagination on (created_at, id), served by the partial index on live messages,
+    so every page costs the same regardless of how deep into the history it is.
+    Given the conversation's `version`, pages within the newest messages come from the
+    conversation cache; only the first page loads the cache on a miss.
+    """
+    if version is not None:
+        if cursor is None:
+            entry = await message_cache.recent(conversation_id, version, session)
+        else:
+            entry = message_cache.get(conversation_id, version)
+        if entry is not None:
+            cached = entry.messages
+            if cursor is not None:
+                before = message_sort_key(*decode_cursor(cursor))
+                cached = [m for m in cached if m.sort_key < before]
+            if len(cached) > limit:
+                return cached[:limit], encode_cursor(cached[limit - 1])
+            if entry.complete:
+                return cached, None
+
+    statement = (
+        select(MessageModel)
+        .where(MessageModel.conversation_id == conversation_id, MessageModel.deleted_at.is_(None))
+        .order_by(MessageModel.created_at.desc(), MessageModel.id.desc())
+        .limit(limit + 1)
+    )
+    if cursor is not None:
+        statement = statement.where(tuple_(MessageModel.created_at, MessageModel.id) < decode_cursor(cursor))
+
+    messages = list((await session.scalars(statement)).all())
+    next_cursor = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        next_cursor = encode_cursor(messages[-1])
+    return messages, next_cursor
+
+async def get_user_message(message_id: int, user_id: str, session: AsyncSession) -> MessageModel:
+    """
+    Fetch one of the user's own prompts, raising 404 if it does not exist, is deleted or belongs to someone else.
+    """
+    message = await session.get(MessageModel, message_id)
+    if message is None or message.user_id != user_id or message.author != "user" or message.deleted_at is not None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Could not find a message with id {message_id}"
+        )
+    return message
+
+async def get_reply(message: MessageModel, session: AsyncSession) -> Optional[MessageModel]:
+    statement = select(MessageModel).where(
+        MessageModel.reply_to_id == message.id,
+        MessageModel.deleted_at.is_(None)
+    )
+    return await session.scalar(statement)
@@ -1,17 +1,136 @@
 # database.py
 import os
-from typing import AsyncGenerator
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+import time
+from typing import Any, AsyncGenerator, Dict, Optional
+from uuid import uuid4
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-engine = create_async_engine(os.getenv("DATABASE_URL"), echo=True)
+from instrumentation import stage
+from metrics import Gauge, Histogram
 
+POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the database pool",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return default if value is None else int(value)
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return default if value is None else float(value)
+
+class InstrumentedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Queue pool that records how long each checkout waited for a connection.
+    """
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.observe(time.perf_counter() - start)
+
+class InstrumentedAsyncSession(AsyncSession):
+    """
+    Session that times each commit as the db_commit stage.
+    """
+    async def commit(self) -> None:
+        with stage("db_commit"):
+            await super().commit()
+
+def engine_options(database_url: str) -> Dict[str, Any]:
+    """
+    Build create_async_engine keyword arguments from the environment.
+
+    DB_ECHO                  log every statement (default off)
+    DB_POOL_SIZE             persistent connections per process (default 5)
+    DB_MAX_OVERFLOW          extra connections allowed under load (default 10)
+    DB_POOL_TIMEOUT          seconds to wait for a connection before failing (default 30)
+    DB_POOL_PRE_PING         test connections on checkout (default on)
+    DB_POOL_RECYCLE          seconds before a connection is replaced (default 1800)
+    DB_STATEMENT_CACHE_SIZE  asyncpg prepared statement cache size (default 100); set it to 0
+                             behind a transaction pooler such as PgBouncer or the Supabase pooler
+    """
+    url = make_url(database_url)
+    options: Dict[str, Any] = {"echo": _env_bool("DB_ECHO", False)}
+
+    # SQLite picks its own pool (a single static connection for in-memory databases)
+    if url.get_backend_name() == "sqlite":
+        return options
+
+    options.update(
+        poolclass=InstrumentedAsyncAdaptedQueuePool,
+        pool_size=_env_int("DB_POOL_SIZE", 5),
+        max_overflow=_env_int("DB_MAX_OVERFLOW", 10),
+        pool_timeout=_env_float("DB_POOL_TIMEOUT", 30),
+        pool_pre_ping=_env_bool("DB_POOL_PRE_PING", True),
+        pool_recycle=_env_int("DB_POOL_RECYCLE", 1800),
+    )
+
+    if url.get_driver_name() == "asyncpg":
+        statement_cache_size = _env_int("DB_STATEMENT_CACHE_SIZE", 100)
+        connect_args: Dict[str, Any] = {
+            "statement_cache_size": statement_cache_size,
+            "prepared_statement_cache_size": statement_cache_size,
+        }
+        if statement_cache_size == 0:
+            # Transaction poolers hand each transaction a different backend, so statement
+            # names must never collide with ones prepared by another client
+            connect_args["prepared_statement_name_func"] = lambda: f"__asyncpg_{uuid4()}__"
+        options["connect_args"] = connect_args
+
+    return options
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+# Created by init_engine, in the app's lifespan, so that every worker process has its own pool
+engine: Optional[AsyncEngine] = None
+
+def _pool_stat(name: str) -> float:
+    stat: Optional[Any] = getattr(engine.pool, name, None) if engine is not None else None
+    return stat() if callable(stat) else 0
+
+Gauge("db_pool_size", "Configured size of the database pool", callback=lambda: _pool_stat("size"))
+Gauge("db_pool_checked_out", "Database connections currently checked out", callback=lambda: _pool_stat("checkedout"))
+Gauge("db_pool_overflow", "Overflow connections currently open", callback=lambda: max(0, _pool_stat("overflow")))
+
+# Bound to the engine by init_engine
 AsyncSessionLocal = sessionmaker(
-    bind=engine,
     expire_on_commit=False,
-    class_=AsyncSession
+    class_=InstrumentedAsyncSession
 )
 
+def init_engine(database_url: Optional[str] = None) -> AsyncEngine:
+    """
+    Create this process's engine, if it has none yet, and bind AsyncSessionLocal to it.
+    """
+    global engine
+    if engine is None:
+        database_url = database_url or DATABASE_URL
+        engine = create_async_engine(database_url, **engine_options(database_url))
+        AsyncSessionLocal.configure(bind=engine)
+    return engine
+
+async def dispose_engine() -> None:
+    """
+    Close the engine's pooled connections. Sessions still open keep working until they end.
+    """
+    global engine
+    if engine is not None:
+        await engine.dispose()
+        engine = None
+
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
     async with AsyncSessionLocal() as session:
         yield session
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import time
+import uuid
+from typing import Optional
+
+import httpx
+from openai import AsyncOpenAI
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+
+class FakeOpenAI:
+    """
+    Stand-in for the OpenAI chat completions API, for tests and benchmarks.
+
+    It replies with `reply` after `latency` seconds, streams it at `tokens_per_second` when asked
+    to, and simulates rate limiting: the first `rate_limit_first` requests, and any request beyond
+    `max_concurrency` concurrent ones, get a 429 with a Retry-After of `retry_after` seconds.
+
+    Use `client()` for an AsyncOpenAI wired to it in-process, or serve `app` with uvicorn and point
+    OPENAI_BASE_URL at it.
+    """
+
+    def __init__(
+        self,
+        reply: str = "Fake LLM Response",
+        latency: float = 0.0,
+        tokens_per_second: Optional[float] = None,
+        rate_limit_first: int = 0,
+        max_concurrency: Optional[int] = None,
+        retry_after: float = 0.01,
+    ):
+        self.reply = reply
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.rate_limit_first = rate_limit_first
+        self.max_concurrency = max_concurrency
+        self.retry_after = retry_after
+        self.calls = 0
+        self.rate_limited = 0
+        self.in_flight = 0
+        self.app = Starlette(routes=[Route("/v1/chat/completions", self.chat_completions, methods=["POST"])])
+
+    def client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(
+            api_key="fake",
+            base_url="http://fake-openai/v1",
+            http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=self.app)),
+            max_retries=0,
+        )
+
+    def _tokens(self):
+        # Split on spaces but keep them, like real completion chunks
+        words = self.reply.split(" ")
+        return [word + " " for word in words[:-1]] + words[-1:]
+
+    async def chat_completions(self, request: Request) -> Response:
+        body = await request.json()
+        self.calls += 1
+
+        if self.calls <= self.rate_limit_first or (
+            self.max_concurrency is not None and self.in_flight >= self.max_concurrency
+        ):
+            self.rate_limited += 1
+            return JSONResponse(
+                status_code=429,
+                content={"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                headers={"retry-after": str(self.retry_after)},
+            )
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = body.get("model", "gpt-4o")
+
+        if body.get("stream"):
+            return StreamingResponse(
+                self._stream(completion_id, created, model),
+                media_type="text/event-stream",
+            )
+
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+
+        prompt_tokens = sum(len(str(m.get("content", ""))) // 4 + 1 for m in body.get("messages", []))
+        completion_tokens = len(self._tokens())
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.reply},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    async def _stream(self, completion_id: str, created: int, model: str):
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(self.latency)
+            for token in self._tokens():
+                if self.tokens_per_second:
+                    await asyncio.sleep(1 / self.tokens_per_second)
+                yield self._chunk(completion_id, created, model, {"content": token}, None)
+            yield self._chunk(completion_id, created, model, {}, "stop")
+            yield "data: [DONE]\n\n"
+        finally:
+            self.in_flight -= 1
+
+    @staticmethod
+    def _chunk(completion_id: str, created: int, model: str, delta: dict, finish_reason: Optional[str]) -> str:
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(chunk)}\n\n"
@@ -0,0 +1,214 @@
+"""
+Idempotency-Key support for POST /message. A retried or double-submitted request carrying the
+same key gets the first request's response instead of generating and storing another exchange.
+
+Completed responses are kept for IDEMPOTENCY_TTL_SECONDS in the idempotency_key table, which
+every worker shares, behind a bounded in-process cache. Duplicates that arrive while the first
+request is still running wait for its result: within a worker they attach to the call in
+flight, across workers they poll the table until the claimant stores its response or its
+lease runs out, in which case they take the key over.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import TTLCache
+from metrics import Counter
+from models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_REQUESTS = Counter(
+    "idempotent_requests_total",
+    "Requests carrying an Idempotency-Key by whether they were processed or answered with an earlier response",
+    labelnames=("result",),
+)
+
+# Seconds a completed response is replayed for
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", 86400))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 10000))
+# Seconds a claimed key is left to its claimant before another worker may take it over;
+# keep it above the time a request can take (LLM_TIMEOUT_SECONDS and its retries)
+IDEMPOTENCY_LEASE_SECONDS = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", 120))
+IDEMPOTENCY_POLL_SECONDS = 0.2
+MAX_KEY_LENGTH = 255
+
+
+def request_hash(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(
+        self,
+        maxsize: int = IDEMPOTENCY_CACHE_SIZE,
+        ttl: float = IDEMPOTENCY_TTL_SECONDS,
+        lease: float = IDEMPOTENCY_LEASE_SECONDS,
+        poll_interval: float = IDEMPOTENCY_POLL_SECONDS,
+    ):
+        self.ttl = ttl
+        self.lease = lease
+        self.poll_interval = poll_interval
+        # (user_id, key) -> (request hash, response)
+        self._completed = TTLCache(maxsize=maxsize, ttl=ttl)
+        # (user_id, key) -> (request hash, future resolved with the response)
+        self._in_flight: Dict[Tuple[str, str], Tuple[str, asyncio.Future]] = {}
+
+    def clear(self) -> None:
+        self._completed.clear()
+
+    async def run(
+        self,
+        user_id: str,
+        key: str,
+        request_hash: str,
+        session: AsyncSession,
+        call: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> Tuple[Dict[str, Any], bool]:
+        """
+        Return the response to the request identified by `key` and whether it is a replay: the
+        stored response, the result of the same request in flight, or else the result of
+        awaiting `call`, which is then stored. Raises 422 if the key was used for a different
+        request. Failed calls are not stored, so the request can be retried with the same key.
+        """
+        if len(key) > MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail=f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters")
+
+        cache_key = (user_id, key)
+        while True:
+            completed = self._completed.get(cache_key)
+            if completed is not None:
+                _check_request(completed[0], request_hash)
+                IDEMPOTENT_REQUESTS.inc(result="replayed")
+                return completed[1], True
+
+            in_flight = self._in_flight.get(cache_key)
+            if in_flight is None:
+                break
+            _check_request(in_flight[0], request_hash)
+            try:
+                response = await asyncio.shield(in_flight[1])
+            except asyncio.CancelledError:
+                # The request doing the work went away; take over unless this one is going too
+                if in_flight[1].cancelled() and not asyncio.current_task().cancelling():
+                    continue
+                raise
+            IDEMPOTENT_REQUESTS.inc(result="coalesced")
+            return response, True
+
+        future = asyncio.get_running_loop().create_future()
+        # Marks a failure as retrieved even when no duplicate was waiting for it
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._in_flight[cache_key] = (request_hash, future)
+        try:
+            response, replayed = await self._run_claimed(user_id, key, request_hash, session, call)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._in_flight[cache_key]
+
+        future.set_result(response)
+        self._completed.set(cache_key, (request_hash, response))
+        return response, replayed
+
+    async def _run_claimed(
+        self,
+        user_id: str,
+        key: str,
+        request_hash: str,
+        session: AsyncSession,
+        call: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> Tuple[Dict[str, Any], bool]:
+        while True:
+            record = await self._claim(user_id, key, request_hash, session)
+            if record is None:
+                break
+            _check_request(record.request_hash, request_hash)
+            if record.response is not None:
+                IDEMPOTENT_REQUESTS.inc(result="replayed")
+                return json.loads(record.response), True
+            # Another worker is processing the same request
+            await asyncio.sleep(self.poll_interval)
+
+        IDEMPOTENT_REQUESTS.inc(result="processed")
+        try:
+            response = await call()
+        except BaseException:
+            # Also when the request is cancelled, so a retry need not wait out the lease;
+            # shielded so that finishing the cancellation does not cut the release short
+            await asyncio.shield(self._release(user_id, key, session))
+            raise
+
+        await session.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key)
+            .values(response=json.dumps(response), expires_at=datetime.now(timezone.utc) + timedelta(seconds=self.ttl))
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        return response, False
+
+    async def _claim(self, user_id: str, key: str, request_hash: str, session: AsyncSession) -> Optional[IdempotencyKey]:
+        """
+        Claim the key for this request. Returns None once claimed, or the record of the request
+        that holds it. Expired records are replaced.
+        """
+        where = (IdempotencyKey.user_id == user_id, IdempotencyKey.key == key)
+        insert = postgresql_insert if session.bind.dialect.name == "postgresql" else sqlite_insert
+        while True:
+            now = datetime.now(timezone.utc)
+            await session.execute(
+                delete(IdempotencyKey)
+                .where(*where, IdempotencyKey.expires_at < now)
+                .execution_options(synchronize_session=False)
+            )
+            result = await session.execute(
+                insert(IdempotencyKey)
+                .values(user_id=user_id, key=key, request_hash=request_hash, expires_at=now + timedelta(seconds=self.lease))
+                .on_conflict_do_nothing()
+            )
+            if result.rowcount == 1:
+                await session.commit()
+                return None
+
+            record = await session.scalar(select(IdempotencyKey).where(*where).execution_options(populate_existing=True))
+            # Ends the transaction so no connection or lock is held while waiting
+            await session.commit()
+            if record is not None:
+                return record
+
+    async def _release(self, user_id: str, key: str, session: AsyncSession) -> None:
+        try:
+            await session.rollback()
+            await session.execute(
+                delete(IdempotencyKey)
+                .where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key, IdempotencyKey.response.is_(None))
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        except Exception as e:
+            # The claim lapses once its lease expires
+            logger.warning("Error releasing idempotency key", extra={"error": repr(e)})
+
+
+def _check_request(stored_hash: str, request_hash: str) -> None:
+    if stored_hash != request_hash:
+        IDEMPOTENT_REQUESTS.inc(result="mismatch")
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+
+
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,134 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from typing import Any, Iterator, Optional
+
+from metrics import Counter, Histogram
+
+try:
+    from opentelemetry import trace
+except ImportError: # Optional, spans are only recorded when OpenTelemetry is installed
+    trace = None
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_DURATION = Histogram(
+    "request_stage_duration_seconds",
+    "Time spent in each stage of a request",
+    labelnames=("stage",),
+    buckets=STAGE_BUCKETS,
+)
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    "llm_time_to_first_token_seconds",
+    "Time from sending a streamed completion request to its first content token",
+    labelnames=("model",),
+    buckets=STAGE_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "Tokens sent to and generated by the LLM",
+    labelnames=("model", "kind"),
+)
+
+_tracer = trace.get_tracer("chatbot") if trace is not None else None
+
+
+@contextmanager
+def stage(name: str, **attributes: Any) -> Iterator[None]:
+    """
+    Time a stage of a request into request_stage_duration_seconds{stage=name}, inside an
+    OpenTelemetry span of the same name when OpenTelemetry is installed.
+    """
+    span = _tracer.start_as_current_span(name, attributes=attributes) if _tracer is not None else nullcontext()
+    start = time.perf_counter()
+    with span:
+        try:
+            yield
+        finally:
+            STAGE_DURATION.observe(time.perf_counter() - start, stage=name)
+
+
+def record_stage(name: str, seconds: float) -> None:
+    """
+    Record a stage timed by hand, for stages that span a generator's yields.
+    """
+    STAGE_DURATION.observe(seconds, stage=name)
+
+
+def record_tokens(model: str, prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> None:
+    if isinstance(prompt_tokens, int):
+        LLM_TOKENS.inc(prompt_tokens, model=model, kind="prompt")
+    if isinstance(completion_tokens, int):
+        LLM_TOKENS.inc(completion_tokens, model=model, kind="completion")
+
+
+# Attributes every LogRecord has; anything else was passed through `extra` and is logged as a field
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, including any fields passed through `extra`.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve the message and traceback on the calling thread, where the arguments and
+        # exception are still valid, but leave the formatting to the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configure_logging(level: Optional[str] = None) -> None:
+    """
+    Send log records through a queue to a background thread that writes them to stdout as
+    JSON, so logging never blocks the event loop on a slow stdout. LOG_LEVEL sets the level
+    (default INFO). Safe to call more than once.
+    """
+    global _listener
+    root = logging.getLogger()
+    root.setLevel(level or os.getenv("LOG_LEVEL", "INFO"))
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root.addHandler(_QueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
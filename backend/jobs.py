@@ -0,0 +1,225 @@
+"""
+Background generation of chatbot replies.
+
+POST /message/async stores the user message with status "queued", which makes the message
+table itself the job queue. Workers claim queued messages one at a time, generate the reply,
+and store it exactly like POST /message does. The API process runs JOB_WORKERS workers
+in-process; set JOB_WORKERS=0 there and run `python jobs.py` to consume the queue from a
+separate worker process instead.
+"""
+from dotenv import load_dotenv
+load_dotenv()
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import and_, or_, select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from crud_conversation import bump_versions
+from crud_message import create_reply, set_message_status
+from instrumentation import stage
+from llm_service import build_context, get_chatbot_response
+from message_cache import message_cache
+from metrics import Counter, Gauge
+from models import JOB_STATUS_PREDICATE, Conversation, MessageModel
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+# How often idle workers look for jobs queued by other processes
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", 1))
+# Seconds a claimed job may stay "pending" before it is presumed abandoned (its worker crashed
+# or was stopped) and claimed again; keep it well above the time a generation can take
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 300))
+# Seconds running jobs get to finish on shutdown, after the server has drained its requests
+JOB_SHUTDOWN_SECONDS = float(os.getenv("JOB_SHUTDOWN_SECONDS", 10))
+
+GENERATION_JOBS = Counter("generation_jobs_total", "Background reply generations by outcome", labelnames=("outcome",))
+GENERATION_JOBS_RUNNING = Gauge("generation_jobs_running", "Background reply generations in progress")
+
+
+def _claimable(lease: float):
+    return or_(
+        MessageModel.status == "queued",
+        and_(
+            MessageModel.status == "pending",
+            MessageModel.claimed_at < datetime.now(timezone.utc) - timedelta(seconds=lease)
+        ),
+    )
+
+
+async def claim_job(session: AsyncSession, lease: float = JOB_LEASE_SECONDS) -> Optional[MessageModel]:
+    """
+    Move the oldest queued message, or one whose claim has been "pending" for longer than
+    `lease` seconds, to "pending" and return it, or return None when there is none. The
+    conditional UPDATE makes sure only one worker, in any process, claims a job.
+    """
+    while True:
+        candidate = await session.scalar(
+            select(MessageModel.id)
+            .where(text(JOB_STATUS_PREDICATE), _claimable(lease), MessageModel.deleted_at.is_(None))
+            .order_by(MessageModel.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        if candidate is None:
+            await session.commit()
+            return None
+
+        result = await session.execute(
+            update(MessageModel)
+            .where(MessageModel.id == candidate, _claimable(lease))
+            .values(status="pending", claimed_at=datetime.now(timezone.utc))
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            await session.commit()
+            continue
+
+        message = await session.get(MessageModel, candidate, populate_existing=True)
+        versions = await bump_versions([message.conversation_id], session)
+        await session.commit()
+        for conversation_id, version in versions.items():
+            message_cache.write_through(conversation_id, version, upserts=[message])
+        return message
+
+
+async def process_job(message: MessageModel, session: AsyncSession) -> None:
+    """
+    Generate and store the reply to a claimed message, or mark it failed.
+    """
+    try:
+        conversation = await session.get(Conversation, message.conversation_id)
+        context = await build_context(conversation, session, before_id=message.id)
+        response = await get_chatbot_response(message.content, context)
+    except Exception as e:
+        if not isinstance(e, HTTPException):
+            logger.exception("Unexpected error generating reply", extra={"message_id": message.id})
+        await session.rollback()
+        await set_message_status(message, "failed", session)
+        GENERATION_JOBS.inc(outcome="failed")
+        return
+
+    await create_reply(message, response, session)
+    GENERATION_JOBS.inc(outcome="complete")
+
+
+class GenerationQueue:
+    """
+    Pool of asyncio workers that consume queued messages. `notify` wakes an idle worker as soon
+    as a job is queued in this process; jobs queued elsewhere are picked up by polling.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], AsyncSession],
+        workers: int = JOB_WORKERS,
+        poll_interval: float = JOB_POLL_INTERVAL_SECONDS,
+    ):
+        self.session_factory = session_factory
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        # Message id -> one event per request waiting for its job
+        self._waiters: Dict[int, List[asyncio.Event]] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+
+    def start(self) -> None:
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = JOB_SHUTDOWN_SECONDS) -> None:
+        """
+        Let the workers finish the jobs they are running, then stop them. Jobs still running
+        after `timeout` seconds are cancelled and stay "pending" until their lease runs out,
+        when a worker claims them again.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._tasks:
+            _, running = await asyncio.wait(self._tasks, timeout=timeout)
+            for task in running:
+                task.cancel()
+        self._tasks = []
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    async def wait_for(
+        self,
+        message_id: int,
+        timeout: float,
+        finished: Optional[Callable[[], Awaitable[bool]]] = None
+    ) -> None:
+        """
+        Wait up to `timeout` seconds for a worker in this process to finish the job. `finished`
+        is checked once the wait is registered, so a job that completes just before is not
+        waited on.
+        """
+        event = asyncio.Event()
+        waiters = self._waiters.setdefault(message_id, [])
+        waiters.append(event)
+        try:
+            if finished is None or not await finished():
+                await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiters.remove(event)
+            if not waiters:
+                del self._waiters[message_id]
+
+    async def _work(self) -> None:
+        while not self._stopping:
+            # Cleared before looking for a job, so a notify that arrives meanwhile is not lost
+            self._wakeup.clear()
+            try:
+                async with self.session_factory() as session:
+                    message = await claim_job(session)
+                    if message is not None:
+                        GENERATION_JOBS_RUNNING.inc()
+                        try:
+                            with stage("generation_job"):
+                                await process_job(message, session)
+                        finally:
+                            GENERATION_JOBS_RUNNING.dec()
+            except Exception:
+                logger.exception("Unexpected error running generation job")
+                message = None
+
+            if message is not None:
+                for event in self._waiters.get(message.id, ()):
+                    event.set()
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def main() -> None:
+    from database import AsyncSessionLocal, dispose_engine, init_engine
+    from instrumentation import configure_logging
+    from llm_service import close_client
+
+    configure_logging()
+    init_engine()
+    queue = GenerationQueue(AsyncSessionLocal, workers=max(1, JOB_WORKERS))
+    queue.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await queue.stop()
+        await close_client()
+        await dispose_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
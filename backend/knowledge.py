@@ -0,0 +1,415 @@
+"""
+Knowledge base retrieval. Documents in KNOWLEDGE_DOCS_DIR are split into chunks, embedded
+and written to an index in KNOWLEDGE_INDEX_DIR, which the API memory-maps; llm_service sends
+the chunks closest to each prompt to the model along with it. Build or refresh the index with
+
+    python knowledge.py [docs_dir] [--index-dir DIR] [--embedder hashing|openai]
+
+Re-indexing is incremental: chunks whose text is unchanged keep their stored vectors, so only
+new and edited text is embedded. API processes load the index on first use; restart them to
+pick up a new one.
+
+Index files, all rows in the same order:
+
+    meta.json        embedder name, dimensions and counts, written last
+    embeddings.npy   float32 unit vectors, one row per chunk, grouped by list
+    centroids.npy    one unit vector per list
+    lists.npy        row at which each list starts, then the row count
+    chunks.jsonl     {"source", "text", "hash"} per chunk
+    offsets.npy      byte offset of each line of chunks.jsonl, then the file size
+
+Indexes under PARTITION_MIN_CHUNKS chunks are one list, searched exhaustively. Larger ones
+are split into about sqrt(n) lists by k-means, and a query only scores the rows of the
+KNOWLEDGE_NPROBE lists with the closest centroids, which keeps a search over a million
+chunks to a few milliseconds.
+"""
+from dotenv import load_dotenv
+load_dotenv()
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+from typing import TYPE_CHECKING, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+KNOWLEDGE_DOCS_DIR = os.getenv("KNOWLEDGE_DOCS_DIR", "knowledge")
+KNOWLEDGE_INDEX_DIR = os.getenv("KNOWLEDGE_INDEX_DIR", "knowledge_index")
+KNOWLEDGE_EMBEDDER = os.getenv("KNOWLEDGE_EMBEDDER", "hashing")
+# Lists scored per query; more finds more of the true nearest chunks but takes longer
+KNOWLEDGE_NPROBE = int(os.getenv("KNOWLEDGE_NPROBE", 16))
+CHUNK_WORDS = int(os.getenv("KNOWLEDGE_CHUNK_WORDS", 200))
+PARTITION_MIN_CHUNKS = 20_000
+DOCUMENT_SUFFIXES = (".md", ".txt")
+EMBED_BATCH_SIZE = 256
+# Rows copied or scored at a time while indexing, bounding memory use
+INDEX_BATCH_SIZE = 65_536
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+class Embedder:
+    """
+    Turns texts into unit vectors of `dimensions` float32s. An index can only be searched
+    with the embedder that built it, which is recorded by `name`.
+    """
+    name = "embedder"
+    dimensions = 0
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        raise NotImplementedError
+
+
+class HashingEmbedder(Embedder):
+    """
+    Deterministic local embedder: words and word pairs hashed into signed buckets. It needs no
+    model or network, so indexes can be built and searched offline, but it only matches on
+    shared vocabulary.
+    """
+
+    def __init__(self, dimensions: int = 384):
+        self.dimensions = dimensions
+        self.name = f"hashing-{dimensions}"
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = re.findall(r"\w+", text.lower())
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                bucket = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+                vectors[row, bucket % self.dimensions] += 1.0 if bucket >> 63 else -1.0
+        return normalize(vectors)
+
+
+class OpenAIEmbedder(Embedder):
+    """
+    The OpenAI embeddings API. `client` returns the AsyncOpenAI client to use.
+    """
+
+    def __init__(self, client: Callable[[], "AsyncOpenAI"], model: str = "text-embedding-3-small", dimensions: int = 512):
+        self.client = client
+        self.model = model
+        self.dimensions = dimensions
+        self.name = f"openai-{model}-{dimensions}"
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        response = await self.client().embeddings.create(model=self.model, input=list(texts), dimensions=self.dimensions)
+        return normalize(np.array([d.embedding for d in response.data], dtype=np.float32))
+
+
+def create_embedder(name: str, client: Optional[Callable[[], "AsyncOpenAI"]] = None) -> Embedder:
+    if name == "hashing":
+        return HashingEmbedder()
+    if name == "openai":
+        if client is None:
+            from openai import AsyncOpenAI
+            openai_client = AsyncOpenAI()
+            client = lambda: openai_client
+        return OpenAIEmbedder(client)
+    raise ValueError(f"Unknown embedder {name!r}")
+
+
+class Chunk(NamedTuple):
+    source: str
+    text: str
+
+    @property
+    def hash(self) -> str:
+        return hashlib.sha256(self.text.encode()).hexdigest()
+
+
+class SearchResult(NamedTuple):
+    score: float
+    source: str
+    text: str
+
+
+def split_document(text: str, max_words: int = CHUNK_WORDS) -> List[str]:
+    """
+    Split a document into chunks of whole paragraphs of at most `max_words` words. Longer
+    paragraphs are split between words.
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        words = paragraph.split()
+        if current and len(current) + len(words) > max_words:
+            chunks.append(" ".join(current))
+            current = []
+        while len(words) > max_words:
+            chunks.append(" ".join(words[:max_words]))
+            words = words[max_words:]
+        current.extend(words)
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def load_chunks(docs_dir: str) -> List[Chunk]:
+    chunks = []
+    for root, dirs, files in os.walk(docs_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(DOCUMENT_SUFFIXES):
+                path = os.path.join(root, name)
+                with open(path, encoding="utf-8") as f:
+                    text = f.read()
+                source = os.path.relpath(path, docs_dir)
+                chunks.extend(Chunk(source, chunk) for chunk in split_document(text))
+    return chunks
+
+
+def index_exists(index_dir: str) -> bool:
+    return os.path.exists(os.path.join(index_dir, "meta.json"))
+
+
+def _top_k(scores: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    if len(scores) > k:
+        best = np.argpartition(-scores, k)[:k]
+    else:
+        best = np.arange(len(scores))
+    best = best[np.argsort(-scores[best], kind="stable")]
+    return scores[best], rows[best]
+
+
+class VectorIndex:
+    """
+    A read-only index written by write_index. Embeddings and chunk text stay memory-mapped, so
+    opening an index is instant and its pages are shared by every worker process.
+    """
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        with open(self._path("meta.json")) as f:
+            meta = json.load(f)
+        self.embedder = meta["embedder"]
+        self.embeddings = np.load(self._path("embeddings.npy"), mmap_mode="r")
+        self.centroids = np.load(self._path("centroids.npy"))
+        self.lists = np.load(self._path("lists.npy"))
+        self._offsets = np.load(self._path("offsets.npy"), mmap_mode="r")
+        if len(self.embeddings) != meta["chunks"] or len(self.centroids) != meta["lists"]:
+            raise ValueError(f"Index in {index_dir} is incomplete; build it again")
+
+        self._chunks: Optional[mmap.mmap] = None
+        if len(self.embeddings):
+            with open(self._path("chunks.jsonl"), "rb") as f:
+                self._chunks = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.index_dir, name)
+
+    def __len__(self) -> int:
+        return len(self.embeddings)
+
+    def chunk(self, row: int) -> Dict[str, str]:
+        return json.loads(self._chunks[self._offsets[row]:self._offsets[row + 1]])
+
+    def search(self, queries: np.ndarray, k: int, nprobe: int = KNOWLEDGE_NPROBE) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Find the `k` rows closest to each of a batch of unit query vectors. Returns a
+        (scores, rows) pair per query, best first; scores are cosine similarities.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if not len(self):
+            return [(np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)) for _ in queries]
+
+        if len(self.centroids) == 1:
+            rows = np.arange(len(self))
+            return [_top_k(scores, rows, k) for scores in queries @ self.embeddings.T]
+
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+        results = []
+        for query, lists in zip(queries, probes):
+            rows = np.concatenate([np.arange(self.lists[l], self.lists[l + 1]) for l in lists])
+            vectors = np.concatenate([self.embeddings[self.lists[l]:self.lists[l + 1]] for l in lists])
+            results.append(_top_k(vectors @ query, rows, k))
+        return results
+
+
+class KnowledgeBase:
+    def __init__(self, index: VectorIndex, embedder: Embedder):
+        if index.embedder != embedder.name:
+            raise ValueError(f"Index was built with {index.embedder}, not {embedder.name}")
+        self.index = index
+        self.embedder = embedder
+
+    @classmethod
+    def open(cls, index_dir: str, embedder: Embedder) -> "KnowledgeBase":
+        return cls(VectorIndex(index_dir), embedder)
+
+    async def retrieve(self, texts: Sequence[str], k: int, min_score: float = 0.0) -> List[List[SearchResult]]:
+        """
+        The `k` chunks closest to each text, best first, leaving out those scoring below
+        `min_score`. All texts are embedded and searched as one batch.
+        """
+        results = []
+        for scores, rows in self.index.search(await self.embedder.embed(texts), k):
+            chunks = [self.index.chunk(int(row)) for row in rows]
+            results.append([
+                SearchResult(float(score), chunk["source"], chunk["text"])
+                for score, chunk in zip(scores, chunks)
+                if score >= min_score
+            ])
+        return results
+
+
+def list_count(chunks: int, partition_min_chunks: int = PARTITION_MIN_CHUNKS) -> int:
+    # A power of two, so that the lists (and their centroids) survive moderate growth
+    if chunks < partition_min_chunks:
+        return 1
+    return 2 ** round(math.log2(math.sqrt(chunks)))
+
+
+def train_centroids(vectors: np.ndarray, lists: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Spherical k-means over a sample of the vectors.
+    """
+    if not len(vectors):
+        return np.zeros((lists, vectors.shape[1]), dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    sample = vectors[np.sort(rng.choice(len(vectors), size=min(len(vectors), lists * 64), replace=False))]
+    centroids = sample[rng.choice(len(sample), size=lists, replace=len(sample) < lists)].copy()
+    for _ in range(iterations):
+        labels = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        # Lists left empty keep their previous centroid
+        centroids = normalize(np.where(np.bincount(labels, minlength=lists)[:, None] > 0, sums, centroids))
+    return centroids
+
+
+def _replace(index_dir: str, name: str) -> None:
+    os.replace(os.path.join(index_dir, _tmp_name(name)), os.path.join(index_dir, name))
+
+
+def _tmp_name(name: str) -> str:
+    stem, suffix = os.path.splitext(name)
+    return f"{stem}.tmp{suffix}"
+
+
+def write_index(
+    index_dir: str,
+    vectors: np.ndarray,
+    chunks: Sequence[Chunk],
+    embedder: str,
+    centroids: Optional[np.ndarray] = None,
+    partition_min_chunks: int = PARTITION_MIN_CHUNKS,
+) -> None:
+    """
+    Write an index of unit `vectors` (which may be memory-mapped) and their chunks, grouping
+    the rows by list. `centroids` from a previous build are reused when there should still be
+    as many lists, so the lists stay stable across incremental builds.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    path = lambda name: os.path.join(index_dir, _tmp_name(name))
+    lists = list_count(len(vectors), partition_min_chunks)
+    if centroids is None or len(centroids) != lists:
+        centroids = train_centroids(vectors, lists)
+
+    labels = np.zeros(len(vectors), dtype=np.int64)
+    if lists > 1:
+        for start in range(0, len(vectors), INDEX_BATCH_SIZE):
+            labels[start:start + INDEX_BATCH_SIZE] = np.argmax(vectors[start:start + INDEX_BATCH_SIZE] @ centroids.T, axis=1)
+    order = np.argsort(labels, kind="stable")
+
+    embeddings = np.lib.format.open_memmap(path("embeddings.npy"), mode="w+", dtype=np.float32, shape=vectors.shape)
+    for start in range(0, len(vectors), INDEX_BATCH_SIZE):
+        embeddings[start:start + INDEX_BATCH_SIZE] = vectors[order[start:start + INDEX_BATCH_SIZE]]
+    embeddings.flush()
+    del embeddings
+
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    with open(path("chunks.jsonl"), "wb") as f:
+        for i, row in enumerate(order):
+            chunk = chunks[row]
+            f.write(json.dumps({"source": chunk.source, "text": chunk.text, "hash": chunk.hash}).encode() + b"\n")
+            offsets[i + 1] = f.tell()
+
+    np.save(path("centroids.npy"), centroids)
+    np.save(path("lists.npy"), np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=lists))]))
+    np.save(path("offsets.npy"), offsets)
+    with open(path("meta.json"), "w") as f:
+        json.dump({"embedder": embedder, "dimensions": vectors.shape[1], "chunks": len(chunks), "lists": lists}, f)
+
+    for name in ("embeddings.npy", "chunks.jsonl", "centroids.npy", "lists.npy", "offsets.npy", "meta.json"):
+        _replace(index_dir, name)
+
+
+async def build_index(
+    docs_dir: str,
+    index_dir: str,
+    embedder: Embedder,
+    partition_min_chunks: int = PARTITION_MIN_CHUNKS,
+) -> Dict[str, int]:
+    """
+    Index the documents in `docs_dir` into `index_dir`, reusing the vectors of chunks the
+    existing index already holds. Returns how many chunks were reused and embedded.
+    """
+    chunks = load_chunks(docs_dir)
+    previous = VectorIndex(index_dir) if index_exists(index_dir) else None
+    if previous is not None and previous.embedder != embedder.name:
+        previous = None
+
+    known: Dict[str, int] = {}
+    if previous is not None:
+        for row in range(len(previous)):
+            known.setdefault(previous.chunk(row)["hash"], row)
+
+    reused = [(i, known[c.hash]) for i, c in enumerate(chunks) if c.hash in known]
+    missing = [i for i, c in enumerate(chunks) if c.hash not in known]
+
+    os.makedirs(index_dir, exist_ok=True)
+    unsorted_path = os.path.join(index_dir, "embeddings.unsorted.npy")
+    vectors = np.lib.format.open_memmap(unsorted_path, mode="w+", dtype=np.float32, shape=(len(chunks), embedder.dimensions))
+    try:
+        for start in range(0, len(reused), INDEX_BATCH_SIZE):
+            rows, previous_rows = zip(*reused[start:start + INDEX_BATCH_SIZE])
+            vectors[list(rows)] = previous.embeddings[list(previous_rows)]
+        for start in range(0, len(missing), EMBED_BATCH_SIZE):
+            rows = missing[start:start + EMBED_BATCH_SIZE]
+            vectors[rows] = await embedder.embed([chunks[i].text for i in rows])
+            logger.info("Embedded knowledge chunks", extra={"embedded": start + len(rows), "total": len(missing)})
+
+        write_index(
+            index_dir,
+            vectors,
+            chunks,
+            embedder.name,
+            centroids=previous.centroids if previous is not None else None,
+            partition_min_chunks=partition_min_chunks,
+        )
+    finally:
+        del vectors
+        os.remove(unsorted_path)
+    return {"chunks": len(chunks), "reused": len(reused), "embedded": len(missing)}
+
+
+def main() -> None:
+    from instrumentation import configure_logging
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("docs_dir", nargs="?", default=KNOWLEDGE_DOCS_DIR)
+    parser.add_argument("--index-dir", default=KNOWLEDGE_INDEX_DIR)
+    parser.add_argument("--embedder", default=KNOWLEDGE_EMBEDDER, choices=["hashing", "openai"])
+    args = parser.parse_args()
+
+    configure_logging()
+    counts = asyncio.run(build_index(args.docs_dir, args.index_dir, create_embedder(args.embedder)))
+    logger.info("Knowledge base indexed", extra=counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Chat completion providers. Each one implements LLMBackend; llm_router.LLMRouter picks the
+backend and model for every request.
+"""
+import asyncio
+import hashlib
+from typing import TYPE_CHECKING, AsyncGenerator, Callable, Dict, List, NamedTuple, Optional
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+
+class Completion(NamedTuple):
+    content: str
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+
+
+class LLMBackend:
+    """
+    A chat completion provider. Calls go through llm_scheduler.LLMScheduler, which retries the
+    errors it considers retryable, so providers should raise those for transient failures.
+    """
+    name = "llm"
+
+    async def complete(self, model: str, messages: List[Dict[str, str]]) -> Completion:
+        raise NotImplementedError
+
+    async def stream(self, model: str, messages: List[Dict[str, str]]) -> AsyncGenerator[str, None]:
+        """
+        Send the request and return an iterator over the reply's content tokens, so that
+        failing to reach the provider raises here rather than halfway through the reply.
+        Closing the iterator releases the upstream connection.
+        """
+        raise NotImplementedError
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    The OpenAI chat completions API. `client` returns the AsyncOpenAI client to use, which
+    lets it be created lazily and replaced in tests.
+    """
+    name = "openai"
+
+    def __init__(self, client: Callable[[], "AsyncOpenAI"]):
+        self.client = client
+
+    async def complete(self, model: str, messages: List[Dict[str, str]]) -> Completion:
+        completion = await self.client().chat.completions.create(model=model, messages=messages)
+        usage = getattr(completion, "usage", None)
+        return Completion(
+            completion.choices[0].message.content,
+            getattr(usage, "prompt_tokens", None),
+            getattr(usage, "completion_tokens", None),
+        )
+
+    async def stream(self, model: str, messages: List[Dict[str, str]]) -> AsyncGenerator[str, None]:
+        stream = await self.client().chat.completions.create(model=model, messages=messages, stream=True)
+        return _iter_deltas(stream)
+
+
+async def _iter_deltas(stream) -> AsyncGenerator[str, None]:
+    try:
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        await stream.close()
+
+
+class StubBackend(LLMBackend):
+    """
+    Deterministic in-process provider for offline tests, benchmarks and local development
+    (LLM_PROVIDER=stub). The reply depends only on the model and the messages, arrives after
+    `latency` seconds and is streamed word by word at `tokens_per_second`. Set `error` to make
+    every call raise it.
+    """
+    name = "stub"
+
+    def __init__(self, latency: float = 0.0, tokens_per_second: Optional[float] = None, error: Optional[Exception] = None):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error = error
+        self.calls = 0
+
+    @staticmethod
+    def reply(model: str, messages: List[Dict[str, str]]) -> str:
+        prompt = messages[-1]["content"] if messages else ""
+        digest = hashlib.sha256(repr((model, messages)).encode()).hexdigest()[:8]
+        return f"Stub reply {digest} from {model} to: {prompt}"
+
+    async def _respond(self, model: str, messages: List[Dict[str, str]]) -> str:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error is not None:
+            raise self.error
+        return self.reply(model, messages)
+
+    async def complete(self, model: str, messages: List[Dict[str, str]]) -> Completion:
+        content = await self._respond(model, messages)
+        prompt_words = sum(len(m["content"].split()) for m in messages)
+        return Completion(content, prompt_words, len(content.split()))
+
+    async def stream(self, model: str, messages: List[Dict[str, str]]) -> AsyncGenerator[str, None]:
+        content = await self._respond(model, messages)
+        return self._iter_words(content)
+
+    async def _iter_words(self, content: str) -> AsyncGenerator[str, None]:
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            if self.tokens_per_second:
+                await asyncio.sleep(1 / self.tokens_per_second)
+            yield word if i == len(words) - 1 else word + " "
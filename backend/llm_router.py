@@ -0,0 +1,139 @@
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, List, Optional, Tuple, TypeVar
+
+from llm_backends import LLMBackend
+from llm_scheduler import LLMUnavailableError, retryable_errors
+from metrics import Counter
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+LLM_ROUTED = Counter("llm_routed_total", "LLM requests by the backend and model that served them", labelnames=("backend", "model"))
+LLM_FAILOVERS = Counter("llm_failovers_total", "LLM requests retried on another route after a failure, by the backend of that route", labelnames=("backend",))
+
+
+class RouteStats:
+    """
+    Latencies and outcomes of a route's calls over the last `window_seconds`, capped at
+    `max_samples` calls. Old samples age out, so a route that was skipped while unhealthy
+    is tried again once its bad samples have expired.
+    """
+
+    def __init__(self, window_seconds: float = 60, max_samples: int = 200, clock: Callable[[], float] = time.monotonic):
+        self.window_seconds = window_seconds
+        self._clock = clock
+        self._samples: Deque[Tuple[float, float, bool]] = deque(maxlen=max_samples)
+
+    def record(self, seconds: float, ok: bool) -> None:
+        self._samples.append((self._clock(), seconds, ok))
+
+    def _recent(self) -> List[Tuple[float, float, bool]]:
+        cutoff = self._clock() - self.window_seconds
+        while self._samples and self._samples[0][0] < cutoff:
+            self._samples.popleft()
+        return list(self._samples)
+
+    def __len__(self) -> int:
+        return len(self._recent())
+
+    @property
+    def error_rate(self) -> float:
+        samples = self._recent()
+        return sum(1 for _, _, ok in samples if not ok) / len(samples) if samples else 0.0
+
+    @property
+    def p95(self) -> Optional[float]:
+        latencies = sorted(seconds for _, seconds, ok in self._recent() if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+
+class Route:
+    def __init__(self, backend: LLMBackend, model: str, stats: Optional[RouteStats] = None):
+        self.backend = backend
+        self.model = model
+        self.stats = stats if stats is not None else RouteStats()
+
+    def __repr__(self) -> str:
+        return f"Route(backend={self.backend.name!r}, model={self.model!r})"
+
+
+class LLMRouter:
+    """
+    Picks the backend and model for each request.
+
+    Prompts of at most `short_prompt_tokens` try the `fast` route first, everything else the
+    `primary` one, and each falls back on the other. A route is skipped in favour of a healthy
+    one while its rolling error rate is above `max_error_rate` or its p95 latency is above
+    `max_p95_seconds`; both only count once it has `min_samples` recent calls. When a call
+    fails with an error that another route may not hit (rate limits, timeouts, outages), the
+    request moves on to the next route; other errors, such as a rejected request or a bad API
+    key, are raised straight away. Models on the same backend are worth trying: providers rate
+    limit, and often fail, per model.
+    """
+
+    def __init__(
+        self,
+        primary: Route,
+        fast: Optional[Route] = None,
+        short_prompt_tokens: int = 32,
+        max_error_rate: float = 0.5,
+        max_p95_seconds: Optional[float] = None,
+        min_samples: int = 10,
+    ):
+        self.primary = primary
+        self.fast = fast
+        self.short_prompt_tokens = short_prompt_tokens
+        self.max_error_rate = max_error_rate
+        self.max_p95_seconds = max_p95_seconds
+        self.min_samples = min_samples
+
+    def healthy(self, route: Route) -> bool:
+        if len(route.stats) < self.min_samples:
+            return True
+        if route.stats.error_rate > self.max_error_rate:
+            return False
+        p95 = route.stats.p95
+        return self.max_p95_seconds is None or p95 is None or p95 <= self.max_p95_seconds
+
+    def routes(self, prompt_tokens: int) -> List[Route]:
+        """
+        The routes to try for a prompt, in order: preferred ones first, unhealthy ones last.
+        """
+        if self.fast is None:
+            preferred = [self.primary]
+        elif prompt_tokens <= self.short_prompt_tokens:
+            preferred = [self.fast, self.primary]
+        else:
+            preferred = [self.primary, self.fast]
+        return [r for r in preferred if self.healthy(r)] + [r for r in preferred if not self.healthy(r)]
+
+    async def run(self, prompt_tokens: int, call: Callable[[Route, bool], Awaitable[T]]) -> Tuple[Route, T]:
+        """
+        Await `call(route, last)` with the first route for the prompt, failing over to the next
+        route if it raises a retryable error. `last` tells `call` whether it is the last route
+        to try: only that one is worth retrying, since earlier ones have somewhere to fail over
+        to. Returns the route that answered and its result.
+        """
+        routes = self.routes(prompt_tokens)
+        error: Optional[Exception] = None
+        for i, route in enumerate(routes):
+            if error is not None:
+                LLM_FAILOVERS.inc(backend=route.backend.name)
+                logger.warning("Failing over to another LLM route", extra={"backend": route.backend.name, "model": route.model, "error": repr(error)})
+
+            start = time.perf_counter()
+            try:
+                result = await call(route, i == len(routes) - 1)
+            except (LLMUnavailableError, *retryable_errors()) as e:
+                route.stats.record(time.perf_counter() - start, ok=False)
+                error = e
+                continue
+            route.stats.record(time.perf_counter() - start, ok=True)
+            LLM_ROUTED.inc(backend=route.backend.name, model=route.model)
+            return route, result
+        raise error
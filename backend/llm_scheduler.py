@@ -0,0 +1,272 @@
+import asyncio
+import functools
+import logging
+import random
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, Optional, Tuple, Type, TypeVar
+
+from metrics import Counter, Gauge, Histogram
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+LLM_CALLS = Counter("llm_calls_total", "Upstream LLM call attempts by outcome", labelnames=("outcome",))
+LLM_COALESCED = Counter("llm_coalesced_total", "Requests that shared an identical in-flight LLM call")
+LLM_IN_FLIGHT = Gauge("llm_calls_in_flight", "LLM calls currently holding a concurrency slot")
+LLM_QUEUE_WAIT = Histogram("llm_queue_wait_seconds", "Time spent waiting for a concurrency slot and token budget")
+
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors() -> Tuple[Type[BaseException], ...]:
+    """
+    Errors worth retrying: rate limits, timeouts, dropped connections and 5xx responses.
+    Only evaluated once a call has failed, so openai is not imported at startup.
+    """
+    import openai
+
+    return (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+        asyncio.TimeoutError,
+    )
+
+
+class LLMUnavailableError(Exception):
+    """
+    Raised when an LLM call still fails after every retry. `retry_after` is a hint, in seconds,
+    for when the client may try again.
+    """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBudget:
+    """
+    Token bucket holding at most `tokens_per_minute` tokens, refilled continuously.
+    Only ever touched from the event loop, so it needs no lock.
+    """
+
+    def __init__(self, tokens_per_minute: int, clock: Callable[[], float] = time.monotonic):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self._tokens = float(tokens_per_minute)
+        self._clock = clock
+        self._updated_at = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def try_acquire(self, tokens: int) -> float:
+        """
+        Take `tokens` if available and return 0, otherwise return the seconds to wait before retrying.
+        """
+        tokens = min(tokens, self.capacity)
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: int) -> None:
+        while (wait := self.try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+
+class LLMScheduler:
+    """
+    Runs upstream LLM calls with bounded concurrency, a tokens-per-minute budget, per-attempt
+    timeouts and jittered exponential backoff that honours Retry-After.
+
+    Calls given the same `key` while one is already in flight share its result instead of making
+    a second upstream request. The shared call runs in its own task, so it completes for the
+    remaining waiters even if the request that started it is cancelled.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 16,
+        tokens_per_minute: Optional[int] = None,
+        max_retries: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 20,
+        timeout: float = 60,
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._budget = TokenBudget(tokens_per_minute) if tokens_per_minute else None
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+
+    async def run(
+        self,
+        call: Callable[[], Awaitable[T]],
+        key: Optional[Hashable] = None,
+        tokens: int = 0,
+        max_retries: Optional[int] = None
+    ) -> T:
+        """
+        Run `call` under the scheduler's limits. `tokens` is the estimated token cost charged
+        against the per-minute budget; `max_retries` overrides the scheduler's.
+        """
+        if key is None:
+            return await self._run_with_retries(call, tokens, max_retries)
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            LLM_COALESCED.inc()
+        else:
+            task = asyncio.create_task(self._run_with_retries(call, tokens, max_retries))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    async def stream(
+        self,
+        open_stream: Callable[[], Awaitable[AsyncIterator[T]]],
+        tokens: int = 0,
+        max_retries: Optional[int] = None
+    ) -> "SlotStream[T]":
+        """
+        Open a stream with `open_stream` under the scheduler's limits and return an iterator over
+        it. Opening the stream is retried and timed out like `run`; the concurrency slot is then
+        held until the iterator is exhausted or closed, since the generation upstream lasts as
+        long as the stream. Streams are never coalesced.
+        """
+        stream = await self._run_with_retries(open_stream, tokens, max_retries, keep_slot=True)
+        return SlotStream(stream, self._release_slot)
+
+    def _release_slot(self) -> None:
+        LLM_IN_FLIGHT.dec()
+        self._semaphore.release()
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Mark the exception as retrieved in case every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    async def _run_with_retries(
+        self,
+        call: Callable[[], Awaitable[T]],
+        tokens: int,
+        max_retries: Optional[int] = None,
+        keep_slot: bool = False
+    ) -> T:
+        max_retries = self.max_retries if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            try:
+                return await self._attempt(call, tokens, keep_slot)
+            except retryable_errors() as e:
+                retry_after = _retry_after(e)
+                if attempt >= max_retries:
+                    LLM_CALLS.inc(outcome="gave_up")
+                    raise LLMUnavailableError(f"LLM call failed after {attempt + 1} attempts: {e}", retry_after) from e
+
+                delay = self.backoff(attempt, retry_after)
+                logger.warning("LLM call failed, retrying", extra={"error": e.__class__.__name__, "attempt": attempt + 1, "delay": round(delay, 3)})
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _attempt(self, call: Callable[[], Awaitable[T]], tokens: int, keep_slot: bool = False) -> T:
+        """
+        Make one call holding a concurrency slot. With `keep_slot`, a successful call leaves the
+        slot held for the caller to release with _release_slot.
+        """
+        start = time.perf_counter()
+        if self._budget is not None and tokens:
+            await self._budget.acquire(tokens)
+        await self._semaphore.acquire()
+        LLM_QUEUE_WAIT.observe(time.perf_counter() - start)
+
+        LLM_IN_FLIGHT.inc()
+        succeeded = False
+        try:
+            result = await asyncio.wait_for(call(), self.timeout)
+            succeeded = True
+        except retryable_errors():
+            LLM_CALLS.inc(outcome="retryable_error")
+            raise
+        except Exception:
+            LLM_CALLS.inc(outcome="error")
+            raise
+        finally:
+            if not (succeeded and keep_slot):
+                self._release_slot()
+
+        LLM_CALLS.inc(outcome="success")
+        return result
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Full-jitter exponential backoff, never shorter than the server's Retry-After.
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class SlotStream(AsyncIterator[T]):
+    """
+    Iterator over an upstream stream that gives back its concurrency slot once the stream is
+    exhausted, fails or is closed. A stream dropped without being closed gives it back when
+    garbage collected.
+    """
+
+    def __init__(self, stream: AsyncIterator[T], release: Callable[[], None]):
+        self._stream = stream
+        self._release: Optional[Callable[[], None]] = release
+
+    async def __anext__(self) -> T:
+        try:
+            return await self._stream.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self) -> None:
+        if self._release is None:
+            return
+        release, self._release = self._release, None
+        try:
+            aclose = getattr(self._stream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        finally:
+            release()
+
+    def __del__(self) -> None:
+        if self._release is not None:
+            self._release()
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+
+    retry_after_ms = response.headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = response.headers.get("retry-after")
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            return None
+    return None
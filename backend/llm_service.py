@@ -1,25 +1,413 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional, Tuple
 from fastapi import HTTPException
-from openai import AsyncOpenAI
-client = AsyncOpenAI()
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-async def get_chatbot_response(prompt: str):
+from instrumentation import LLM_TIME_TO_FIRST_TOKEN, record_stage, record_tokens, stage
+from llm_backends import Completion, LLMBackend, OpenAIBackend, StubBackend
+from llm_router import LLMRouter, Route
+from llm_scheduler import LLMScheduler, LLMUnavailableError, SlotStream
+from message_cache import message_cache
+from models import Conversation, MessageModel
+from response_cache import InProcessResponseCacheBackend, ResponseCache
 
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from knowledge import KnowledgeBase
+
+try:
+    import tiktoken
+except ImportError: # Optional, token counts fall back to an estimate
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", 60))
+
+def get_client() -> "AsyncOpenAI":
+    """
+    The OpenAI client, created on the first LLM call so that every worker process gets its
+    own connection pool and startup never waits for the SDK to import. Also available as
+    `llm_service.client`.
+    """
+    global client
+    if "client" not in globals():
+        from openai import AsyncOpenAI
+        # Retries are handled by the scheduler, so the SDK's own are turned off
+        client = AsyncOpenAI(max_retries=0, timeout=LLM_TIMEOUT_SECONDS)
+    return client
+
+async def close_client() -> None:
+    created = globals().pop("client", None)
+    if created is not None:
+        await created.close()
+
+def __getattr__(name: str):
+    if name == "client":
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+scheduler = LLMScheduler(
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 16)),
+    tokens_per_minute=int(os.getenv("LLM_TOKENS_PER_MINUTE", 0)) or None,
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", 4)),
+    timeout=LLM_TIMEOUT_SECONDS,
+)
+
+MODEL = "gpt-4o"
+# Cheaper, faster model that answers short prompts; empty sends everything to MODEL
+FAST_MODEL = os.getenv("LLM_FAST_MODEL", "gpt-4o-mini")
+SYSTEM_PROMPT = "You are a chatbot. Please be concise when you answer any questions the user asks you, but find a way to compliment the company 'Artisan' within your response."
+
+# Tokens of conversation history (summary plus recent turns) sent with each prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+# Most recent turns loaded from the database when building the context
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", 50))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+# Knowledge base chunks sent with each prompt (see knowledge.py), once an index has been built
+KNOWLEDGE_TOP_K = int(os.getenv("KNOWLEDGE_TOP_K", 3))
+KNOWLEDGE_MIN_SCORE = float(os.getenv("KNOWLEDGE_MIN_SCORE", 0.2))
+KNOWLEDGE_PROMPT = "Facts about Artisan from its knowledge base. Base anything you say about Artisan on these and do not make up others:"
+SUMMARY_PROMPT = "Update the running summary of this conversation with the new turns. Keep every fact, name and decision the user may refer back to, and stay under 200 words."
+
+def create_router() -> LLMRouter:
+    """
+    Route requests between MODEL and FAST_MODEL on the provider named by LLM_PROVIDER:
+    "openai" (the default) or "stub", a deterministic offline provider.
+    """
+    backend: LLMBackend = StubBackend() if os.getenv("LLM_PROVIDER") == "stub" else OpenAIBackend(get_client)
+    max_p95 = float(os.getenv("LLM_MAX_P95_SECONDS", 0)) or None
+    return LLMRouter(
+        primary=Route(backend, MODEL),
+        fast=Route(backend, FAST_MODEL) if FAST_MODEL and FAST_MODEL != MODEL else None,
+        short_prompt_tokens=int(os.getenv("LLM_SHORT_PROMPT_TOKENS", 32)),
+        max_error_rate=float(os.getenv("LLM_MAX_ERROR_RATE", 0.5)),
+        max_p95_seconds=max_p95,
+    )
+
+router = create_router()
+
+def get_knowledge_base() -> Optional["KnowledgeBase"]:
+    """
+    The knowledge base in KNOWLEDGE_INDEX_DIR, memory-mapped on first use, or None if no index
+    has been built.
+    """
+    global knowledge_base
+    if "knowledge_base" not in globals():
+        from knowledge import KNOWLEDGE_EMBEDDER, KNOWLEDGE_INDEX_DIR, KnowledgeBase, create_embedder, index_exists
+        knowledge_base = None
+        if index_exists(KNOWLEDGE_INDEX_DIR):
+            knowledge_base = KnowledgeBase.open(KNOWLEDGE_INDEX_DIR, create_embedder(KNOWLEDGE_EMBEDDER, get_client))
+    return knowledge_base
+
+# Opt-in cache of replies to identical first-turn prompts. Replace the backend with a shared one
+# to let every worker process serve each other's hits.
+response_cache: Optional[ResponseCache] = None
+if os.getenv("LLM_RESPONSE_CACHE") == "true":
+    cache_ttl = float(os.getenv("LLM_RESPONSE_CACHE_TTL", 3600))
+    response_cache = ResponseCache(
+        InProcessResponseCacheBackend(maxsize=int(os.getenv("LLM_RESPONSE_CACHE_SIZE", 1024)), ttl=cache_ttl),
+        ttl=cache_ttl
+    )
+
+# Rough per-message overhead of the chat format
+MESSAGE_TOKEN_OVERHEAD = 4
+# Completion tokens charged against the per-minute budget before the real count is known
+COMPLETION_TOKEN_ESTIMATE = int(os.getenv("COMPLETION_TOKEN_ESTIMATE", 256))
+ROLES = {"user": "user", "chatbot": "assistant"}
+
+_encoding = None
+
+def count_tokens(text: str) -> int:
+    """
+    Count tokens with tiktoken when it is installed, otherwise estimate about four characters per token.
+    """
+    global _encoding
+    if tiktoken is not None and _encoding is None:
+        try:
+            _encoding = tiktoken.encoding_for_model(MODEL)
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
+
+def count_message_tokens(message: Dict[str, str]) -> int:
+    return count_tokens(message["content"]) + MESSAGE_TOKEN_OVERHEAD
+
+def estimate_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(count_message_tokens(m) for m in messages) + COMPLETION_TOKEN_ESTIMATE
+
+def request_key(model: str, messages: List[Dict[str, str]]) -> str:
+    return hashlib.sha256(json.dumps([model, messages]).encode()).hexdigest()
+
+def llm_error(e: Exception) -> HTTPException:
+    """
+    Map a failed LLM call to the HTTP error returned to the client.
+    """
+    if isinstance(e, LLMUnavailableError):
+        retry_after = max(1, round(e.retry_after or 1))
+        return HTTPException(
+            status_code=503,
+            detail="The chatbot is busy right now. Please try again shortly.",
+            headers={"Retry-After": str(retry_after)}
+        )
+    return HTTPException(
+        status_code=500,
+        detail="An unexpected error occurred. Please try again later."
+    )
+
+def build_messages(
+    prompt: str,
+    context: Optional[List[Dict[str, str]]] = None,
+    snippets: Optional[List[str]] = None
+) -> List[Dict[str, str]]:
+    knowledge = [{"role": "system", "content": "\n\n".join([KNOWLEDGE_PROMPT, *snippets])}] if snippets else []
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        *knowledge,
+        *(context or []),
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ]
+
+async def build_context(conversation: Conversation, session: AsyncSession, before_id: Optional[int] = None) -> List[Dict[str, str]]:
+    """
+    Assemble the history sent with the next prompt of a conversation.
+
+    The newest turns are packed into CONTEXT_TOKEN_BUDGET. Once they no longer fit, the oldest
+    ones are folded into the conversation's rolling summary until the rest fit in half the budget,
+    so the summary is only regenerated every few turns rather than on every request. The summary
+    is stored on the conversation and only ever extended with turns it has not seen yet.
+    `before_id` limits the history to messages older than it, for prompts that are already stored.
+    """
+    with stage("db_history"):
+        rows = await _history_rows(conversation, session, before_id)
+    # Ends the transaction so no pooled connection is held while summarizing or generating the reply
+    await session.commit()
+    turns = [{"role": ROLES.get(m.author, "user"), "content": m.content} for m in rows]
+
+    if sum(count_message_tokens(t) for t in turns) > _history_budget(conversation):
+        kept_tokens = 0
+        split = len(turns)
+        while split > 0 and kept_tokens + count_message_tokens(turns[split - 1]) <= CONTEXT_TOKEN_BUDGET // 2:
+            kept_tokens += count_message_tokens(turns[split - 1])
+            split -= 1
+
+        if split > 0:
+            try:
+                conversation.summary = await summarize(conversation.summary, turns[:split])
+                conversation.summary_through_id = rows[split - 1].id
+                session.add(conversation)
+                await session.commit()
+                turns = turns[split:]
+            except HTTPException:
+                # Answer without the new summary rather than failing the request
+                pass
+
+    # Drop whatever still does not fit, e.g. a single turn larger than the budget
+    while turns and sum(count_message_tokens(t) for t in turns) > _history_budget(conversation):
+        turns.pop(0)
+
+    if conversation.summary:
+        return [_summary_message(conversation)] + turns
+    return turns
+
+async def _history_rows(conversation: Conversation, session: AsyncSession, before_id: Optional[int]) -> list:
+    """
+    The newest CONTEXT_MAX_TURNS usable messages after the summary, oldest first. Served from
+    the conversation cache when its window holds enough of them, otherwise queried.
+    """
+    entry = await message_cache.recent(conversation.id, conversation.version, session)
+    rows = [
+        m for m in entry.messages
+        if m.status != "failed"
+        and (conversation.summary_through_id is None or m.id > conversation.summary_through_id)
+        and (before_id is None or m.id < before_id)
+    ]
+    # The window follows the history order (created_at, id), which matches id order except for
+    # messages imported with an earlier created_at
+    if entry.complete or len(rows) >= CONTEXT_MAX_TURNS:
+        return sorted(rows, key=lambda m: m.id)[-CONTEXT_MAX_TURNS:]
+
+    statement = (
+        select(MessageModel)
+        .where(
+            MessageModel.conversation_id == conversation.id,
+            MessageModel.deleted_at.is_(None),
+            MessageModel.status != "failed"
+        )
+        .order_by(MessageModel.id.desc())
+        .limit(CONTEXT_MAX_TURNS)
+    )
+    if conversation.summary_through_id is not None:
+        statement = statement.where(MessageModel.id > conversation.summary_through_id)
+    if before_id is not None:
+        statement = statement.where(MessageModel.id < before_id)
+    return list(reversed((await session.scalars(statement)).all()))
+
+def _summary_message(conversation: Conversation) -> Dict[str, str]:
+    return {"role": "system", "content": f"Summary of the earlier conversation: {conversation.summary}"}
+
+def _history_budget(conversation: Conversation) -> int:
+    if conversation.summary:
+        return CONTEXT_TOKEN_BUDGET - count_message_tokens(_summary_message(conversation))
+    return CONTEXT_TOKEN_BUDGET
+
+async def summarize(summary: Optional[str], turns: List[Dict[str, str]]) -> str:
+    """
+    Fold turns into an existing summary with the cheaper summary model.
+    """
+    transcript = "\n".join(f"{t['role']}: {t['content']}" for t in turns)
+    messages = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": f"Current summary: {summary or '(none)'}\n\nNew turns:\n{transcript}"}
+    ]
+    backend = router.primary.backend
     try:
-        completion = await client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are a chatbot. Please be concise when you answer any questions the user asks you, but find a way to compliment the company 'Artisan' within your response."},
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
+        with stage("llm_summary", model=SUMMARY_MODEL):
+            completion = await scheduler.run(
+                lambda: backend.complete(SUMMARY_MODEL, messages),
+                tokens=estimate_tokens(messages)
+            )
+        record_tokens(SUMMARY_MODEL, completion.prompt_tokens, completion.completion_tokens)
+        return completion.content
+    except Exception as e:
+        logger.warning("Error occurred when summarizing conversation", extra={"error": repr(e)})
+        raise llm_error(e)
+
+async def retrieve_snippets(prompt: str) -> Optional[List[str]]:
+    """
+    The knowledge base chunks closest to the prompt. Best effort: if retrieval fails the
+    prompt is answered without them, and None is returned so the reply is not cached.
+    """
+    try:
+        knowledge_base = get_knowledge_base()
+        if knowledge_base is None or KNOWLEDGE_TOP_K <= 0:
+            return []
+        with stage("retrieval"):
+            results = await knowledge_base.retrieve([prompt], KNOWLEDGE_TOP_K, KNOWLEDGE_MIN_SCORE)
+    except Exception as e:
+        logger.warning("Error occurred when retrieving knowledge", extra={"error": repr(e)})
+        return None
+    return [r.text for r in results[0]]
+
+def _use_cache(context: Optional[List[Dict[str, str]]], snippets: Optional[List[str]]) -> bool:
+    # The cache key does not cover history, so only replies to context-free prompts are cached,
+    # and neither are replies written without the knowledge base because retrieval failed
+    return response_cache is not None and not context and snippets is not None
+
+def _cache_system_prompt(snippets: List[str]) -> str:
+    # Replies depend on the snippets they were grounded in, so a rebuilt index does not
+    # serve answers written from the old one
+    return "\n\n".join([SYSTEM_PROMPT, *snippets])
+
+def _cached_model(prompt_tokens: int) -> str:
+    # Replies are cached under the model that wrote them, so a lookup asks for the one the
+    # router would try first
+    return router.routes(prompt_tokens)[0].model
+
+async def get_chatbot_response(prompt: str, context: Optional[List[Dict[str, str]]] = None):
+    prompt_tokens = count_tokens(prompt)
+    snippets = await retrieve_snippets(prompt)
+    use_cache = _use_cache(context, snippets)
+    if use_cache:
+        cached = await response_cache.get(prompt, _cache_system_prompt(snippets), _cached_model(prompt_tokens))
+        if cached is not None:
+            return cached
+
+    messages = build_messages(prompt, context, snippets)
+
+    async def complete(route: Route, last: bool) -> Completion:
+        # Identical requests already in flight share a single upstream call
+        with stage("llm_completion", model=route.model):
+            return await scheduler.run(
+                lambda: route.backend.complete(route.model, messages),
+                key=request_key(route.model, messages),
+                tokens=estimate_tokens(messages),
+                max_retries=None if last else 0
+            )
+
+    try:
+        route, completion = await router.run(prompt_tokens, complete)
+        response = completion.content
+    except Exception as e:
+        logger.error("Error occurred when querying the LLM", extra={"error": repr(e)})
+        raise llm_error(e)
+
+    record_tokens(route.model, completion.prompt_tokens, completion.completion_tokens)
+
+    if use_cache:
+        await response_cache.set(prompt, _cache_system_prompt(snippets), route.model, response)
+    return response
+
+async def stream_chatbot_response(prompt: str, context: Optional[List[Dict[str, str]]] = None) -> AsyncIterator[str]:
+    """
+    Start a streamed completion and return an iterator over its content tokens.
+
+    The request is sent before returning, so failures to reach the LLM surface here as an
+    HTTPException rather than halfway through the stream.
+    """
+    prompt_tokens = count_tokens(prompt)
+    snippets = await retrieve_snippets(prompt)
+    use_cache = _use_cache(context, snippets)
+    if use_cache:
+        cached = await response_cache.get(prompt, _cache_system_prompt(snippets), _cached_model(prompt_tokens))
+        if cached is not None:
+            return _iter_cached(cached)
+
+    messages = build_messages(prompt, context, snippets)
+    start = time.perf_counter()
+
+    async def open_stream(route: Route, last: bool) -> SlotStream[str]:
+        # Holds a concurrency slot until the stream is closed
+        return await scheduler.stream(
+            lambda: route.backend.stream(route.model, messages),
+            tokens=estimate_tokens(messages),
+            max_retries=None if last else 0
         )
 
-        return completion.choices[0].message.content
+    try:
+        route, stream = await router.run(prompt_tokens, open_stream)
     except Exception as e:
-        print(f"Error occurred when querying openai: {e}")
-        raise HTTPException(
-            status_code=500,
-            detail="An unexpected error occurred. Please try again later."
-        )
\ No newline at end of file
+        logger.error("Error occurred when querying the LLM", extra={"error": repr(e)})
+        raise llm_error(e)
+
+    # Streamed chunks carry no usage, so prompt tokens are counted locally
+    record_tokens(route.model, sum(count_message_tokens(m) for m in messages), None)
+    cache_key = (prompt, _cache_system_prompt(snippets)) if use_cache else None
+    return _iter_tokens(stream, route.model, cache_key, start)
+
+async def _iter_cached(response: str) -> AsyncIterator[str]:
+    yield response
+
+async def _iter_tokens(
+    stream: SlotStream[str],
+    model: str = MODEL,
+    cache_key: Optional[Tuple[str, str]] = None,
+    start: Optional[float] = None
+) -> AsyncIterator[str]:
+    start = time.perf_counter() if start is None else start
+    parts: List[str] = []
+    try:
+        async for token in stream:
+            if not parts:
+                LLM_TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - start, model=model)
+            parts.append(token)
+            yield token
+
+        # Only complete replies are cached, never ones cut short by a disconnect
+        if cache_key is not None:
+            await response_cache.set(*cache_key, model, "".join(parts))
+    finally:
+        record_stage("llm_stream", time.perf_counter() - start)
+        record_tokens(model, None, count_tokens("".join(parts)) if parts else 0)
+        # Releases the upstream connection when the client goes away mid-stream
+        await stream.aclose()
@@ -0,0 +1,300 @@
+"""
+Load test and latency benchmark for the chatbot API.
+
+Runs the real ASGI app under uvicorn against local stand-ins: a token verifier with a local
+secret instead of Supabase, FakeOpenAI served over HTTP instead of OpenAI, and SQLite (or a
+local Postgres via --database-url) instead of the production database. It then drives
+concurrent POST /message, PUT /message/{id} and DELETE /message/{id} traffic and reports
+p50/p95/p99 latency, throughput and server event-loop lag as JSON.
+
+    python loadtest.py --concurrency 50 --requests 2000 --llm-latency 0.5 --output results.json
+    python loadtest.py --baseline results.json   # exits non-zero if p95 regressed
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+import uvicorn
+from jose import jwt
+from openai import AsyncOpenAI
+
+from fake_openai import FakeOpenAI
+
+JWT_SECRET = "loadtest-secret"
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of values, 0 for an empty list.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = math.ceil(pct / 100 * len(ordered))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+def summarize_latencies(latencies: List[float], errors: int, elapsed: float) -> Dict[str, float]:
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies, default=0) * 1000, 2),
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """
+    Return a description of every endpoint whose p95 latency regressed by more than max_regression.
+    """
+    regressions = []
+    for endpoint, stats in results["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(endpoint)
+        if not previous or not previous["p95_ms"]:
+            continue
+        change = stats["p95_ms"] / previous["p95_ms"] - 1
+        if change > max_regression:
+            regressions.append(f"{endpoint}: p95 {previous['p95_ms']}ms -> {stats['p95_ms']}ms (+{change:.0%})")
+    return regressions
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ServerThread:
+    """
+    Runs an ASGI app under uvicorn on its own event loop in a background thread.
+    """
+
+    def __init__(self, app, port: int, loop: str = "asyncio"):
+        self.port = port
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, loop=loop, log_level="warning", lifespan="off"))
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        if self.server.config.loop == "uvloop":
+            import uvloop
+            self.loop = uvloop.new_event_loop()
+        else:
+            self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.server.serve())
+
+    def start(self) -> "ServerThread":
+        self.thread.start()
+        while not self.server.started:
+            if not self.thread.is_alive():
+                raise RuntimeError(f"Server on port {self.port} failed to start")
+            time.sleep(0.01)
+        return self
+
+    def stop(self) -> None:
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+class LoopLagMonitor:
+    """
+    Measures how late a periodic timer fires on the server's event loop.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._running = True
+
+    async def run(self) -> None:
+        while self._running:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def stop(self) -> None:
+        self._running = False
+
+
+async def drive_load(base_url: str, token: str, concurrency: int, requests: int) -> Dict[str, Any]:
+    """
+    Run `requests` exchanges over `concurrency` workers. Each exchange posts a message, edits it
+    and deletes the reply.
+    """
+    latencies: Dict[str, List[float]] = {"POST /message": [], "PUT /message/{id}": [], "DELETE /message/{id}": []}
+    errors: Dict[str, int] = {endpoint: 0 for endpoint in latencies}
+    headers = {"Authorization": f"Bearer {token}"}
+    remaining = iter(range(requests))
+
+    async def timed(endpoint: str, call) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await call
+        except httpx.HTTPError:
+            errors[endpoint] += 1
+            return None
+        if response.status_code >= 400:
+            errors[endpoint] += 1
+            return None
+        latencies[endpoint].append(time.perf_counter() - start)
+        return response
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        for i in remaining:
+            response = await timed("POST /message", client.post("/message", json={"message": f"Load test message {i}"}, headers=headers))
+            if response is None:
+                continue
+            user_message, reply = response.json()["exchange"]
+            await timed("PUT /message/{id}", client.put(f"/message/{user_message['id']}", json={"message": f"Edited {i}"}, headers=headers))
+            await timed("DELETE /message/{id}", client.delete(f"/message/{reply['id']}", headers=headers))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    total = sum(len(values) for values in latencies.values())
+    return {
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2),
+        "endpoints": {endpoint: summarize_latencies(values, errors[endpoint], elapsed) for endpoint, values in latencies.items()},
+    }
+
+
+def run_load_test(
+    concurrency: int = 10,
+    requests: int = 200,
+    llm_latency: float = 0.2,
+    llm_tokens_per_second: Optional[float] = None,
+    database_url: Optional[str] = None,
+    loop: str = "asyncio",
+) -> Dict[str, Any]:
+    """
+    Start the stand-ins and the app, run the load and return the results.
+    """
+    workdir = tempfile.TemporaryDirectory()
+    database_url = database_url or f"sqlite+aiosqlite:///{os.path.join(workdir.name, 'loadtest.db')}"
+
+    # main reads its configuration at import time; none of it is used against the stand-ins
+    os.environ.setdefault("DATABASE_URL", database_url)
+    os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:54321")
+    os.environ.setdefault("SUPABASE_KEY", jwt.encode({"role": "anon"}, JWT_SECRET, algorithm="HS256"))
+    os.environ.setdefault("OPENAI_API_KEY", "loadtest")
+    # Per-request info logs would otherwise flood the results
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+    from sqlalchemy.orm import sessionmaker
+
+    import llm_service
+    import main
+    from auth import TokenVerifier
+    from database import get_session
+    from models import Base
+
+    engine = create_async_engine(database_url)
+    session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def get_loadtest_session():
+        async with session_factory() as session:
+            yield session
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        await engine.dispose()
+
+    asyncio.run(create_tables())
+
+    fake_openai = FakeOpenAI(latency=llm_latency, tokens_per_second=llm_tokens_per_second)
+    openai_server = ServerThread(fake_openai.app, free_port()).start()
+
+    original_verifier, original_client = main.verifier, llm_service.client
+    main.verifier = TokenVerifier(jwt_secret=JWT_SECRET)
+    llm_service.client = AsyncOpenAI(api_key="loadtest", base_url=f"http://127.0.0.1:{openai_server.port}/v1", max_retries=0)
+    main.app.dependency_overrides[get_session] = get_loadtest_session
+
+    app_server = ServerThread(main.app, free_port(), loop=loop).start()
+    lag_monitor = LoopLagMonitor()
+    lag_future = asyncio.run_coroutine_threadsafe(lag_monitor.run(), app_server.loop)
+
+    try:
+        token = jwt.encode({"sub": "loadtest_user", "aud": "authenticated", "exp": int(time.time()) + 3600}, JWT_SECRET, algorithm="HS256")
+        results = asyncio.run(drive_load(f"http://127.0.0.1:{app_server.port}", token, concurrency, requests))
+    finally:
+        lag_monitor.stop()
+        lag_future.result(timeout=5)
+        app_server.stop()
+        openai_server.stop()
+        main.verifier, llm_service.client = original_verifier, original_client
+        main.app.dependency_overrides.pop(get_session, None)
+        workdir.cleanup()
+
+    results["event_loop_lag"] = {
+        "p50_ms": round(percentile(lag_monitor.samples, 50) * 1000, 2),
+        "p99_ms": round(percentile(lag_monitor.samples, 99) * 1000, 2),
+        "max_ms": round(max(lag_monitor.samples, default=0) * 1000, 2),
+        "mean_ms": round(statistics.fmean(lag_monitor.samples) * 1000, 2) if lag_monitor.samples else 0.0,
+    }
+    results["config"] = {
+        "concurrency": concurrency,
+        "requests": requests,
+        "llm_latency": llm_latency,
+        "llm_tokens_per_second": llm_tokens_per_second,
+        "database": database_url.split(":", 1)[0],
+        "loop": loop,
+    }
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=200, help="exchanges to run (each is a POST, PUT and DELETE)")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds the fake OpenAI takes per completion")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=None, help="fake OpenAI streaming rate")
+    parser.add_argument("--database-url", default=None, help="defaults to a temporary SQLite database")
+    parser.add_argument("--loop", default="asyncio", choices=["asyncio", "uvloop"])
+    parser.add_argument("--output", default="loadtest-results.json")
+    parser.add_argument("--baseline", default=None, help="results file to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed p95 increase over the baseline")
+    args = parser.parse_args()
+
+    results = run_load_test(
+        concurrency=args.concurrency,
+        requests=args.requests,
+        llm_latency=args.llm_latency,
+        llm_tokens_per_second=args.llm_tokens_per_second,
+        database_url=args.database_url,
+        loop=args.loop,
+    )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
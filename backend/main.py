@@ -1,28 +1,115 @@
 from dotenv import load_dotenv
 load_dotenv()
 from jose import JWTError
-import uvicorn
+import anyio
+import asyncio
+import json
+import logging
 import os
-from typing import Dict, List
-from fastapi import Depends, FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager, suppress
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.ext.asyncio import AsyncSession
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-from contracts import MessageExchange, PostMessage, MessageContract
-from database import get_session
-from crud_message import create_messages, update_message, delete_message
-from llm_service import get_chatbot_response
+from auth import TokenVerifier, get_current_user_id
+from instrumentation import configure_logging, stage
+from backup import ImportLineTooLong, export_messages, import_ndjson
+from contracts import BatchResult, ImportResult, MessageBatch, MessageExchange, MessagePage, PostMessage, MessageContract
+from idempotency import idempotency_store, request_hash
+from models import MessageModel
+from compaction import COMPACTION_INTERVAL_SECONDS, run_compaction
+from jobs import JOB_WORKERS, GenerationQueue
+from database import AsyncSessionLocal, dispose_engine, get_session, init_engine
+import metrics
+from crud_conversation import get_conversation, get_or_create_conversation
+from crud_message import apply_batch, create_messages, create_reply, get_messages_page, get_reply, get_user_message, set_message_status, update_message, delete_message
+from llm_service import build_context, build_messages, close_client, estimate_tokens, get_chatbot_response, get_knowledge_base, stream_chatbot_response
+from search import search_messages
+from rate_limit import InProcessRateLimitBackend, RateLimiter, RateLimitExceeded, RedisRateLimitBackend
 
-from supabase import create_client, Client
+configure_logging()
+logger = logging.getLogger(__name__)
 
 url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(url, key)
 
-app = FastAPI()
+# Tokens are verified locally; set SUPABASE_AUTH_REMOTE_CHECK=true to also ask Supabase
+# whether the session has been revoked. The Supabase client that does so is created at startup.
+verifier = TokenVerifier(
+    jwt_secret=os.environ.get("SUPABASE_JWT_SECRET"),
+    jwks_url=f"{url}/auth/v1/.well-known/jwks.json",
+    cache_ttl=float(os.environ.get("AUTH_CACHE_TTL_SECONDS", 300)),
+)
+
+def create_auth_client():
+    """
+    Client for the Supabase auth API, the only part of Supabase the backend talks to. Built
+    from gotrue directly so the rest of the supabase package (realtime, storage, postgrest,
+    functions) is never imported.
+    """
+    from gotrue import SyncGoTrueClient
+
+    return SyncGoTrueClient(
+        url=f"{url}/auth/v1",
+        headers={"apiKey": key, "Authorization": f"Bearer {key}"},
+        auto_refresh_token=False,
+        persist_session=False,
+    )
+
+def create_rate_limiter() -> RateLimiter:
+    """
+    Per-user limits, off unless configured. Set RATE_LIMIT_REDIS_URL to share the buckets
+    between worker processes (needs the redis package).
+    """
+    redis_url = os.environ.get("RATE_LIMIT_REDIS_URL")
+    if redis_url:
+        import redis.asyncio
+        backend = RedisRateLimitBackend(redis.asyncio.from_url(redis_url))
+    else:
+        backend = InProcessRateLimitBackend()
+    return RateLimiter(
+        backend,
+        requests_per_second=float(os.environ.get("RATE_LIMIT_REQUESTS_PER_SECOND", 0)) or None,
+        burst=float(os.environ.get("RATE_LIMIT_BURST", 0)) or None,
+        tokens_per_day=float(os.environ.get("LLM_TOKENS_PER_DAY", 0)) or None,
+    )
+
+rate_limiter = create_rate_limiter()
+
+# Generates the replies to messages posted to /message/async
+generation_queue = GenerationQueue(AsyncSessionLocal, workers=JOB_WORKERS)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Clients are created here or on first use rather than at import, so each worker process
+    # opens its own connections and importing the app (e.g. in the launcher) connects to nothing.
+    # The OpenAI client is left to the first LLM call.
+    init_engine()
+    if os.environ.get("SUPABASE_AUTH_REMOTE_CHECK") == "true":
+        verifier.remote_verify = create_auth_client().get_user
+    # Maps the knowledge base index now so the first request does not wait for it
+    get_knowledge_base()
+
+    # Purges soft-deleted and expired messages in the background
+    compaction = asyncio.create_task(run_compaction(AsyncSessionLocal)) if COMPACTION_INTERVAL_SECONDS > 0 else None
+    generation_queue.start()
+    yield
+    # Runs once the server has drained in-flight requests
+    await generation_queue.stop()
+    if compaction is not None:
+        compaction.cancel()
+        # Lets a batch in progress roll back before its connection is closed
+        with suppress(asyncio.CancelledError):
+            await compaction
+    await close_client()
+    await dispose_engine()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 origins = [
     "http://localhost:5173",
@@ -42,40 +129,104 @@ cors_headers = {
     "Access-Control-Allow-Headers": "*",
 }
 
-class AuthMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
+# Most items accepted by POST /messages/batch in one request
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS", 1000))
+
+# Paths served without a user token. /metrics is guarded by METRICS_TOKEN instead.
+PUBLIC_PATHS = {"/metrics"}
+
+class AuthMiddleware:
+    """
+    Pure ASGI authentication middleware. Unlike BaseHTTPMiddleware it does not wrap the
+    request and response in extra tasks and memory streams, so streaming responses pass
+    straight through. Websockets authenticate in their route.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
 
-        # Skip cors preflight requests
-        if request.method == "OPTIONS":
-            return await call_next(request)
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+
+        # Skip non-http connections, cors preflight requests and metrics scrapes
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or scope["path"] in PUBLIC_PATHS:
+            return await self.app(scope, receive, send)
 
         try:
-            token = request.headers.get("Authorization")
+            token = Headers(scope=scope).get("Authorization")
             if token:
                 token = token.split(" ")[-1]  # Remove "Bearer" part
                 try:
-                    request.state.user = supabase.auth.get_user(token)
+                    # Read back by request.state.user
+                    with stage("auth"):
+                        scope.setdefault("state", {})["user"] = await verifier.verify(token)
                 except JWTError:
                     raise HTTPException(status_code=401, detail="Invalid token")
             else:
                 raise HTTPException(status_code=401, detail="Authorization token missing")
-            
-            response = await call_next(request)
-            return response
-    
+
         except HTTPException as e:
-            return JSONResponse(
+            response = JSONResponse(
                 status_code=e.status_code,
                 content={"detail": e.detail},
                 headers=cors_headers,
             )
+            return await response(scope, receive, send)
         except Exception as e:
-            return JSONResponse(
-                status_code=500,
-                content={"detail": "Internal Server Error"},
-                headers=cors_headers,
+            logger.exception("Unexpected error authenticating request")
+            return await internal_error_response(scope, receive, send)
+
+        response_started = False
+
+        async def send_wrapper(message: Message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            if response_started:
+                raise
+            logger.exception("Unhandled error", extra={"path": scope["path"]})
+            await internal_error_response(scope, receive, send)
+
+async def internal_error_response(scope: Scope, receive: Receive, send: Send):
+    response = JSONResponse(
+        status_code=500,
+        content={"detail": "Internal Server Error"},
+        headers=cors_headers,
+    )
+    await response(scope, receive, send)
+
+# Requests that call the LLM, and so count against the daily token quota
+LLM_ROUTES = {("POST", "/message"), ("POST", "/message/stream"), ("POST", "/message/async")}
+
+class RateLimitMiddleware:
+    """
+    Rejects requests from users over their rate limits with a 429, before any database or LLM
+    work starts. Runs inside AuthMiddleware, which identifies the user.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        user = scope.get("state", {}).get("user") if scope["type"] == "http" else None
+        if user is None or not rate_limiter.enabled:
+            return await self.app(scope, receive, send)
+
+        try:
+            await rate_limiter.check(user["sub"], uses_llm=(scope["method"], scope["path"]) in LLM_ROUTES)
+        except RateLimitExceeded as e:
+            response = JSONResponse(
+                status_code=429,
+                content={"detail": "Too many requests. Please slow down."},
+                headers={**cors_headers, "Retry-After": e.retry_after_header},
             )
-        
+            return await response(scope, receive, send)
+        await self.app(scope, receive, send)
+
+# Added first so it runs after (inside) AuthMiddleware
+app.add_middleware(RateLimitMiddleware)
 app.add_middleware(AuthMiddleware)
 
 @app.exception_handler(ConnectionError)
@@ -85,32 +236,407 @@ async def database_exception_handler(request, exc):
         content={"error": "Internal Service Error"}
     )
 
-@app.post("/message")
-async def post_message(body: PostMessage, session: AsyncSession = Depends(get_session)) -> MessageExchange:
+@app.get("/metrics")
+async def get_metrics(request: Request) -> PlainTextResponse:
+    """
+    Prometheus scrape endpoint. When METRICS_TOKEN is set, scrapers must send it as a bearer token.
+    """
+    metrics_token = os.environ.get("METRICS_TOKEN")
+    if metrics_token and request.headers.get("Authorization") != f"Bearer {metrics_token}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+async def charge_llm_tokens(user_id: str, prompt: str, context: List[Dict[str, str]]) -> None:
+    # Charged at the scheduler's estimate, before the reply's real length is known
+    await rate_limiter.charge_tokens(user_id, estimate_tokens(build_messages(prompt, context)))
+
+# Hot paths build their JSON straight from the rows and return it as the response, which
+# also stops FastAPI from validating it again against the response model.
+@app.post("/message", response_model=MessageExchange)
+async def post_message(
+    body: PostMessage,
+    idempotency_key: Optional[str] = Header(default=None),
+    session: AsyncSession = Depends(get_session),
+    user_id: str = Depends(get_current_user_id)
+) -> ORJSONResponse:
+    """
+    Send a message and get the chatbot's reply. Requests carrying an `Idempotency-Key` header
+    are answered once: repeats with the same key get the first response, marked with an
+    `Idempotent-Replayed: true` header, rather than another exchange.
+    """
     if not body.message.strip():
         raise HTTPException(status_code=400, detail="Message cannot be empty")
-    
-    llm_response = await get_chatbot_response(body.message)
-            
-    messages: List[Dict[str, str]] = [
-        {"author": "user", "content": body.message},
-        {"author": "chatbot", "content": llm_response}
-    ]
-    messages = await create_messages(messages, session)
-    return  MessageExchange.from_models(messages)
-
-@app.put("/message/{message_id}")
-async def put_message(message_id: int, body: PostMessage, session: AsyncSession = Depends(get_session)) -> MessageContract:
+
+    if idempotency_key is None:
+        return ORJSONResponse(await create_exchange(body, user_id, session))
+    response, replayed = await idempotency_store.run(
+        user_id,
+        idempotency_key,
+        request_hash("POST /message", body.model_dump()),
+        session,
+        lambda: create_exchange(body, user_id, session)
+    )
+    return ORJSONResponse(response, headers={"Idempotent-Replayed": "true"} if replayed else None)
+
+async def create_exchange(body: PostMessage, user_id: str, session: AsyncSession) -> Dict[str, Any]:
+    conversation = await get_or_create_conversation(body.conversation_id, user_id, session)
+    context = await build_context(conversation, session) if body.conversation_id is not None else []
+    await charge_llm_tokens(user_id, body.message, context)
+
+    # The user message is written while the reply is generated, so the write adds no latency
+    # and the message is kept even if generation fails
+    user_message_write = asyncio.create_task(create_user_message(body.message, conversation.id, user_id, session))
+    generation = asyncio.create_task(get_chatbot_response(body.message, context))
+    try:
+        await asyncio.wait({user_message_write, generation}, return_when=asyncio.FIRST_EXCEPTION)
+        if user_message_write.done() and user_message_write.exception() is not None:
+            raise user_message_write.exception()
+
+        user_message = await user_message_write
+        try:
+            llm_response = await generation
+        except HTTPException:
+            await set_message_status(user_message, "failed", session)
+            raise
+
+        reply = await create_reply(user_message, llm_response, session)
+        return MessageExchange.dump_models((user_message, reply))
+    finally:
+        for task in (user_message_write, generation):
+            task.cancel()
+
+async def create_user_message(
+    content: str,
+    conversation_id: int,
+    user_id: str,
+    session: AsyncSession,
+    status: str = "pending"
+) -> MessageModel:
+    messages = await create_messages([
+        {"author": "user", "content": content, "conversation_id": conversation_id, "user_id": user_id, "status": status}
+    ], session)
+    return messages[0]
+
+@app.post("/message/async", status_code=202)
+async def post_message_async(
+    body: PostMessage,
+    response: Response,
+    session: AsyncSession = Depends(get_session),
+    user_id: str = Depends(get_current_user_id)
+) -> MessageContract:
+    """
+    Queue the message for a background worker and return it straight away, with status "queued".
+    Fetch the reply from GET /message/{id}/reply.
+    """
+    if not body.message.strip():
+        raise HTTPException(status_code=400, detail="Message cannot be empty")
+
+    conversation = await get_or_create_conversation(body.conversation_id, user_id, session)
+    # The context is built by the worker, so only the prompt is charged here
+    await charge_llm_tokens(user_id, body.message, [])
+    user_message = await create_user_message(body.message, conversation.id, user_id, session, status="queued")
+    generation_queue.notify()
+
+    response.headers["Location"] = f"/message/{user_message.id}/reply"
+    return MessageContract.from_model(user_message)
+
+@app.get("/message/{message_id}/reply")
+async def get_message_reply(
+    message_id: int,
+    response: Response,
+    wait: float = Query(default=0, ge=0, le=25),
+    session: AsyncSession = Depends(get_session),
+    user_id: str = Depends(get_current_user_id)
+) -> MessageContract:
+    """
+    Return the chatbot's reply to a message. While it is still being generated, respond 202 with
+    the message itself; pass `wait` to long-poll for up to that many seconds first.
+    """
+    user_message = await get_user_message(message_id, user_id, session)
+    if user_message.status in ("queued", "pending") and wait:
+        async def finished() -> bool:
+            # Checked again once the wait is registered, in case the job finished meanwhile
+            await session.refresh(user_message)
+            # Release the connection while waiting
+            await session.commit()
+            return user_message.status not in ("queued", "pending")
+
+        await generation_queue.wait_for(message_id, wait, finished)
+        await session.refresh(user_message)
+
+    if user_message.status in ("queued", "pending"):
+        response.status_code = 202
+        response.headers["Retry-After"] = "1"
+        return MessageContract.from_model(user_message)
+
+    reply = await get_reply(user_message, session)
+    if user_message.status == "failed" or reply is None:
+        raise HTTPException(
+            status_code=500,
+            detail="The reply could not be generated. Please try again later."
+        )
+    return MessageContract.from_model(reply)
+
+async def stream_exchange(
+    prompt: str,
+    tokens: AsyncIterator[str],
+    conversation_id: int,
+    user_id: str,
+    session: AsyncSession
+) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Yield ("token", text) events as the chatbot reply is generated, then a ("done", MessageExchange)
+    event. The user message is written as soon as the stream starts and the reply once it completes,
+    fails or is cancelled; an interrupted reply keeps whatever was generated so far and marks the
+    exchange failed.
+    """
+    user_message_write = asyncio.create_task(create_user_message(prompt, conversation_id, user_id, session))
+    parts: List[str] = []
+    status = "failed"
+    try:
+        async for token in tokens:
+            parts.append(token)
+            yield "token", token
+        status = "complete"
+    finally:
+        # Shielded so the rows are still written when the client disconnects mid-stream
+        with anyio.CancelScope(shield=True):
+            await tokens.aclose()
+            user_message = await user_message_write
+            reply = await create_reply(user_message, "".join(parts), session, status=status)
+
+    yield "done", MessageExchange.from_models((user_message, reply))
+
+def sse_event(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+async def sse_exchange(events: AsyncIterator[Tuple[str, Any]]) -> AsyncIterator[str]:
+    try:
+        async for event, payload in events:
+            if event == "token":
+                yield sse_event("token", json.dumps({"token": payload}))
+            else:
+                yield sse_event("done", payload.model_dump_json())
+    except HTTPException as e:
+        yield sse_event("error", json.dumps({"detail": e.detail}))
+    except Exception as e:
+        logger.exception("Unexpected error streaming message")
+        yield sse_event("error", json.dumps({"detail": "An unexpected error occurred. Please try again later."}))
+    finally:
+        with anyio.CancelScope(shield=True):
+            await events.aclose()
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that always closes its body iterator, so the generator's cleanup
+    runs as soon as the client disconnects instead of whenever it is garbage collected.
+    """
+    async def stream_response(self, send) -> None:
+        try:
+            await super().stream_response(send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self.body_iterator.aclose()
+
+@app.post("/message/stream")
+async def post_message_stream(
+    body: PostMessage,
+    session: AsyncSession = Depends(get_session),
+    user_id: str = Depends(get_current_user_id)
+) -> StreamingResponse:
+    """
+    Stream the chatbot reply as Server-Sent Events: a `token` event per chunk, then a `done`
+    event carrying the persisted MessageExchange (or an `error` event).
+    """
+    if not body.message.strip():
+        raise HTTPException(status_code=400, detail="Message cannot be empty")
+
+    conversation = await get_or_create_conversation(body.conversation_id, user_id, session)
+    context = await build_context(conversation, session) if body.conversation_id is not None else []
+    await charge_llm_tokens(user_id, body.message, context)
+    tokens = await stream_chatbot_response(body.message, context)
+    return ClosingStreamingResponse(
+        sse_exchange(stream_exchange(body.message, tokens, conversation.id, user_id, session)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.websocket("/message/ws")
+async def message_websocket(websocket: WebSocket, token: str = "", session: AsyncSession = Depends(get_session)):
+    """
+    WebSocket variant of /message/stream. Browsers cannot set headers on websockets, so the
+    access token is passed as the `token` query parameter. Each `{"message": ...}` sent by the
+    client is answered with `token` frames followed by a `done` (or `error`) frame.
+    """
+    try:
+        with stage("auth"):
+            websocket.state.user = await verifier.verify(token)
+        user_id = websocket.state.user["sub"]
+    except JWTError:
+        await websocket.close(code=1008, reason="Invalid token")
+        return
+
+    await websocket.accept()
+    try:
+        while True:
+            try:
+                body = PostMessage.model_validate(await websocket.receive_json())
+            except ValueError:
+                await websocket.send_json({"type": "error", "detail": "Invalid message"})
+                continue
+
+            if not body.message.strip():
+                await websocket.send_json({"type": "error", "detail": "Message cannot be empty"})
+                continue
+
+            try:
+                await rate_limiter.check(user_id, uses_llm=True)
+            except RateLimitExceeded as e:
+                await websocket.send_json({"type": "error", "detail": "Too many requests. Please slow down.", "retry_after": int(e.retry_after_header)})
+                continue
+
+            events = None
+            # The session lives as long as the socket; forgetting what earlier turns loaded makes
+            # this one read the conversation (and its version) as it is now
+            session.expunge_all()
+            try:
+                conversation = await get_or_create_conversation(body.conversation_id, user_id, session)
+                context = await build_context(conversation, session) if body.conversation_id is not None else []
+                await charge_llm_tokens(user_id, body.message, context)
+                tokens = await stream_chatbot_response(body.message, context)
+                events = stream_exchange(body.message, tokens, conversation.id, user_id, session)
+                async for event, payload in events:
+                    if event == "token":
+                        await websocket.send_json({"type": "token", "token": payload})
+                    else:
+                        await websocket.send_json({"type": "done", **payload.model_dump()})
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "detail": e.detail})
+            finally:
+                if events is not None:
+                    with anyio.CancelScope(shield=True):
+                        await events.aclose()
+    except WebSocketDisconnect:
+        pass
+
+@app.get("/conversations/{conversation_id}/messages", response_model=MessagePage)
+async def get_conversation_messages(
+    conversation_id: int,
+    cursor: Optional[str] = None,
+    limit: int = Query(default=50, ge=1, le=200),
+    session: AsyncSession = Depends(get_session),
+    user_id: str = Depends(get_current_user_id)
+) -> ORJSONResponse:
+    """
+    Page through a conversation's messages, newest first. Pass `next_cursor` from the
+    previous page as `cursor` to continue further back.
+    """
+    conversation = await get_conversation(conversation_id, user_id, session)
+    messages, next_cursor = await get_messages_page(conversation_id, session, limit=limit, cursor=cursor, version=conversation.version)
+    return ORJSONResponse(MessagePage.dump_models(messages, next_cursor))
+
+@app.get("/search", response_model=MessagePage)
+async def search_user_messages(
+    q: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(default=20, ge=1, le=100),
+    session: AsyncSession = Depends(get_session),
+    user_id: str = Depends(get_current_user_id)
+) -> ORJSONResponse:
+    """
+    Search the user's messages across all their conversations, best match first. Pass
+    `next_cursor` from the previous page as `cursor` to fetch more results.
+    """
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Search query cannot be empty")
+
+    messages, next_cursor = await search_messages(q, user_id, session, limit=limit, cursor=cursor)
+    return ORJSONResponse(MessagePage.dump_models(messages, next_cursor))
+
+@app.get("/export")
+async def export_user_messages(
+    conversation_id: Optional[int] = None,
+    session: AsyncSession = Depends(get_session),
+    user_id: str = Depends(get_current_user_id)
+) -> StreamingResponse:
+    """
+    Stream the user's messages, or one conversation's, as NDJSON, oldest first.
+    """
+    if conversation_id is not None:
+        await get_conversation(conversation_id, user_id, session)
+    return ClosingStreamingResponse(
+        export_messages(user_id, session, conversation_id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="messages.ndjson"'},
+    )
+
+@app.post("/import")
+async def import_user_messages(
+    request: Request,
+    session: AsyncSession = Depends(get_session),
+    user_id: str = Depends(get_current_user_id)
+) -> ImportResult:
+    """
+    Import an NDJSON request body in the /export format into new conversations, in batches
+    committed as the body is read.
+    """
+    try:
+        return ImportResult.model_validate(await import_ndjson(request.stream(), user_id, session))
+
+    except ImportLineTooLong as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    except Exception as e:
+        logger.exception("Unexpected error importing messages")
+        raise HTTPException(
+            status_code=500,
+            detail="An unexpected error occurred. Please try again later."
+        )
+
+@app.put("/message/{message_id}", response_model=MessageContract)
+async def put_message(
+    message_id: int,
+    body: PostMessage,
+    session: AsyncSession = Depends(get_session),
+    user_id: str = Depends(get_current_user_id)
+) -> ORJSONResponse:
     if not body.message.strip():
         raise HTTPException(status_code=400, detail="Message cannot be empty")
     
-    updated_message = await update_message(message_id, body.message, session)
-    return MessageContract.from_model(updated_message)
+    updated_message = await update_message(message_id, body.message, user_id, session)
+    return ORJSONResponse(MessageContract.dump_model(updated_message))
 
 @app.delete("/message/{message_id}")
-async def remove_message(message_id: int, session: AsyncSession = Depends(get_session)) -> bool:
-    is_deleted = await delete_message(message_id, session)
+async def remove_message(
+    message_id: int,
+    session: AsyncSession = Depends(get_session),
+    user_id: str = Depends(get_current_user_id)
+) -> bool:
+    is_deleted = await delete_message(message_id, user_id, session)
     return is_deleted
 
+@app.post("/messages/batch")
+async def post_messages_batch(
+    body: MessageBatch,
+    session: AsyncSession = Depends(get_session),
+    user_id: str = Depends(get_current_user_id)
+) -> BatchResult:
+    """
+    Edit, delete and import many of the user's messages in one transaction. Each item gets
+    its own result; items that are empty or not found are skipped without failing the batch.
+    """
+    if len(body.edits) + len(body.deletes) + len(body.imports) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"A batch can contain at most {MAX_BATCH_ITEMS} items")
+
+    results = await apply_batch(
+        [{"id": e.id, "content": e.message} for e in body.edits],
+        body.deletes,
+        [{"author": m.author, "content": m.message, "conversation_id": m.conversation_id, "created_at": m.created_at} for m in body.imports],
+        user_id,
+        session
+    )
+    return BatchResult.model_validate(results)
+
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="127.0.0.1", port=8000)
@@ -0,0 +1,151 @@
+import os
+from datetime import datetime
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import TTLCache
+from metrics import Counter, Gauge
+from models import MessageModel
+
+# Conversations kept in memory, least recently used evicted first
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", 1000))
+# Newest messages kept per conversation; covers the first history page and the prompt context
+CONVERSATION_CACHE_WINDOW = int(os.getenv("CONVERSATION_CACHE_WINDOW", 200))
+CONVERSATION_CACHE_TTL = float(os.getenv("CONVERSATION_CACHE_TTL", 3600))
+
+CACHE_REQUESTS = Counter(
+    "conversation_cache_requests_total",
+    "Conversation message cache lookups by result",
+    labelnames=("result",),
+)
+
+
+class CachedMessage(NamedTuple):
+    """
+    Immutable copy of a message row, safe to share between requests. Has the attributes the
+    read paths use from MessageModel.
+    """
+    id: int
+    conversation_id: int
+    author: str
+    content: str
+    status: str
+    created_at: datetime
+
+    @classmethod
+    def from_model(cls, message: MessageModel) -> "CachedMessage":
+        return cls(message.id, message.conversation_id, message.author, message.content, message.status, message.created_at)
+
+    @property
+    def sort_key(self) -> Tuple[datetime, int]:
+        return message_sort_key(self.created_at, self.id)
+
+
+class CachedConversation(NamedTuple):
+    version: int
+    messages: Tuple[CachedMessage, ...] # Live messages, newest first
+    complete: bool # True when `messages` holds every live message of the conversation
+
+
+def message_sort_key(created_at: datetime, message_id: int) -> Tuple[datetime, int]:
+    # SQLite hands back naive datetimes; compare everything as naive UTC
+    return (created_at.replace(tzinfo=None), message_id)
+
+
+class ConversationCache:
+    """
+    Per-conversation LRU cache of the newest live messages.
+
+    Entries are tagged with the conversation's `version`, which every write to its messages
+    increments in the same transaction. Readers pass the version they loaded with the
+    conversation row, so an entry made stale by a write in another worker is never served.
+    Writes in this worker update the entry in place (write-through) when it was current just
+    before the write, and drop it otherwise.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = CONVERSATION_CACHE_SIZE,
+        window: int = CONVERSATION_CACHE_WINDOW,
+        ttl: float = CONVERSATION_CACHE_TTL,
+    ):
+        self.window = window
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, conversation_id: int, version: int) -> Optional[CachedConversation]:
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            CACHE_REQUESTS.inc(result="miss")
+            return None
+        if entry.version != version:
+            CACHE_REQUESTS.inc(result="stale")
+            return None
+        CACHE_REQUESTS.inc(result="hit")
+        return entry
+
+    async def recent(self, conversation_id: int, version: int, session: AsyncSession) -> CachedConversation:
+        """
+        Return the newest messages of the conversation at `version`, loading them on a miss.
+        """
+        entry = self.get(conversation_id, version)
+        if entry is not None:
+            return entry
+
+        statement = (
+            select(MessageModel)
+            .where(MessageModel.conversation_id == conversation_id, MessageModel.deleted_at.is_(None))
+            .order_by(MessageModel.created_at.desc(), MessageModel.id.desc())
+            .limit(self.window + 1)
+        )
+        rows = (await session.scalars(statement)).all()
+        # Tagged with the version read before the rows, so the rows are never older than the tag
+        entry = CachedConversation(
+            version=version,
+            messages=tuple(CachedMessage.from_model(m) for m in rows[:self.window]),
+            complete=len(rows) <= self.window,
+        )
+        self._entries.set(conversation_id, entry)
+        return entry
+
+    def write_through(
+        self,
+        conversation_id: int,
+        version: int,
+        upserts: Iterable[MessageModel] = (),
+        removed_ids: Iterable[int] = (),
+    ) -> None:
+        """
+        Apply a committed write that moved the conversation to `version`. Only an entry that
+        was at the previous version can be brought up to date; any other is dropped. Writes
+        that skip this (bulk edits, imports, compaction) still bump the version, which is
+        enough to stop their conversations' entries from being served.
+        """
+        entry = self._entries.pop(conversation_id)
+        if entry is None or entry.version != version - 1:
+            return
+
+        changed = {m.id: CachedMessage.from_model(m) for m in upserts}
+        removed = set(removed_ids) | changed.keys()
+        messages: List[CachedMessage] = [m for m in entry.messages if m.id not in removed]
+        oldest = entry.messages[-1].sort_key if entry.messages else None
+        for message in changed.values():
+            # Outside the window of an incomplete entry there is nothing to update
+            if entry.complete or oldest is None or message.sort_key >= oldest:
+                messages.append(message)
+        messages.sort(key=lambda m: m.sort_key, reverse=True)
+
+        complete = entry.complete and len(messages) <= self.window
+        self._entries.set(conversation_id, CachedConversation(version, tuple(messages[:self.window]), complete))
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+message_cache = ConversationCache()
+
+Gauge("conversation_cache_entries", "Conversations held in the message cache", callback=lambda: len(message_cache))
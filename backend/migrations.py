@@ -0,0 +1,159 @@
+"""
+Schema migrations. A database without a message table gets the whole schema from the models
+and is recorded as up to date. An existing one, starting from the original bare `message`
+table, is brought up to date by the numbered migrations it has not had yet, in order, in one
+transaction. Applied migrations are recorded in the schema_migration table. Run before new
+code serves traffic (the Procfile's release phase does this on every deploy):
+
+    python migrations.py
+
+Each migration checks what already exists, so it is safe on a database that has part of the
+change already.
+
+Messages stored before accounts existed have no owner. Set LEGACY_MESSAGES_USER_ID to the user
+id that should own them; the first migration refuses to run while such messages exist and it
+is unset.
+"""
+from dotenv import load_dotenv
+load_dotenv()
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, Connection, DateTime, MetaData, String, Table, func, insert, inspect, select, text, update
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.schema import CreateColumn
+
+from models import SEARCH_DDL, Base, Conversation, IdempotencyKey, MessageModel
+
+logger = logging.getLogger(__name__)
+
+LEGACY_MESSAGES_USER_ID = os.getenv("LEGACY_MESSAGES_USER_ID")
+# Held for the migration's transaction so that concurrent runs apply each migration once
+MIGRATION_LOCK_ID = 7_461_203
+
+schema_migration = Table(
+    "schema_migration",
+    MetaData(),
+    Column("name", String, primary_key=True),
+    Column("applied_at", DateTime(timezone=True), nullable=False),
+)
+
+
+def add_column(conn: Connection, column: Column) -> None:
+    """
+    Add a model's column to its table unless the table already has it.
+    """
+    table = column.table
+    if column.name in {c["name"] for c in inspect(conn).get_columns(table.name)}:
+        return
+    ddl = str(CreateColumn(column).compile(dialect=conn.dialect))
+    for fk in column.foreign_keys:
+        ddl += f" REFERENCES {fk.column.table.name} ({fk.column.name})"
+        if fk.ondelete:
+            ddl += f" ON DELETE {fk.ondelete}"
+    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+
+
+def create_indexes(conn: Connection, table: Table) -> None:
+    for index in table.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def add_conversations(conn: Connection) -> None:
+    """
+    Conversations, message ownership and status, background jobs, replies and idempotency keys.
+    Messages without an owner are given LEGACY_MESSAGES_USER_ID, and each user's messages
+    without a conversation are gathered into a new one.
+    """
+    Conversation.__table__.create(conn, checkfirst=True)
+    IdempotencyKey.__table__.create(conn, checkfirst=True)
+    message = MessageModel.__table__
+    for column in (message.c.conversation_id, message.c.user_id, message.c.status, message.c.claimed_at, message.c.reply_to_id):
+        add_column(conn, column)
+
+    ownerless = conn.scalar(select(func.count()).select_from(message).where(message.c.user_id.is_(None)))
+    if ownerless:
+        if not LEGACY_MESSAGES_USER_ID:
+            raise RuntimeError(
+                f"{ownerless} messages predate accounts and have no owner; "
+                "set LEGACY_MESSAGES_USER_ID to the user id that should own them"
+            )
+        conn.execute(update(message).where(message.c.user_id.is_(None)).values(user_id=LEGACY_MESSAGES_USER_ID))
+
+    user_ids = conn.scalars(select(message.c.user_id).where(message.c.conversation_id.is_(None)).distinct()).all()
+    for user_id in user_ids:
+        conversation_id = conn.scalar(insert(Conversation.__table__).values(user_id=user_id).returning(Conversation.__table__.c.id))
+        conn.execute(
+            update(message)
+            .where(message.c.user_id == user_id, message.c.conversation_id.is_(None))
+            .values(conversation_id=conversation_id)
+        )
+    logger.info("Backfilled message owners", extra={"ownerless": ownerless, "conversations_created": len(user_ids)})
+
+    create_indexes(conn, message)
+
+
+def add_message_search(conn: Connection) -> None:
+    """
+    The full-text search column and index (or FTS5 table) /search reads, built over the
+    messages already stored.
+    """
+    for statement in SEARCH_DDL.get(conn.dialect.name, []):
+        conn.execute(text(statement))
+
+
+MIGRATIONS: List[Tuple[str, Callable[[Connection], None]]] = [
+    ("0001_add_conversations", add_conversations),
+    ("0002_add_message_search", add_message_search),
+]
+
+
+def run_migrations(conn: Connection) -> List[str]:
+    """
+    Bring the database up to date, returning the names of the migrations applied.
+    """
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+
+    now = datetime.now(timezone.utc)
+    if not inspect(conn).has_table(MessageModel.__tablename__):
+        Base.metadata.create_all(conn)
+        schema_migration.create(conn)
+        conn.execute(insert(schema_migration), [{"name": name, "applied_at": now} for name, _ in MIGRATIONS])
+        logger.info("Created schema")
+        return []
+
+    schema_migration.create(conn, checkfirst=True)
+    done = set(conn.scalars(select(schema_migration.c.name)).all())
+    applied = []
+    for name, migration in MIGRATIONS:
+        if name in done:
+            continue
+        migration(conn)
+        conn.execute(insert(schema_migration).values(name=name, applied_at=now))
+        logger.info("Applied migration", extra={"migration": name})
+        applied.append(name)
+    return applied
+
+
+async def migrate(engine: AsyncEngine) -> List[str]:
+    async with engine.begin() as conn:
+        return await conn.run_sync(run_migrations)
+
+
+async def main() -> None:
+    from database import dispose_engine, init_engine
+    from instrumentation import configure_logging
+
+    configure_logging()
+    try:
+        await migrate(init_engine())
+    finally:
+        await dispose_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
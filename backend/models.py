@@ -1,6 +1,6 @@
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Optional
-from sqlalchemy import DateTime, String, func
+from sqlalchemy import DDL, DateTime, ForeignKey, Index, String, Text, event, func, text
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
@@ -8,10 +8,15 @@ from sqlalchemy.orm import mapped_column
 class Base(DeclarativeBase):
     pass
 
+# Messages whose reply a background worker has yet to generate (see jobs.py). Queries repeat it
+# as literal SQL so that the planner can match it to ix_message_jobs.
+JOB_STATUS_PREDICATE = "status IN ('queued', 'pending')"
+
 class TimestampMixin:
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
         server_default=func.now(), # Tells SQLAlchemy the DB will supply a default
+        default=lambda: datetime.now(timezone.utc), # Set client side too, so keyset cursors see the exact stored value
         nullable=False
     )
     updated_at: Mapped[Optional[datetime]] = mapped_column(
@@ -23,14 +28,134 @@ class TimestampMixin:
         nullable=True
     )
 
-    
+
+class Conversation(Base, TimestampMixin):
+    __tablename__ = "conversation"
+
+    # columns
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[str] = mapped_column(String, nullable=False, index=True)
+    # Rolling summary of the turns too old to fit in the prompt, up to and including summary_through_id
+    summary: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    summary_through_id: Mapped[Optional[int]] = mapped_column(nullable=True)
+    # Incremented by every write to the conversation's messages; tags cached copies of them
+    version: Mapped[int] = mapped_column(nullable=False, default=0, server_default="0")
+
+    def __repr__(self) -> str:
+            return f"Conversation(id={self.id!r}, user_id={self.user_id!r})"
+
 class MessageModel(Base, TimestampMixin):
     __tablename__ = "message"
+    __table_args__ = (
+        # Keyset pagination over a conversation's history
+        Index("ix_message_conversation_created_at_id", "conversation_id", "created_at", "id"),
+        # Same ordering restricted to live rows, which is what every read path asks for
+        Index(
+            "ix_message_conversation_created_at_id_live",
+            "conversation_id", "created_at", "id",
+            postgresql_where=text("deleted_at IS NULL"),
+            sqlite_where=text("deleted_at IS NULL"),
+        ),
+        # Soft-deleted rows waiting to be purged by compaction
+        Index(
+            "ix_message_deleted_at",
+            "deleted_at",
+            postgresql_where=text("deleted_at IS NOT NULL"),
+            sqlite_where=text("deleted_at IS NOT NULL"),
+        ),
+        # A user's live messages in id order, as /export reads them
+        Index(
+            "ix_message_user_id_id_live",
+            "user_id", "id",
+            postgresql_where=text("deleted_at IS NULL"),
+            sqlite_where=text("deleted_at IS NULL"),
+        ),
+        # The job queue; stays as small as the backlog while the table grows
+        Index(
+            "ix_message_jobs",
+            "id",
+            postgresql_where=text(f"{JOB_STATUS_PREDICATE} AND deleted_at IS NULL"),
+            sqlite_where=text(f"{JOB_STATUS_PREDICATE} AND deleted_at IS NULL"),
+        ),
+        # A user message's reply, and the rows ON DELETE SET NULL updates when a message is purged;
+        # only replies have one
+        Index(
+            "ix_message_reply_to_id",
+            "reply_to_id",
+            postgresql_where=text("reply_to_id IS NOT NULL"),
+            sqlite_where=text("reply_to_id IS NOT NULL"),
+        ),
+    )
 
     # columns
     id: Mapped[int] = mapped_column(primary_key=True)
     author: Mapped[str] = mapped_column(String, nullable=False) # Would be better as an enum
     content: Mapped[str] = mapped_column(String, nullable=False)
+    # Nullable so messages created before conversations existed stay valid
+    conversation_id: Mapped[Optional[int]] = mapped_column(ForeignKey("conversation.id"), nullable=True)
+    user_id: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    # Status of the exchange a user message starts: pending while the reply is generated, then complete or failed
+    status: Mapped[str] = mapped_column(String, nullable=False, default="complete", server_default="complete")
+    # When a background worker claimed the reply job; jobs still pending after their lease are claimed again
+    claimed_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    # For chatbot replies, the user message being answered
+    reply_to_id: Mapped[Optional[int]] = mapped_column(ForeignKey("message.id", ondelete="SET NULL"), nullable=True)
 
     def __repr__(self) -> str:
             return f"Message(id={self.id!r}, content={self.content!r})"
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_key"
+    __table_args__ = (
+        # Expired keys waiting to be purged by compaction
+        Index("ix_idempotency_key_expires_at", "expires_at"),
+    )
+
+    # columns
+    user_id: Mapped[str] = mapped_column(String, primary_key=True)
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    # Hash of the request body; reusing a key for a different request is an error
+    request_hash: Mapped[str] = mapped_column(String, nullable=False)
+    # JSON response body, set once the request that claimed the key has completed
+    response: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    # While pending, when another worker may take the key over from a claimant that died
+    expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+
+    def __repr__(self) -> str:
+            return f"IdempotencyKey(user_id={self.user_id!r}, key={self.key!r})"
+
+# Full-text search over message content (see search.py). Neither index can be declared on the
+# model: Postgres gets a generated tsvector column with a GIN index, led by user_id so a
+# search only walks the searching user's postings; SQLite, used in tests, gets an FTS5 index
+# kept in sync by triggers. The same statements create them with the table and add them to
+# existing databases (see migrations.py).
+SEARCH_CONFIG = "english"
+SEARCH_VECTOR_EXPRESSION = f"to_tsvector('{SEARCH_CONFIG}', content)"
+SEARCH_DDL = {
+    "postgresql": [
+        "CREATE EXTENSION IF NOT EXISTS btree_gin",
+        f"ALTER TABLE message ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ({SEARCH_VECTOR_EXPRESSION}) STORED",
+        "CREATE INDEX IF NOT EXISTS ix_message_search ON message USING GIN (user_id, search_vector) WHERE deleted_at IS NULL",
+    ],
+    "sqlite": [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(content, content='message', content_rowid='id')",
+        """CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN
+            INSERT INTO message_fts(rowid, content) VALUES (new.id, new.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN
+            INSERT INTO message_fts(message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF content ON message BEGIN
+            INSERT INTO message_fts(message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO message_fts(rowid, content) VALUES (new.id, new.content);
+        END""",
+        # Indexes the messages stored before the table existed
+        "INSERT INTO message_fts(message_fts) VALUES ('rebuild')",
+    ],
+}
+
+for dialect, statements in SEARCH_DDL.items():
+    for statement in statements:
+        event.listen(MessageModel.__table__, "after_create", DDL(statement).execute_if(dialect=dialect))
+event.listen(MessageModel.__table__, "before_drop", DDL("DROP TABLE IF EXISTS message_fts").execute_if(dialect="sqlite"))
@@ -0,0 +1,168 @@
+import math
+import time
+from typing import Callable, Optional
+
+from cache import TTLCache
+from metrics import Counter
+
+RATE_LIMITED = Counter("rate_limited_total", "Requests rejected by the per-user rate limits", labelnames=("limit",))
+
+SECONDS_PER_DAY = 86400
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a user is over one of their limits. `retry_after` is the number of seconds
+    until the request would be allowed.
+    """
+
+    def __init__(self, limit: str, retry_after: float):
+        super().__init__(f"Rate limit exceeded: {limit}")
+        self.limit = limit
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class RateLimitBackend:
+    """
+    Storage for token buckets that refill continuously at `rate` tokens per second up to
+    `capacity`. Implement this on top of a shared store so that every worker process
+    enforces the same limits; the in-process backend only sees its own worker's traffic.
+    """
+
+    async def acquire(self, key: str, cost: float, capacity: float, rate: float) -> float:
+        """
+        Take `cost` tokens if the bucket holds them and return 0, otherwise take nothing and
+        return the seconds until it will.
+        """
+        raise NotImplementedError
+
+    async def charge(self, key: str, cost: float, capacity: float, rate: float) -> None:
+        """
+        Take `cost` tokens unconditionally. The bucket may go negative, which blocks further
+        acquires until it has refilled past zero.
+        """
+        raise NotImplementedError
+
+
+class InProcessRateLimitBackend(RateLimitBackend):
+    """
+    Buckets kept in a bounded TTL cache. Nothing awaits between reading and writing a bucket,
+    so it needs no lock on a single event loop. Each bucket expires once it would have
+    refilled completely, since a missing bucket counts as full.
+    """
+
+    def __init__(self, maxsize: int = 100_000, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self._buckets = TTLCache(maxsize=maxsize, ttl=SECONDS_PER_DAY, clock=clock)
+
+    def _take(self, key: str, cost: float, capacity: float, rate: float, force: bool) -> float:
+        now = self._clock()
+        tokens, updated_at = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+
+        wait = 0.0
+        if force or tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / rate
+        self._buckets.set(key, (tokens, now), ttl=(capacity - tokens) / rate)
+        return wait
+
+    async def acquire(self, key: str, cost: float, capacity: float, rate: float) -> float:
+        return self._take(key, min(cost, capacity), capacity, rate, force=False)
+
+    async def charge(self, key: str, cost: float, capacity: float, rate: float) -> None:
+        self._take(key, cost, capacity, rate, force=True)
+
+
+# Same algorithm as InProcessRateLimitBackend, run atomically inside Redis on Redis's clock
+_REDIS_TAKE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local cost, capacity, rate = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(state[1]) or capacity
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - updated_at) * rate)
+local wait = 0
+if ARGV[4] == '1' or tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisRateLimitBackend(RateLimitBackend):
+    """
+    Buckets shared by every worker, stored in Redis. `redis` is a redis.asyncio client.
+    """
+
+    def __init__(self, redis, prefix: str = "ratelimit:"):
+        self.redis = redis
+        self.prefix = prefix
+
+    async def _take(self, key: str, cost: float, capacity: float, rate: float, force: bool) -> float:
+        wait = await self.redis.eval(_REDIS_TAKE_SCRIPT, 1, self.prefix + key, cost, capacity, rate, "1" if force else "0")
+        return float(wait)
+
+    async def acquire(self, key: str, cost: float, capacity: float, rate: float) -> float:
+        return await self._take(key, min(cost, capacity), capacity, rate, force=False)
+
+    async def charge(self, key: str, cost: float, capacity: float, rate: float) -> None:
+        await self._take(key, cost, capacity, rate, force=True)
+
+
+class RateLimiter:
+    """
+    Per-user limits on requests per second (with bursts of up to `burst`) and on LLM tokens
+    per rolling day. A limit left as None is not enforced.
+
+    Requests are checked before any work starts. LLM tokens are charged once a request's
+    prompt is known, so the request that crosses the daily quota still completes and the
+    user's next one is rejected.
+    """
+
+    def __init__(
+        self,
+        backend: RateLimitBackend,
+        requests_per_second: Optional[float] = None,
+        burst: Optional[float] = None,
+        tokens_per_day: Optional[float] = None,
+    ):
+        self.backend = backend
+        self.requests_per_second = requests_per_second
+        self.burst = burst or max(1.0, requests_per_second or 0)
+        self.tokens_per_day = tokens_per_day
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.requests_per_second or self.tokens_per_day)
+
+    async def check(self, user_id: str, uses_llm: bool = False) -> None:
+        """
+        Raise RateLimitExceeded if the user is over their request rate or, for requests that
+        call the LLM, has used up their daily token quota.
+        """
+        if self.requests_per_second:
+            wait = await self.backend.acquire(f"requests:{user_id}", 1, self.burst, self.requests_per_second)
+            if wait > 0:
+                RATE_LIMITED.inc(limit="requests")
+                raise RateLimitExceeded("requests", wait)
+
+        if uses_llm and self.tokens_per_day:
+            wait = await self.backend.acquire(f"tokens:{user_id}", 0, self.tokens_per_day, self.tokens_per_day / SECONDS_PER_DAY)
+            if wait > 0:
+                RATE_LIMITED.inc(limit="tokens")
+                raise RateLimitExceeded("tokens", wait)
+
+    async def charge_tokens(self, user_id: str, tokens: int) -> None:
+        if self.tokens_per_day:
+            await self.backend.charge(f"tokens:{user_id}", tokens, self.tokens_per_day, self.tokens_per_day / SECONDS_PER_DAY)
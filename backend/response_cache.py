@@ -0,0 +1,84 @@
+import hashlib
+import logging
+from typing import Optional
+
+from cache import TTLCache
+from metrics import Counter
+
+CACHE_REQUESTS = Counter(
+    "llm_response_cache_requests_total",
+    "LLM response cache lookups by result",
+    labelnames=("result",),
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCacheBackend:
+    """
+    Storage for cached responses. Implement this on top of a shared store (e.g. Redis) so that
+    every worker process sees the same entries; the in-process backend only serves its own worker.
+    """
+
+    async def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        raise NotImplementedError
+
+
+class InProcessResponseCacheBackend(ResponseCacheBackend):
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._cache.get(key)
+
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        self._cache.set(key, value, ttl=ttl)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Fold case and collapse whitespace so trivially different prompts share an entry.
+    """
+    return " ".join(prompt.split()).casefold()
+
+
+class ResponseCache:
+    """
+    Caches chatbot replies keyed on the normalized prompt, the system prompt and the model.
+    Backend failures are logged and treated as misses so they never fail a request.
+    """
+
+    def __init__(self, backend: ResponseCacheBackend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(prompt: str, system_prompt: str, model: str) -> str:
+        raw = "\x00".join((model, system_prompt, normalize_prompt(prompt)))
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    async def get(self, prompt: str, system_prompt: str, model: str) -> Optional[str]:
+        try:
+            response = await self.backend.get(self.key(prompt, system_prompt, model))
+        except Exception as e:
+            logger.warning("Error reading from the response cache", extra={"error": repr(e)})
+            response = None
+
+        if response is None:
+            self.misses += 1
+            CACHE_REQUESTS.inc(result="miss")
+        else:
+            self.hits += 1
+            CACHE_REQUESTS.inc(result="hit")
+        return response
+
+    async def set(self, prompt: str, system_prompt: str, model: str, response: str) -> None:
+        try:
+            await self.backend.set(self.key(prompt, system_prompt, model), response, self.ttl)
+        except Exception as e:
+            logger.warning("Error writing to the response cache", extra={"error": repr(e)})
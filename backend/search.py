@@ -0,0 +1,84 @@
+"""
+Full-text search over a user's messages. Postgres matches against the generated
+`search_vector` column through its GIN index; SQLite, used in tests, through the FTS5
+`message_fts` table. Both are created alongside the message table (see models.py).
+"""
+import base64
+import binascii
+import json
+from typing import List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import column, func, literal_column, select, table, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import SEARCH_CONFIG, MessageModel
+
+MESSAGE_FTS = table("message_fts", column("rowid"))
+
+
+def encode_search_cursor(rank: float, message_id: int) -> str:
+    raw = json.dumps([rank, message_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_search_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        rank, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(rank), int(message_id)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def fts5_query(query: str) -> str:
+    """
+    Quote each word of a user's query so FTS5 matches messages containing all of them,
+    rather than parsing it as FTS5 query syntax.
+    """
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+async def search_messages(
+    query: str,
+    user_id: str,
+    session: AsyncSession,
+    limit: int = 20,
+    cursor: Optional[str] = None
+) -> Tuple[Sequence[MessageModel], Optional[str]]:
+    """
+    Return one page of the user's live messages matching `query`, best match first, and the
+    cursor for the next page.
+
+    Pages are keyset paginated on (rank, id), so later pages do not re-read earlier ones.
+    On Postgres the query is parsed with websearch_to_tsquery (quoted phrases, `or`, `-word`).
+    """
+    if session.bind.dialect.name == "sqlite":
+        fts = literal_column("message_fts")
+        # bm25 is lower for better matches; negated so both dialects rank descending
+        rank = (-func.bm25(fts)).label("rank")
+        statement = (
+            select(MessageModel, rank)
+            .join(MESSAGE_FTS, MESSAGE_FTS.c.rowid == MessageModel.id)
+            .where(fts.op("MATCH")(fts5_query(query)))
+        )
+    else:
+        ts_query = func.websearch_to_tsquery(SEARCH_CONFIG, query)
+        search_vector = literal_column("message.search_vector")
+        rank = func.ts_rank_cd(search_vector, ts_query).label("rank")
+        statement = select(MessageModel, rank).where(search_vector.op("@@")(ts_query))
+
+    statement = (
+        statement
+        .where(MessageModel.user_id == user_id, MessageModel.deleted_at.is_(None))
+        .order_by(rank.desc(), MessageModel.id.desc())
+        .limit(limit + 1)
+    )
+    if cursor is not None:
+        statement = statement.where(tuple_(rank, MessageModel.id) < decode_search_cursor(cursor))
+
+    rows: List[Tuple[MessageModel, float]] = list((await session.execute(statement)).tuples().all())
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_search_cursor(rows[-1][1], rows[-1][0].id)
+    return [message for message, _ in rows], next_cursor
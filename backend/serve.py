@@ -0,0 +1,48 @@
+"""
+Production launcher. Runs the API in WEB_CONCURRENCY worker processes (one per available CPU
+by default) on uvloop and httptools:
+
+    python serve.py
+
+On SIGTERM each worker stops accepting connections and gives in-flight requests, including
+streamed LLM replies, up to GRACEFUL_SHUTDOWN_SECONDS to finish before its lifespan shutdown
+stops the background jobs and closes its clients. Keep the total under the platform's kill
+timeout (30 seconds on Heroku).
+"""
+from dotenv import load_dotenv
+load_dotenv()
+import os
+
+import uvicorn
+
+GRACEFUL_SHUTDOWN_SECONDS = float(os.getenv("GRACEFUL_SHUTDOWN_SECONDS", 15))
+
+
+def worker_count() -> int:
+    configured = os.getenv("WEB_CONCURRENCY")
+    if configured:
+        return max(1, int(configured))
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError: # Not available on macOS
+        return os.cpu_count() or 1
+
+
+def run() -> None:
+    # Imported once up front so a broken configuration fails here rather than in every worker.
+    # Workers are spawned, not forked, and import the app again; nothing connects at import.
+    import main
+
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", 8000)),
+        workers=worker_count(),
+        loop="uvloop",
+        http="httptools",
+        timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_SECONDS,
+    )
+
+
+if __name__ == "__main__":
+    run()
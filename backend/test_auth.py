@@ -0,0 +1,131 @@
+import time
+from unittest.mock import MagicMock
+
+import httpx
+import pytest
+import rsa
+from jose import JWTError, jwk, jwt
+
+from auth import TokenVerifier
+from cache import TTLCache
+
+JWT_SECRET = "test-jwt-secret"
+
+
+def make_token(secret=JWT_SECRET, **overrides):
+    claims = {
+        "sub": "test_user",
+        "aud": "authenticated",
+        "exp": int(time.time()) + 3600,
+    }
+    claims.update(overrides)
+    return jwt.encode(claims, secret, algorithm="HS256")
+
+
+@pytest.fixture(scope="module")
+def rsa_key():
+    _, private_key = rsa.newkeys(1024)
+    return private_key.save_pkcs1().decode()
+
+
+def make_jwks_client(private_pem: str, kid: str, calls: list):
+    public_jwk = jwk.construct(private_pem, "RS256").public_key().to_dict()
+    public_jwk["kid"] = kid
+
+    def handler(request: httpx.Request):
+        calls.append(request.url)
+        return httpx.Response(200, json={"keys": [public_jwk]})
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+######## TTLCache ###########
+
+def test_ttl_cache_expires_entries():
+    now = [0.0]
+    cache = TTLCache(maxsize=10, ttl=5, clock=lambda: now[0])
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    now[0] = 6
+    assert cache.get("a") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert "a" in cache
+    assert "b" not in cache
+    assert len(cache) == 2
+
+
+######## TokenVerifier ###########
+
+@pytest.mark.asyncio
+async def test_verify_hs256_token():
+    verifier = TokenVerifier(jwt_secret=JWT_SECRET)
+    claims = await verifier.verify(make_token())
+    assert claims["sub"] == "test_user"
+
+
+@pytest.mark.asyncio
+async def test_verify_rejects_bad_tokens():
+    verifier = TokenVerifier(jwt_secret=JWT_SECRET)
+    with pytest.raises(JWTError):
+        await verifier.verify(make_token(secret="wrong-secret"))
+    with pytest.raises(JWTError):
+        await verifier.verify(make_token(exp=int(time.time()) - 10))
+    with pytest.raises(JWTError):
+        await verifier.verify(make_token(aud="anon"))
+    with pytest.raises(JWTError):
+        await verifier.verify("not-a-jwt")
+
+
+@pytest.mark.asyncio
+async def test_verify_caches_claims():
+    verifier = TokenVerifier(jwt_secret=JWT_SECRET)
+    token = make_token()
+    await verifier.verify(token)
+
+    verifier.jwt_secret = "rotated-secret"
+    claims = await verifier.verify(token)
+    assert claims["sub"] == "test_user"
+
+
+@pytest.mark.asyncio
+async def test_verify_with_jwks(rsa_key):
+    calls = []
+    verifier = TokenVerifier(
+        jwks_url="http://supabase.test/auth/v1/.well-known/jwks.json",
+        http_client=make_jwks_client(rsa_key, "key-1", calls),
+    )
+
+    for sub in ("user_a", "user_b"):
+        token = jwt.encode({"sub": sub, "aud": "authenticated"}, rsa_key, algorithm="RS256", headers={"kid": "key-1"})
+        claims = await verifier.verify(token)
+        assert claims["sub"] == sub
+
+    # The key set is fetched once and reused for the second token
+    assert len(calls) == 1
+
+    unknown_kid = jwt.encode({"sub": "x", "aud": "authenticated"}, rsa_key, algorithm="RS256", headers={"kid": "key-2"})
+    with pytest.raises(JWTError):
+        await verifier.verify(unknown_kid)
+
+
+@pytest.mark.asyncio
+async def test_verify_remote_fallback():
+    remote_verify = MagicMock(return_value={"id": "test_user"})
+    verifier = TokenVerifier(jwt_secret=JWT_SECRET, remote_verify=remote_verify)
+    token = make_token()
+
+    await verifier.verify(token)
+    await verifier.verify(token)
+    remote_verify.assert_called_once_with(token)
+
+    revoked = TokenVerifier(jwt_secret=JWT_SECRET, remote_verify=MagicMock(return_value=None))
+    with pytest.raises(JWTError):
+        await revoked.verify(make_token())
@@ -0,0 +1,111 @@
+import os
+import tracemalloc
+from datetime import datetime, timezone
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import event, insert
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backup import export_messages, import_ndjson, iter_lines, ImportLineTooLong
+from models import Base, Conversation, MessageModel
+
+# Rows exported by the memory test; set EXPORT_TEST_ROWS=1000000 for the full-size run
+EXPORT_TEST_ROWS = int(os.getenv("EXPORT_TEST_ROWS", 40_000))
+# Well under the size of the exported text itself, and independent of the row count
+EXPORT_MEMORY_CEILING = 4 * 1024 * 1024
+
+
+@pytest_asyncio.fixture
+async def session_factory(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'backup.db'}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    await engine.dispose()
+
+
+async def seed(session_factory, rows: int) -> None:
+    created_at = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    async with session_factory() as session:
+        session.add(Conversation(id=1, user_id="user"))
+        await session.flush()
+        for start in range(0, rows, 50_000):
+            await session.execute(insert(MessageModel), [
+                {"author": "user", "content": f"Message {i} " + "x" * 100, "conversation_id": 1, "user_id": "user", "created_at": created_at}
+                for i in range(start, min(rows, start + 50_000))
+            ])
+        await session.commit()
+
+
+async def chunked(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+@pytest.mark.asyncio
+async def test_export_memory_stays_flat(session_factory):
+    await seed(session_factory, EXPORT_TEST_ROWS)
+
+    lines = 0
+    tracemalloc.start()
+    try:
+        async with session_factory() as session:
+            async for chunk in export_messages("user", session):
+                lines += chunk.count("\n")
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert lines == EXPORT_TEST_ROWS
+    assert peak < EXPORT_MEMORY_CEILING, f"export peaked at {peak / 1024 / 1024:.1f} MiB"
+
+
+@pytest.mark.asyncio
+async def test_export_reads_the_users_index_in_order(session_factory):
+    await seed(session_factory, 10)
+    engine = session_factory.kw["bind"].sync_engine
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        async with session_factory() as session:
+            async for _ in export_messages("user", session):
+                pass
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+    statement, parameters = statements[0]
+    async with session_factory() as session:
+        conn = await session.connection()
+        plan = " ".join(row[-1] for row in (await conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)).all())
+    assert "ix_message_user_id_id_live" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+@pytest.mark.asyncio
+async def test_import_commits_in_batches(session_factory):
+    body = b"".join(
+        b'{"author": "user", "message": "Message %d", "conversation_id": %d}\n' % (i, i % 2)
+        for i in range(25)
+    )
+    async with session_factory() as session:
+        result = await import_ndjson(chunked(body, 7), "user", session, batch_size=10)
+    assert result == {"imported": 25, "failed": 0, "errors": []}
+
+    async with session_factory() as session:
+        exported = "".join([chunk async for chunk in export_messages("user", session)])
+    assert exported.count("\n") == 25
+    assert exported.count('"conversation_id": 1,') + exported.count('"conversation_id": 2,') == 25
+
+
+@pytest.mark.asyncio
+async def test_iter_lines_rejects_unbounded_lines():
+    with pytest.raises(ImportLineTooLong):
+        async for _ in iter_lines(chunked(b"x" * 100, 10), max_line_bytes=50):
+            pass
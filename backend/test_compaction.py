@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from compaction import compact_messages, purge_idempotency_keys
+from models import Base, IdempotencyKey, MessageModel
+
+NOW = datetime(2025, 1, 31, tzinfo=timezone.utc)
+
+
+@pytest_asyncio.fixture
+async def session_factory():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    await engine.dispose()
+
+
+async def seed(session_factory, **columns_by_content):
+    async with session_factory() as session:
+        session.add_all([MessageModel(author="user", content=content, **columns) for content, columns in columns_by_content.items()])
+        await session.commit()
+
+
+async def remaining(session_factory):
+    async with session_factory() as session:
+        return sorted((await session.scalars(select(MessageModel.content))).all())
+
+
+@pytest.mark.asyncio
+async def test_compaction_purges_old_soft_deleted_messages_in_batches(session_factory):
+    old = {f"old{i}": {"deleted_at": NOW - timedelta(days=40)} for i in range(5)}
+    await seed(
+        session_factory,
+        **old,
+        recent={"deleted_at": NOW - timedelta(days=1)},
+        live={"created_at": NOW - timedelta(days=400)},
+    )
+
+    archived = []
+
+    async def archive(batch):
+        archived.append([m.content for m in batch])
+
+    purged = await compact_messages(session_factory, purge_after=timedelta(days=30), batch_size=2, archive=archive, now=NOW)
+    assert purged == 5
+    assert [len(batch) for batch in archived] == [2, 2, 1]
+    assert await remaining(session_factory) == ["live", "recent"]
+
+
+@pytest.mark.asyncio
+async def test_compaction_finds_soft_deleted_messages_through_their_index(session_factory):
+    await seed(session_factory, old={"deleted_at": NOW - timedelta(days=40)})
+    engine = session_factory.kw["bind"].sync_engine
+    selects = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("SELECT") and "deleted_at" in statement:
+            selects.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        await compact_messages(session_factory, purge_after=timedelta(days=30), now=NOW)
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+    statement, parameters = selects[0]
+    async with session_factory() as session:
+        conn = await session.connection()
+        plan = (await conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)).all()
+    assert any("ix_message_deleted_at" in row[-1] for row in plan)
+
+
+@pytest.mark.asyncio
+async def test_compaction_purges_expired_messages_when_retention_is_set(session_factory):
+    await seed(
+        session_factory,
+        expired={"created_at": NOW - timedelta(days=400)},
+        kept={"created_at": NOW - timedelta(days=10)},
+    )
+
+    purged = await compact_messages(session_factory, retention=timedelta(days=365), now=NOW)
+    assert purged == 1
+    assert await remaining(session_factory) == ["kept"]
+
+
+@pytest.mark.asyncio
+async def test_compaction_purges_expired_idempotency_keys(session_factory):
+    async with session_factory() as session:
+        session.add_all([
+            IdempotencyKey(user_id="user", key=key, request_hash="hash", expires_at=NOW + timedelta(hours=hours))
+            for key, hours in (("expired", -1), ("live", 1))
+        ])
+        await session.commit()
+
+    assert await purge_idempotency_keys(session_factory, now=NOW) == 1
+    async with session_factory() as session:
+        assert (await session.scalars(select(IdempotencyKey.key))).all() == ["live"]
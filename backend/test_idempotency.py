@@ -0,0 +1,147 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import pytest_asyncio
+from fastapi import HTTPException
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from idempotency import IdempotencyStore
+from models import Base, IdempotencyKey
+
+RESPONSE = {"exchange": [{"id": 1}, {"id": 2}]}
+
+
+@pytest_asyncio.fixture
+async def session_factory(tmp_path):
+    # A file, so that each session (each "worker") gets its own connection
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    await engine.dispose()
+
+
+class Call:
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return RESPONSE
+
+
+async def add_claim(session_factory, expires_in, response=None):
+    async with session_factory() as session:
+        session.add(IdempotencyKey(
+            user_id="user",
+            key="key",
+            request_hash="hash",
+            response=response,
+            expires_at=datetime.now(timezone.utc) + timedelta(seconds=expires_in),
+        ))
+        await session.commit()
+
+
+@pytest.mark.asyncio
+async def test_completed_responses_are_replayed_by_every_worker(session_factory):
+    call = Call()
+    async with session_factory() as session:
+        assert await IdempotencyStore().run("user", "key", "hash", session, call) == (RESPONSE, False)
+
+    # Another worker has nothing cached and finds the response in the table
+    async with session_factory() as session:
+        assert await IdempotencyStore().run("user", "key", "hash", session, call) == (RESPONSE, True)
+        # Keys are per user
+        assert await IdempotencyStore().run("other", "key", "hash", session, call) == (RESPONSE, False)
+    assert call.calls == 2
+
+    async with session_factory() as session:
+        with pytest.raises(HTTPException) as e:
+            await IdempotencyStore().run("user", "key", "other hash", session, call)
+    assert e.value.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_duplicates_in_flight_share_one_call(session_factory):
+    release = asyncio.Event()
+    calls = 0
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return RESPONSE
+
+    store = IdempotencyStore()
+    async with session_factory() as session:
+        first = asyncio.create_task(store.run("user", "key", "hash", session, call))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(store.run("user", "key", "hash", session, call))
+        await asyncio.sleep(0)
+        release.set()
+        assert await asyncio.gather(first, second) == [(RESPONSE, False), (RESPONSE, True)]
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_waits_for_a_claim_held_by_another_worker(session_factory):
+    await add_claim(session_factory, expires_in=60)
+    call = Call()
+    async with session_factory() as session:
+        waiting = asyncio.create_task(IdempotencyStore(poll_interval=0.01).run("user", "key", "hash", session, call))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+
+        async with session_factory() as other:
+            await other.execute(update(IdempotencyKey).values(response=json.dumps(RESPONSE)))
+            await other.commit()
+        assert await waiting == (RESPONSE, True)
+    assert call.calls == 0
+
+
+@pytest.mark.asyncio
+async def test_abandoned_claims_are_taken_over(session_factory):
+    await add_claim(session_factory, expires_in=-1)
+    call = Call()
+    async with session_factory() as session:
+        assert await IdempotencyStore().run("user", "key", "hash", session, call) == (RESPONSE, False)
+    assert call.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_calls_can_be_retried_at_once(session_factory):
+    started = asyncio.Event()
+
+    async def hang():
+        started.set()
+        await asyncio.Event().wait()
+
+    async with session_factory() as session:
+        request = asyncio.create_task(IdempotencyStore().run("user", "key", "hash", session, hang))
+        await started.wait()
+        request.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await request
+
+    # Another worker takes the key over without waiting for the claim's lease to run out
+    call = Call()
+    async with session_factory() as session:
+        retry = IdempotencyStore(poll_interval=0.01).run("user", "key", "hash", session, call)
+        assert await asyncio.wait_for(retry, 1) == (RESPONSE, False)
+    assert call.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_calls_can_be_retried(session_factory):
+    store = IdempotencyStore()
+    async with session_factory() as session:
+        with pytest.raises(HTTPException):
+            await store.run("user", "key", "hash", session, Call(error=HTTPException(status_code=503)))
+        assert await store.run("user", "key", "hash", session, Call()) == (RESPONSE, False)
@@ -0,0 +1,51 @@
+import json
+import logging
+import sys
+
+import pytest
+
+from instrumentation import JsonFormatter, STAGE_DURATION, _QueueHandler, record_tokens, LLM_TOKENS, stage
+
+
+def test_stage_records_duration_even_on_error():
+    before = STAGE_DURATION.count(stage="test_stage")
+    with stage("test_stage"):
+        pass
+    with pytest.raises(ValueError):
+        with stage("test_stage"):
+            raise ValueError("boom")
+    assert STAGE_DURATION.count(stage="test_stage") == before + 2
+
+
+def test_record_tokens_ignores_missing_counts():
+    before = LLM_TOKENS.value(model="test-model", kind="prompt")
+    record_tokens("test-model", 12, None)
+    record_tokens("test-model", None, None)
+    assert LLM_TOKENS.value(model="test-model", kind="prompt") == before + 12
+    assert LLM_TOKENS.value(model="test-model", kind="completion") == 0
+
+
+def test_json_formatter_includes_extra_fields():
+    record = logging.getLogger("test").makeRecord(
+        "test", logging.INFO, __file__, 1, "Message %s", ("updated",), None, extra={"message_id": 7}
+    )
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["message"] == "Message updated"
+    assert entry["level"] == "INFO"
+    assert entry["message_id"] == 7
+
+
+def test_queued_records_keep_their_traceback():
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = logging.getLogger("test").makeRecord(
+            "test", logging.ERROR, __file__, 1, "Failed", (), sys.exc_info()
+        )
+
+    prepared = _QueueHandler(None).prepare(record)
+    assert prepared.exc_info is None
+
+    entry = json.loads(JsonFormatter().format(prepared))
+    assert entry["message"] == "Failed"
+    assert "ValueError: boom" in entry["exception"]
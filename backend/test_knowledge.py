@@ -0,0 +1,67 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from knowledge import Chunk, HashingEmbedder, KnowledgeBase, VectorIndex, build_index, normalize, split_document, write_index
+
+# Chunks in the synthetic index searched by the latency benchmark
+BENCHMARK_CHUNKS = int(os.getenv("KNOWLEDGE_BENCHMARK_CHUNKS", 200_000))
+SEARCH_LATENCY_BUDGET_SECONDS = float(os.getenv("SEARCH_LATENCY_BUDGET_SECONDS", 0.005))
+
+
+def test_split_document_keeps_paragraphs_whole():
+    text = "one two three\n\nfour five\n\n" + " ".join(["word"] * 7)
+    assert split_document(text, max_words=5) == ["one two three four five", "word word word word word", "word word"]
+
+
+@pytest.mark.asyncio
+async def test_build_index_embeds_only_changed_chunks(tmp_path):
+    docs = tmp_path / "docs"
+    docs.mkdir()
+    (docs / "pricing.md").write_text("Plans start with a free trial.\n\nAnnual billing gets a discount.")
+    (docs / "notes.bin").write_text("Not a document")
+    index_dir = str(tmp_path / "index")
+    embedder = HashingEmbedder()
+
+    assert await build_index(str(docs), index_dir, embedder, partition_min_chunks=1) == {"chunks": 1, "reused": 0, "embedded": 1}
+    (docs / "team.md").write_text("The support team answers within a day.")
+    assert await build_index(str(docs), index_dir, embedder, partition_min_chunks=1) == {"chunks": 2, "reused": 1, "embedded": 1}
+    assert not any(name.startswith("embeddings.") and name != "embeddings.npy" for name in os.listdir(index_dir))
+
+    knowledge_base = KnowledgeBase.open(index_dir, embedder)
+    trial, support = await knowledge_base.retrieve(["Is there a free trial?", "How fast does support answer?"], k=1)
+    assert [r.source for r in trial] == ["pricing.md"]
+    assert [r.source for r in support] == ["team.md"]
+
+    with pytest.raises(ValueError):
+        KnowledgeBase.open(index_dir, HashingEmbedder(dimensions=64))
+
+
+def test_partitioned_search_finds_nearest_chunks(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = normalize(rng.standard_normal((5000, 32)).astype(np.float32))
+    write_index(str(tmp_path), vectors, [Chunk("synthetic", str(i)) for i in range(len(vectors))], "synthetic", partition_min_chunks=1000)
+    index = VectorIndex(str(tmp_path))
+    assert len(index.centroids) > 1
+
+    queries = normalize(vectors[:50] + 0.1 * rng.standard_normal((50, 32)).astype(np.float32))
+    results = index.search(queries, k=3)
+    found = [int(index.chunk(int(rows[0]))["text"]) for _, rows in results]
+    assert np.mean(np.array(found) == np.arange(50)) >= 0.9
+    assert all(np.all(np.diff(scores) <= 0) for scores, _ in results)
+
+
+def test_benchmark_search_latency(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = normalize(rng.standard_normal((BENCHMARK_CHUNKS, 128)).astype(np.float32))
+    write_index(str(tmp_path), vectors, [Chunk("synthetic", "") for _ in range(BENCHMARK_CHUNKS)], "synthetic")
+    index = VectorIndex(str(tmp_path))
+    queries = normalize(rng.standard_normal((200, 128)).astype(np.float32))
+
+    start = time.perf_counter()
+    for query in queries:
+        index.search(query, k=5)
+    seconds = (time.perf_counter() - start) / len(queries)
+    assert seconds < SEARCH_LATENCY_BUDGET_SECONDS, f"search over {BENCHMARK_CHUNKS} chunks: {seconds * 1000:.2f} ms"
@@ -0,0 +1,163 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+import llm_service
+from llm_backends import StubBackend
+from llm_router import LLMRouter, Route, RouteStats
+from llm_scheduler import LLMScheduler, LLMUnavailableError
+
+MESSAGES = [{"role": "system", "content": "You are a chatbot."}, {"role": "user", "content": "Hello there"}]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+async def answer(route, last):
+    return (await route.backend.complete(route.model, MESSAGES)).content
+
+
+def api_error(error_class, status_code):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    return error_class("Rejected", response=httpx.Response(status_code, request=request), body=None)
+
+
+@pytest.mark.asyncio
+async def test_stub_backend_is_deterministic():
+    backend = StubBackend()
+    completion = await backend.complete("gpt-4o", MESSAGES)
+    assert completion.content == (await backend.complete("gpt-4o", MESSAGES)).content
+    assert completion.content != (await backend.complete("gpt-4o-mini", MESSAGES)).content
+    assert completion.content.endswith("to: Hello there")
+
+    stream = await backend.stream("gpt-4o", MESSAGES)
+    assert "".join([token async for token in stream]) == completion.content
+    assert backend.calls == 4
+
+
+def test_route_stats_roll_over_the_window():
+    clock = FakeClock()
+    stats = RouteStats(window_seconds=60, clock=clock)
+    for i in range(19):
+        stats.record(0.1, ok=True)
+    stats.record(2.0, ok=True)
+    stats.record(5.0, ok=False)
+    assert stats.p95 == 2.0
+    assert stats.error_rate == pytest.approx(1 / 21)
+
+    clock.now = 61
+    assert len(stats) == 0
+    assert stats.p95 is None
+
+
+@pytest.mark.asyncio
+async def test_short_prompts_go_to_the_fast_model():
+    backend = StubBackend()
+    router = LLMRouter(Route(backend, "gpt-4o"), fast=Route(backend, "gpt-4o-mini"), short_prompt_tokens=10)
+
+    route, _ = await router.run(5, answer)
+    assert route.model == "gpt-4o-mini"
+    route, _ = await router.run(500, answer)
+    assert route.model == "gpt-4o"
+
+
+@pytest.mark.asyncio
+async def test_slow_or_failing_routes_are_avoided_until_they_recover():
+    clock = FakeClock()
+    backend = StubBackend()
+    primary = Route(backend, "gpt-4o", RouteStats(clock=clock))
+    fast = Route(backend, "gpt-4o-mini", RouteStats(clock=clock))
+    router = LLMRouter(primary, fast=fast, short_prompt_tokens=10, max_p95_seconds=1, min_samples=5)
+
+    for _ in range(5):
+        primary.stats.record(3.0, ok=True)
+    assert router.routes(500) == [fast, primary]
+
+    clock.now = 120
+    for _ in range(5):
+        fast.stats.record(0.2, ok=False)
+    assert router.routes(5) == [primary, fast]
+
+    # Once the failures have aged out the fast route is preferred again
+    clock.now = 240
+    assert router.routes(5) == [fast, primary]
+
+
+@pytest.mark.asyncio
+async def test_failures_fail_over_to_the_next_route():
+    broken = StubBackend(error=LLMUnavailableError("provider is down"))
+    router = LLMRouter(Route(broken, "gpt-4o"), fast=Route(broken, "gpt-4o-mini"))
+    with pytest.raises(LLMUnavailableError):
+        await router.run(500, answer)
+    assert broken.calls == 2
+
+    class Standby(StubBackend):
+        name = "standby"
+
+    standby = Standby()
+    router = LLMRouter(Route(broken, "gpt-4o"), fast=Route(standby, "local-small"))
+    route, content = await router.run(500, answer)
+    assert route.backend is standby
+    assert content == StubBackend.reply("local-small", MESSAGES)
+
+
+@pytest.mark.asyncio
+async def test_rejected_requests_do_not_fail_over():
+    for error in (api_error(openai.BadRequestError, 400), api_error(openai.AuthenticationError, 401)):
+        backend = StubBackend(error=error)
+        router = LLMRouter(Route(backend, "gpt-4o"), fast=Route(backend, "gpt-4o-mini"))
+        with pytest.raises(type(error)):
+            await router.run(500, answer)
+        assert backend.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_only_the_last_route_is_retried():
+    scheduler = LLMScheduler(max_retries=2, base_delay=0)
+    broken = StubBackend(error=asyncio.TimeoutError())
+    router = LLMRouter(Route(broken, "gpt-4o"), fast=Route(broken, "gpt-4o-mini"))
+
+    async def call(route, last):
+        return await scheduler.run(lambda: route.backend.complete(route.model, MESSAGES), max_retries=None if last else 0)
+
+    with pytest.raises(LLMUnavailableError):
+        await router.run(500, call)
+    # Straight on to the fast model after the first failure, which then gets every retry
+    assert broken.calls == 1 + 3
+
+
+class Completions:
+    def __init__(self, error):
+        self.error = error
+        self.models = []
+
+    async def create(self, model, messages):
+        self.models.append(model)
+        if model == llm_service.MODEL:
+            raise self.error
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="Fast reply"))], usage=None)
+
+
+@pytest.mark.asyncio
+async def test_default_router_fails_over_to_the_fast_model(monkeypatch):
+    completions = Completions(openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions")))
+    monkeypatch.setattr(llm_service, "client", SimpleNamespace(chat=SimpleNamespace(completions=completions)), raising=False)
+    router = llm_service.create_router()
+
+    route, content = await router.run(500, answer)
+    assert (route.model, content) == (llm_service.FAST_MODEL, "Fast reply")
+    assert completions.models == [llm_service.MODEL, llm_service.FAST_MODEL]
+
+    completions = Completions(api_error(openai.BadRequestError, 400))
+    monkeypatch.setattr(llm_service, "client", SimpleNamespace(chat=SimpleNamespace(completions=completions)), raising=False)
+    with pytest.raises(openai.BadRequestError):
+        await router.run(500, answer)
+    assert completions.models == [llm_service.MODEL]
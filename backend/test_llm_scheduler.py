@@ -0,0 +1,131 @@
+import asyncio
+import time
+
+import pytest
+
+from fake_openai import FakeOpenAI
+from llm_scheduler import LLMScheduler, LLMUnavailableError, TokenBudget
+
+def create(client, content="Hello"):
+    return lambda: client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": content}])
+
+
+@pytest.mark.asyncio
+async def test_retries_rate_limits_honouring_retry_after():
+    fake = FakeOpenAI(rate_limit_first=2, retry_after=0.05)
+    scheduler = LLMScheduler(max_retries=3, base_delay=0.001)
+
+    start = time.perf_counter()
+    completion = await scheduler.run(create(fake.client()))
+    elapsed = time.perf_counter() - start
+
+    assert completion.choices[0].message.content == "Fake LLM Response"
+    assert fake.calls == 3
+    assert elapsed >= 0.1
+
+
+@pytest.mark.asyncio
+async def test_gives_up_after_max_retries():
+    fake = FakeOpenAI(rate_limit_first=10, retry_after=0.01)
+    scheduler = LLMScheduler(max_retries=2, base_delay=0.001)
+
+    with pytest.raises(LLMUnavailableError) as error:
+        await scheduler.run(create(fake.client()))
+    assert fake.calls == 3
+    assert error.value.retry_after == 0.01
+
+
+@pytest.mark.asyncio
+async def test_times_out_slow_calls():
+    fake = FakeOpenAI(latency=1)
+    scheduler = LLMScheduler(max_retries=0, timeout=0.05)
+
+    with pytest.raises(LLMUnavailableError):
+        await scheduler.run(create(fake.client()))
+
+
+@pytest.mark.asyncio
+async def test_coalesces_identical_in_flight_calls():
+    fake = FakeOpenAI(latency=0.05)
+    client = fake.client()
+    scheduler = LLMScheduler()
+
+    results = await asyncio.gather(*(scheduler.run(create(client), key="same") for _ in range(10)))
+    assert fake.calls == 1
+    assert all(r.choices[0].message.content == "Fake LLM Response" for r in results)
+
+    # Once finished, the next identical call goes upstream again
+    await scheduler.run(create(client), key="same")
+    assert fake.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limit_prevents_rate_limit_storm():
+    fake = FakeOpenAI(latency=0.02, max_concurrency=2)
+    client = fake.client()
+
+    unbounded = LLMScheduler(max_concurrency=100, max_retries=0)
+    outcomes = await asyncio.gather(*(unbounded.run(create(client, f"Q{i}")) for i in range(10)), return_exceptions=True)
+    assert any(isinstance(o, LLMUnavailableError) for o in outcomes)
+
+    fake.calls = fake.rate_limited = 0
+    bounded = LLMScheduler(max_concurrency=2, max_retries=0)
+    await asyncio.gather(*(bounded.run(create(client, f"Q{i}")) for i in range(10)))
+    assert fake.calls == 10
+    assert fake.rate_limited == 0
+
+
+@pytest.mark.asyncio
+async def test_streams_hold_their_slot_until_closed():
+    scheduler = LLMScheduler(max_concurrency=2, max_retries=0)
+    opened = 0
+
+    async def tokens():
+        yield "Hello"
+        yield " world"
+
+    async def open_stream():
+        nonlocal opened
+        opened += 1
+        return tokens()
+
+    first = await scheduler.stream(open_stream)
+    second = await scheduler.stream(open_stream)
+    assert await first.__anext__() == "Hello"
+
+    # Both slots are held by streams still being read
+    third = asyncio.create_task(scheduler.stream(open_stream))
+    await asyncio.sleep(0.05)
+    assert not third.done()
+    assert opened == 2
+
+    # Reading a stream to the end frees its slot
+    assert [token async for token in first] == [" world"]
+    third = await asyncio.wait_for(third, 1)
+    assert opened == 3
+
+    # So does closing one part way through
+    fourth = asyncio.create_task(scheduler.stream(open_stream))
+    await asyncio.sleep(0.05)
+    assert not fourth.done()
+    await second.aclose()
+    await asyncio.wait_for(fourth, 1)
+    assert opened == 4
+
+
+def test_token_budget():
+    now = [0.0]
+    budget = TokenBudget(tokens_per_minute=600, clock=lambda: now[0])
+    assert budget.try_acquire(500) == 0
+    assert budget.try_acquire(200) == pytest.approx(10)
+
+    now[0] = 10
+    assert budget.try_acquire(200) == 0
+
+
+def test_backoff_is_jittered_and_bounded():
+    scheduler = LLMScheduler(base_delay=1, max_delay=4)
+    delays = [scheduler.backoff(10) for _ in range(100)]
+    assert all(0 <= d <= 4 for d in delays)
+    assert len(set(delays)) > 1
+    assert scheduler.backoff(0, retry_after=7) == 7
@@ -0,0 +1,41 @@
+import pytest
+import uvloop
+from fastapi import FastAPI
+
+from loadtest import ServerThread, compare, free_port, percentile, run_load_test
+
+
+def test_percentile():
+    values = [i / 100 for i in range(1, 101)]
+    assert percentile(values, 50) == 0.5
+    assert percentile(values, 95) == 0.95
+    assert percentile(values, 99) == 0.99
+    assert percentile([], 99) == 0.0
+    assert percentile([0.3], 50) == 0.3
+
+
+def test_compare_flags_p95_regressions():
+    baseline = {"endpoints": {"POST /message": {"p95_ms": 100.0}, "PUT /message/{id}": {"p95_ms": 10.0}}}
+    results = {"endpoints": {"POST /message": {"p95_ms": 150.0}, "PUT /message/{id}": {"p95_ms": 11.0}}}
+    regressions = compare(results, baseline, max_regression=0.2)
+    assert len(regressions) == 1
+    assert regressions[0].startswith("POST /message")
+
+
+def test_load_test_smoke():
+    results = run_load_test(concurrency=2, requests=6, llm_latency=0)
+    for endpoint in ("POST /message", "PUT /message/{id}", "DELETE /message/{id}"):
+        stats = results["endpoints"][endpoint]
+        assert stats["requests"] == 6
+        assert stats["errors"] == 0
+        assert stats["p99_ms"] >= stats["p50_ms"] > 0
+    assert results["throughput_rps"] > 0
+    assert "p99_ms" in results["event_loop_lag"]
+
+
+def test_server_thread_runs_on_the_requested_loop():
+    server = ServerThread(FastAPI(), free_port(), loop="uvloop").start()
+    try:
+        assert isinstance(server.loop, uvloop.Loop)
+    finally:
+        server.stop()
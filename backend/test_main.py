@@ -1,14 +1,42 @@
+import asyncio
+import json
+import statistics
+from datetime import datetime, timedelta, timezone
 from unittest.mock import MagicMock, patch
+import time
+from contextlib import asynccontextmanager
+from fastapi.testclient import TestClient
+from fastapi import FastAPI, WebSocketDisconnect
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.utils import create_model_field
+from starlette.middleware.base import BaseHTTPMiddleware
 from httpx import AsyncClient, ASGITransport
 from jose import JWTError
 import pytest
 import pytest_asyncio
+from sqlalchemy import event, insert, select
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 
-from main import app
+import llm_service
+from fake_openai import FakeOpenAI
+from instrumentation import LLM_TIME_TO_FIRST_TOKEN, STAGE_DURATION
+from idempotency import idempotency_store
+from jobs import JOB_LEASE_SECONDS, GenerationQueue, claim_job
+from knowledge import HashingEmbedder, KnowledgeBase, build_index
+from llm_backends import StubBackend
+from llm_router import LLMRouter, Route
+from llm_scheduler import LLMScheduler
+from message_cache import CACHE_REQUESTS, message_cache
+from rate_limit import InProcessRateLimitBackend, RateLimiter
+from response_cache import InProcessResponseCacheBackend, ResponseCache
+from main import app, cors_headers, origins, verifier
+from contracts import MessageContract, MessagePage
 from database import get_session
-from models import Base
+from models import Base, Conversation, MessageModel
+from crud_conversation import bump_versions
+from crud_message import encode_cursor
 
 # Create a separate async engine for tests (pointing to SQLite in memory)
 TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
@@ -37,13 +65,36 @@ async def mock_commit_error():
         session.commit = failing_commit
         yield session
 
-def mock_get_user_func(token):
+async def mock_verify_func(token):
     if token == 'valid_token':
-        return {"id": "test_user", "email": "user@example.com"}
+        return {"sub": "test_user", "email": "user@example.com"}
+    elif token == 'other_user_token':
+        return {"sub": "other_user", "email": "other@example.com"}
     else:
         raise JWTError()
     
-async def mock_create_func(model="", messages=""):
+class MockStream:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.closed = False
+
+    async def __aiter__(self):
+        for token in self.tokens:
+            mock_delta = MagicMock()
+            mock_delta.content = token
+            mock_choice = MagicMock()
+            mock_choice.delta = mock_delta
+            mock_chunk = MagicMock()
+            mock_chunk.choices = [mock_choice]
+            yield mock_chunk
+
+    async def close(self):
+        self.closed = True
+
+async def mock_create_func(model="", messages="", stream=False):
+    if stream:
+        return MockStream(["Mock ", "LLM ", "Response"])
+
     mock_content = MagicMock()
     mock_content.content = "Mock LLM Response"
     
@@ -68,6 +119,9 @@ async def prepare_database():
     # Drop the tables after tests are done
     async with engine_test.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
+    # Ids are reused by the next test's fresh tables
+    message_cache.clear()
+    idempotency_store.clear()
 
 @pytest.fixture
 def mock_openai_create():
@@ -76,13 +130,13 @@ def mock_openai_create():
         yield mock_create
 
 @pytest.fixture
-def mock_supabase_auth():
-    with patch("main.supabase.auth.get_user") as mock_get_user:
-        mock_get_user.side_effect = mock_get_user_func
-        yield mock_get_user
+def mock_token_verifier():
+    with patch("main.verifier.verify") as mock_verify:
+        mock_verify.side_effect = mock_verify_func
+        yield mock_verify
 
 @pytest_asyncio.fixture
-async def client(mock_supabase_auth, mock_openai_create):
+async def client(mock_token_verifier, mock_openai_create):
     """
     Overrides get_session, and returns a AsyncClient.
     """
@@ -96,7 +150,7 @@ async def client(mock_supabase_auth, mock_openai_create):
 
 
 @pytest_asyncio.fixture
-async def client_db_commit_error(mock_supabase_auth):
+async def client_db_commit_error(mock_token_verifier):
     """Mocks a database commit error"""
     app.dependency_overrides[get_session] = mock_commit_error
     async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as test_client:
@@ -106,7 +160,7 @@ async def client_db_commit_error(mock_supabase_auth):
 
 # Add this fixture
 @pytest_asyncio.fixture
-async def client_db_connect_error(mock_supabase_auth):
+async def client_db_connect_error(mock_token_verifier):
     """
     Creates a client that simulates a database connection error
     """
@@ -120,6 +174,29 @@ async def client_db_connect_error(mock_supabase_auth):
     
     app.dependency_overrides.clear()
 
+@asynccontextmanager
+async def query_plans(match: str):
+    """
+    Collects the EXPLAIN QUERY PLAN details of the statements run inside the block whose SQL
+    contains `match`.
+    """
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if match in statement and not statement.startswith("EXPLAIN"):
+            statements.append((statement, parameters))
+
+    plans = []
+    event.listen(engine_test.sync_engine, "before_cursor_execute", capture)
+    try:
+        yield plans
+    finally:
+        event.remove(engine_test.sync_engine, "before_cursor_execute", capture)
+    async with engine_test.connect() as conn:
+        for statement, parameters in statements:
+            rows = (await conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)).all()
+            plans.append(" ".join(row[-1] for row in rows))
+
 ######## Create Tests ###########
 
 @pytest.mark.asyncio
@@ -139,6 +216,22 @@ async def test_create_message_success(client: AsyncClient, prepare_database):
     assert data["exchange"][1]["message"] == "Mock LLM Response"
 
 
+@pytest.mark.asyncio
+async def test_create_message_llm_error_keeps_user_message(client: AsyncClient, prepare_database):
+    response = await client.post("/message", json={"message": "First"}, headers={'Authorization': 'Bearer valid_token'})
+    conversation_id = response.json()["exchange"][0]["conversation_id"]
+    assert response.json()["exchange"][0]["status"] == "complete"
+
+    with patch("llm_service.client.chat.completions.create", side_effect=Exception("OpenAI is down")):
+        response = await client.post("/message", json={"message": "Second", "conversation_id": conversation_id}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 500
+
+    response = await client.get(f"/conversations/{conversation_id}/messages", headers={'Authorization': 'Bearer valid_token'})
+    messages = response.json()["messages"]
+    assert messages[0]["message"] == "Second"
+    assert messages[0]["status"] == "failed"
+    assert len(messages) == 3
+
 @pytest.mark.asyncio
 async def test_create_message_db_connect_error(client_db_connect_error):
     response = await client_db_connect_error.post("/message", json={ "message": "Test message" }, headers={'Authorization': 'Bearer valid_token'})
@@ -183,6 +276,28 @@ async def test_create_message_wrong_message_type(client: AsyncClient, prepare_da
     assert response.status_code == 422
 
 
+@pytest.mark.asyncio
+async def test_create_message_idempotency_key(client: AsyncClient, mock_openai_create, prepare_database):
+    headers = {'Authorization': 'Bearer valid_token', 'Idempotency-Key': 'first-send'}
+    responses = await asyncio.gather(*(client.post("/message", json={"message": "Test message"}, headers=headers) for _ in range(3)))
+    assert all(r.status_code == 200 for r in responses)
+    assert len({r.text for r in responses}) == 1
+    assert [r.headers.get("Idempotent-Replayed") for r in responses].count("true") == 2
+
+    response = await client.post("/message", json={"message": "Test message"}, headers=headers)
+    assert response.json() == responses[0].json()
+    assert response.headers["Idempotent-Replayed"] == "true"
+    # One completion and one exchange for all four requests
+    assert mock_openai_create.call_count == 1
+    async with TestingSessionLocal() as session:
+        assert len((await session.scalars(select(MessageModel))).all()) == 2
+
+    response = await client.post("/message", json={"message": "Another message"}, headers=headers)
+    assert response.status_code == 422
+    # Keys belong to the user who sent them
+    response = await client.post("/message", json={"message": "Test message"}, headers={**headers, 'Authorization': 'Bearer other_user_token'})
+    assert "Idempotent-Replayed" not in response.headers
+
 ######## Update Tests ###########
 
 @pytest.mark.asyncio
@@ -193,6 +308,9 @@ async def test_update_message_success(client: AsyncClient, prepare_database):
     data = response.json()
     assert data["message"] == "Updated message"
 
+    async with TestingSessionLocal() as session:
+        assert (await session.get(MessageModel, 1)).updated_at is not None
+
 @pytest.mark.asyncio
 async def test_update_message_db_connect_error(client_db_connect_error: AsyncClient):
     response = await client_db_connect_error.put("/message/1", json={ "message": "Test message" }, headers={'Authorization': 'Bearer valid_token'})
@@ -257,6 +375,26 @@ async def test_delete_message_success(client: AsyncClient, prepare_database):
     assert response.status_code == 200
 
 
+@pytest.mark.asyncio
+async def test_delete_message_is_soft(client: AsyncClient, prepare_database):
+    response = await client.post("/message", json={"message": "Test Message"}, headers={'Authorization': 'Bearer valid_token'})
+    user_message = response.json()["exchange"][0]
+
+    response = await client.delete(f"/message/{user_message['id']}", headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 200
+
+    async with TestingSessionLocal() as session:
+        assert (await session.get(MessageModel, user_message["id"])).deleted_at is not None
+
+    # Deleted messages can no longer be read, edited or deleted again
+    response = await client.get(f"/conversations/{user_message['conversation_id']}/messages", headers={'Authorization': 'Bearer valid_token'})
+    assert [m["id"] for m in response.json()["messages"]] == [user_message["id"] + 1]
+    response = await client.put(f"/message/{user_message['id']}", json={"message": "Edited"}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 404
+    response = await client.delete(f"/message/{user_message['id']}", headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 404
+
+
 @pytest.mark.asyncio
 async def test_delete_message_noexistant_message_404_error(client: AsyncClient, prepare_database):
     response = await client.delete("/message/100", headers={'Authorization': 'Bearer valid_token'})
@@ -282,6 +420,665 @@ async def test_delete_message_db_connect_error(client_db_connect_error: AsyncCli
     data = response.json()
     assert "error" in data
 
+@pytest.mark.asyncio
+async def test_update_and_delete_other_users_message(client: AsyncClient, prepare_database):
+    response = await client.post("/message", json={"message": "Mine"}, headers={'Authorization': 'Bearer valid_token'})
+    message_id = response.json()["exchange"][0]["id"]
+
+    response = await client.put(f"/message/{message_id}", json={"message": "Edited"}, headers={'Authorization': 'Bearer other_user_token'})
+    assert response.status_code == 404
+    response = await client.delete(f"/message/{message_id}", headers={'Authorization': 'Bearer other_user_token'})
+    assert response.status_code == 404
+
+    async with TestingSessionLocal() as session:
+        message = await session.get(MessageModel, message_id)
+        assert (message.content, message.updated_at, message.deleted_at) == ("Mine", None, None)
+
+######## Export/Import Tests ###########
+
+@pytest.mark.asyncio
+async def test_export_then_import_round_trip(client: AsyncClient, prepare_database):
+    response = await client.post("/message", json={"message": "First"}, headers={'Authorization': 'Bearer valid_token'})
+    conversation_id = response.json()["exchange"][0]["conversation_id"]
+    await client.post("/message", json={"message": "Second", "conversation_id": conversation_id}, headers={'Authorization': 'Bearer valid_token'})
+    await client.post("/message", json={"message": "Not mine"}, headers={'Authorization': 'Bearer other_user_token'})
+
+    response = await client.get("/export", headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["message"] for line in lines] == ["First", "Mock LLM Response", "Second", "Mock LLM Response"]
+
+    body = response.text + "not json\n" + json.dumps({"author": "user", "message": " "}) + "\n"
+    response = await client.post("/import", content=body, headers={'Authorization': 'Bearer other_user_token'})
+    assert response.status_code == 200
+    result = response.json()
+    assert result["imported"] == 4
+    assert result["failed"] == 2
+    assert [error["line"] for error in result["errors"]] == [5, 6]
+
+    response = await client.get("/export", headers={'Authorization': 'Bearer other_user_token'})
+    imported = [json.loads(line) for line in response.text.splitlines()][2:]
+    assert [line["message"] for line in imported] == ["First", "Mock LLM Response", "Second", "Mock LLM Response"]
+    assert len({line["conversation_id"] for line in imported}) == 1
+    assert imported[0]["conversation_id"] != conversation_id
+    assert imported[0]["created_at"] == lines[0]["created_at"]
+
+@pytest.mark.asyncio
+async def test_export_other_users_conversation(client: AsyncClient, prepare_database):
+    response = await client.post("/message", json={"message": "Not mine"}, headers={'Authorization': 'Bearer other_user_token'})
+    conversation_id = response.json()["exchange"][0]["conversation_id"]
+
+    response = await client.get(f"/export?conversation_id={conversation_id}", headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 404
+
+######## Batch Tests ###########
+
+@pytest.mark.asyncio
+async def test_batch_edits_deletes_and_imports(client: AsyncClient, prepare_database):
+    response = await client.post("/message", json={"message": "First"}, headers={'Authorization': 'Bearer valid_token'})
+    user_message, reply = response.json()["exchange"]
+    response = await client.post("/message", json={"message": "Not mine"}, headers={'Authorization': 'Bearer other_user_token'})
+    other_message = response.json()["exchange"][0]
+
+    response = await client.post("/messages/batch", json={
+        "edits": [
+            {"id": user_message["id"], "message": "Edited"},
+            {"id": other_message["id"], "message": "Hijacked"},
+            {"id": user_message["id"], "message": "  "},
+        ],
+        "deletes": [reply["id"], 999],
+        "imports": [
+            {"author": "user", "message": "Imported question", "conversation_id": user_message["conversation_id"]},
+            {"author": "chatbot", "message": "Imported answer", "created_at": "2024-01-01T00:00:00Z"},
+            {"author": "user", "message": "Wrong conversation", "conversation_id": 999},
+        ],
+    }, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 200
+    data = response.json()
+
+    assert [r["status"] for r in data["edits"]] == [200, 404, 400]
+    assert [r["status"] for r in data["deletes"]] == [200, 404]
+    assert [r["status"] for r in data["imports"]] == [200, 200, 404]
+
+    async with TestingSessionLocal() as session:
+        assert (await session.get(MessageModel, user_message["id"])).content == "Edited"
+        assert (await session.get(MessageModel, other_message["id"])).content == "Not mine"
+        assert (await session.get(MessageModel, reply["id"])).deleted_at is not None
+
+        imported = await session.get(MessageModel, data["imports"][0]["id"])
+        assert imported.content == "Imported question"
+        assert imported.conversation_id == user_message["conversation_id"]
+        assert imported.user_id == "test_user"
+
+        new_conversation_message = await session.get(MessageModel, data["imports"][1]["id"])
+        assert new_conversation_message.author == "chatbot"
+        assert new_conversation_message.conversation_id not in (None, user_message["conversation_id"])
+        assert new_conversation_message.created_at.year == 2024
+
+@pytest.mark.asyncio
+async def test_batch_rejected_imports_start_no_conversation(client: AsyncClient, prepare_database):
+    response = await client.post("/messages/batch", json={
+        "imports": [{"author": "user", "message": " "}],
+    }, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 200
+    assert [r["status"] for r in response.json()["imports"]] == [400]
+
+    async with TestingSessionLocal() as session:
+        assert (await session.scalars(select(Conversation))).all() == []
+
+@pytest.mark.asyncio
+async def test_batch_too_large(client: AsyncClient, prepare_database, monkeypatch):
+    monkeypatch.setattr("main.MAX_BATCH_ITEMS", 2)
+    response = await client.post("/messages/batch", json={"deletes": [1, 2, 3]}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_batch_db_error_rolls_back(client_db_commit_error: AsyncClient, prepare_database):
+    response = await client_db_commit_error.post("/messages/batch", json={"deletes": [1]}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 500
+    assert response.json() == {'detail': 'An unexpected error occurred. Please try again later.'}
+
+######## History Tests ###########
+
+@pytest.mark.asyncio
+async def test_conversation_history_pagination(client: AsyncClient, prepare_database):
+    response = await client.post("/message", json={"message": "Message 0"}, headers={'Authorization': 'Bearer valid_token'})
+    conversation_id = response.json()["exchange"][0]["conversation_id"]
+    for i in range(1, 5):
+        response = await client.post("/message", json={"message": f"Message {i}", "conversation_id": conversation_id}, headers={'Authorization': 'Bearer valid_token'})
+        assert response.json()["exchange"][1]["conversation_id"] == conversation_id
+
+    # A message in another conversation must not show up
+    await client.post("/message", json={"message": "Elsewhere"}, headers={'Authorization': 'Bearer valid_token'})
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 3}
+        if cursor:
+            params["cursor"] = cursor
+        response = await client.get(f"/conversations/{conversation_id}/messages", params=params, headers={'Authorization': 'Bearer valid_token'})
+        assert response.status_code == 200
+        page = response.json()
+        seen.extend(page["messages"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    assert len(seen) == 10
+    assert [m["id"] for m in seen] == sorted((m["id"] for m in seen), reverse=True)
+    assert seen[-1]["message"] == "Message 0"
+    assert seen[0]["message"] == "Mock LLM Response"
+
+@pytest.mark.asyncio
+async def test_conversation_history_other_user(client: AsyncClient, prepare_database):
+    response = await client.post("/message", json={"message": "Test message"}, headers={'Authorization': 'Bearer valid_token'})
+    conversation_id = response.json()["exchange"][0]["conversation_id"]
+
+    response = await client.get(f"/conversations/{conversation_id}/messages", headers={'Authorization': 'Bearer other_user_token'})
+    assert response.status_code == 404
+
+    response = await client.post("/message", json={"message": "Test message", "conversation_id": conversation_id}, headers={'Authorization': 'Bearer other_user_token'})
+    assert response.status_code == 404
+
+@pytest.mark.asyncio
+async def test_conversation_history_invalid_cursor(client: AsyncClient, prepare_database):
+    response = await client.post("/message", json={"message": "Test message"}, headers={'Authorization': 'Bearer valid_token'})
+    conversation_id = response.json()["exchange"][0]["conversation_id"]
+
+    response = await client.get(f"/conversations/{conversation_id}/messages", params={"cursor": "not-a-cursor"}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_conversation_history_served_from_cache(client: AsyncClient, prepare_database):
+    headers = {'Authorization': 'Bearer valid_token'}
+    response = await client.post("/message", json={"message": "Message 0"}, headers=headers)
+    conversation_id = response.json()["exchange"][0]["conversation_id"]
+    response = await client.post("/message", json={"message": "Message 1", "conversation_id": conversation_id}, headers=headers)
+    user_message_id, reply_id = (m["id"] for m in response.json()["exchange"])
+
+    async def history():
+        response = await client.get(f"/conversations/{conversation_id}/messages", headers=headers)
+        return [m["message"] for m in response.json()["messages"]]
+
+    hits = CACHE_REQUESTS.value(result="hit")
+    assert await history() == ["Mock LLM Response", "Message 1", "Mock LLM Response", "Message 0"]
+    assert CACHE_REQUESTS.value(result="hit") == hits + 1
+
+    # Edits and deletes through the API are written through to the cache
+    await client.put(f"/message/{user_message_id}", json={"message": "Edited"}, headers=headers)
+    await client.delete(f"/message/{reply_id}", headers=headers)
+    assert await history() == ["Edited", "Mock LLM Response", "Message 0"]
+    assert CACHE_REQUESTS.value(result="hit") == hits + 2
+
+    # A write from another worker bumps the version, so the cached copy is not served
+    async with TestingSessionLocal() as session:
+        message = await session.get(MessageModel, user_message_id)
+        message.content = "Edited elsewhere"
+        await bump_versions([conversation_id], session)
+        await session.commit()
+    assert await history() == ["Edited elsewhere", "Mock LLM Response", "Message 0"]
+
+######## Search Tests ###########
+
+@pytest.mark.asyncio
+async def test_search_messages(client: AsyncClient, prepare_database):
+    headers = {'Authorization': 'Bearer valid_token'}
+    response = await client.post("/message", json={"message": "How do I bake sourdough bread?"}, headers=headers)
+    conversation_id = response.json()["exchange"][0]["conversation_id"]
+    await client.post("/message", json={"message": "Sourdough, sourdough, sourdough!", "conversation_id": conversation_id}, headers=headers)
+    response = await client.post("/message", json={"message": "Is rye sourdough different?"}, headers=headers)
+    rye_id = response.json()["exchange"][0]["id"]
+    await client.post("/message", json={"message": "Not mine: sourdough"}, headers={'Authorization': 'Bearer other_user_token'})
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"q": "sourdough", "limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = await client.get("/search", params=params, headers=headers)
+        assert response.status_code == 200
+        page = response.json()
+        seen.extend(page["messages"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    # Across conversations, best match first, never another user's
+    assert seen[0]["message"] == "Sourdough, sourdough, sourdough!"
+    assert sorted(m["message"] for m in seen) == ["How do I bake sourdough bread?", "Is rye sourdough different?", "Sourdough, sourdough, sourdough!"]
+
+    # Every word must match
+    response = await client.get("/search", params={"q": "rye sourdough"}, headers=headers)
+    assert [m["id"] for m in response.json()["messages"]] == [rye_id]
+
+    # Edits are reindexed and deleted messages drop out
+    await client.put(f"/message/{rye_id}", json={"message": "Is rye bread different?"}, headers=headers)
+    response = await client.get("/search", params={"q": "rye"}, headers=headers)
+    assert [m["message"] for m in response.json()["messages"]] == ["Is rye bread different?"]
+    await client.delete(f"/message/{rye_id}", headers=headers)
+    response = await client.get("/search", params={"q": "rye"}, headers=headers)
+    assert response.json()["messages"] == []
+
+@pytest.mark.asyncio
+async def test_search_invalid_requests(client: AsyncClient, prepare_database):
+    headers = {'Authorization': 'Bearer valid_token'}
+    response = await client.get("/search", params={"q": "  "}, headers=headers)
+    assert response.status_code == 400
+    response = await client.get("/search", params={"q": "bread", "cursor": "not-a-cursor"}, headers=headers)
+    assert response.status_code == 400
+    # FTS syntax in the query is searched for literally rather than failing
+    response = await client.get("/search", params={"q": 'bread" OR ('}, headers=headers)
+    assert response.status_code == 200
+
+######## Context Tests ###########
+
+@pytest.mark.asyncio
+async def test_context_includes_history(client: AsyncClient, mock_openai_create, prepare_database):
+    response = await client.post("/message", json={"message": "My name is Ada"}, headers={'Authorization': 'Bearer valid_token'})
+    conversation_id = response.json()["exchange"][0]["conversation_id"]
+    await client.post("/message", json={"message": "What is my name?", "conversation_id": conversation_id}, headers={'Authorization': 'Bearer valid_token'})
+
+    messages = mock_openai_create.call_args.kwargs["messages"]
+    assert [m["role"] for m in messages] == ["system", "user", "assistant", "user"]
+    assert messages[1]["content"] == "My name is Ada"
+    assert messages[-1]["content"] == "What is my name?"
+
+@pytest.mark.asyncio
+async def test_context_folds_old_turns_into_summary(client: AsyncClient, mock_openai_create, prepare_database, monkeypatch):
+    # Each turn is about 25 tokens, so only a handful fit in the budget
+    monkeypatch.setattr(llm_service, "CONTEXT_TOKEN_BUDGET", 120)
+    response = await client.post("/message", json={"message": "x" * 80}, headers={'Authorization': 'Bearer valid_token'})
+    conversation_id = response.json()["exchange"][0]["conversation_id"]
+
+    summary_calls = 0
+    for _ in range(10):
+        mock_openai_create.reset_mock()
+        await client.post("/message", json={"message": "x" * 80, "conversation_id": conversation_id}, headers={'Authorization': 'Bearer valid_token'})
+        system_prompts = [call.kwargs["messages"][0]["content"] for call in mock_openai_create.call_args_list]
+        summary_calls += system_prompts.count(llm_service.SUMMARY_PROMPT)
+
+        history = mock_openai_create.call_args.kwargs["messages"][1:-1]
+        assert sum(llm_service.count_message_tokens(m) for m in history) <= 120
+
+    # The summary is extended every few turns, not regenerated on every request
+    assert 0 < summary_calls < 10
+    assert history[0]["content"].startswith("Summary of the earlier conversation")
+
+    async with TestingSessionLocal() as session:
+        conversation = await session.get(Conversation, conversation_id)
+        assert conversation.summary == "Mock LLM Response"
+        assert conversation.summary_through_id is not None
+
+@pytest.mark.asyncio
+async def test_context_includes_knowledge(client: AsyncClient, mock_openai_create, prepare_database, monkeypatch, tmp_path):
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "company.md").write_text("Artisan was founded in 2023.\n\n" + "Unrelated filler text. " * 300)
+    embedder = HashingEmbedder()
+    await build_index(str(tmp_path / "docs"), str(tmp_path / "index"), embedder)
+    monkeypatch.setattr(llm_service, "knowledge_base", KnowledgeBase.open(str(tmp_path / "index"), embedder), raising=False)
+
+    await client.post("/message", json={"message": "When was Artisan founded?"}, headers={'Authorization': 'Bearer valid_token'})
+    messages = mock_openai_create.call_args.kwargs["messages"]
+    assert [m["role"] for m in messages] == ["system", "system", "user"]
+    assert messages[1]["content"].startswith(llm_service.KNOWLEDGE_PROMPT)
+    assert "Artisan was founded in 2023." in messages[1]["content"]
+    assert "filler" not in messages[1]["content"]
+
+######## Rate Limit Tests ###########
+
+@pytest.mark.asyncio
+async def test_create_message_openai_rate_limited(client: AsyncClient, prepare_database, monkeypatch):
+    fake = FakeOpenAI(rate_limit_first=100, retry_after=2)
+    monkeypatch.setattr(llm_service, "client", fake.client())
+    monkeypatch.setattr(llm_service, "scheduler", LLMScheduler(max_retries=1))
+    monkeypatch.setattr(llm_service.scheduler, "backoff", lambda attempt, retry_after=None: 0)
+
+    response = await client.post("/message", json={"message": "Test message"}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "2"
+    # The primary model fails over at once; the fast model, the last to try, gets the retry
+    assert fake.calls == 3
+
+@pytest.mark.asyncio
+async def test_create_message_with_stub_backend(client: AsyncClient, prepare_database, monkeypatch):
+    backend = StubBackend()
+    monkeypatch.setattr(llm_service, "router", LLMRouter(Route(backend, llm_service.MODEL), fast=Route(backend, llm_service.FAST_MODEL)))
+
+    response = await client.post("/message", json={"message": "Hi"}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 200
+    reply = response.json()["exchange"][1]["message"]
+    assert reply == StubBackend.reply(llm_service.FAST_MODEL, llm_service.build_messages("Hi"))
+
+######## Per-User Rate Limit Tests ###########
+
+async def count_messages():
+    async with TestingSessionLocal() as session:
+        return len((await session.scalars(select(MessageModel))).all())
+
+@pytest.mark.asyncio
+async def test_rate_limit_rejects_before_any_work(client: AsyncClient, prepare_database, monkeypatch):
+    monkeypatch.setattr("main.rate_limiter", RateLimiter(InProcessRateLimitBackend(), requests_per_second=0.001, burst=1))
+
+    response = await client.post("/message", json={"message": "First"}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 200
+    messages = await count_messages()
+
+    response = await client.post("/message", json={"message": "Second"}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+    assert await count_messages() == messages
+
+    # Another user is not affected
+    response = await client.post("/message", json={"message": "Hello"}, headers={'Authorization': 'Bearer other_user_token'})
+    assert response.status_code == 200
+
+@pytest.mark.asyncio
+async def test_llm_token_quota(client: AsyncClient, prepare_database, monkeypatch):
+    monkeypatch.setattr("main.rate_limiter", RateLimiter(InProcessRateLimitBackend(), tokens_per_day=100))
+
+    response = await client.post("/message", json={"message": "First"}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 200
+    message_id = response.json()["exchange"][0]["id"]
+
+    response = await client.post("/message", json={"message": "Second"}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 429
+
+    # Only requests that call the LLM count against the quota
+    response = await client.put(f"/message/{message_id}", json={"message": "Edited"}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 200
+
+######## Background Generation Tests ###########
+
+@pytest.mark.asyncio
+async def test_async_message_is_answered_in_the_background(client: AsyncClient, prepare_database, monkeypatch):
+    response = await client.post("/message", json={"message": "First"}, headers={'Authorization': 'Bearer valid_token'})
+    conversation_id = response.json()["exchange"][0]["conversation_id"]
+
+    response = await client.post("/message/async", json={"message": "Second", "conversation_id": conversation_id}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 202
+    user_message = response.json()
+    assert user_message["status"] == "queued"
+    assert response.headers["Location"] == f"/message/{user_message['id']}/reply"
+
+    # Started only now: the in-memory test database is a single connection shared by every session
+    queue = GenerationQueue(TestingSessionLocal, workers=2, poll_interval=0.05)
+    monkeypatch.setattr("main.generation_queue", queue)
+    queue.start()
+    try:
+        response = await client.get(f"/message/{user_message['id']}/reply?wait=5", headers={'Authorization': 'Bearer valid_token'})
+    finally:
+        await queue.stop()
+    assert response.status_code == 200
+    reply = response.json()
+    assert reply["author"] == "chatbot"
+    assert reply["message"] == "Mock LLM Response"
+
+    # The prompt was answered with the earlier turns as context, but without itself
+    messages = llm_service.client.chat.completions.create.call_args.kwargs["messages"]
+    assert [m["content"] for m in messages[1:]] == ["First", "Mock LLM Response", "Second"]
+
+    response = await client.get(f"/message/{user_message['id']}/reply", headers={'Authorization': 'Bearer other_user_token'})
+    assert response.status_code == 404
+
+@pytest.mark.asyncio
+async def test_reply_is_found_through_its_index(client: AsyncClient, prepare_database):
+    response = await client.post("/message", json={"message": "Hello"}, headers={'Authorization': 'Bearer valid_token'})
+    user_message, reply = response.json()["exchange"]
+
+    async with query_plans("reply_to_id = ") as plans:
+        response = await client.get(f"/message/{user_message['id']}/reply", headers={'Authorization': 'Bearer valid_token'})
+    assert response.json()["id"] == reply["id"]
+    assert plans and all("ix_message_reply_to_id" in plan for plan in plans)
+
+@pytest.mark.asyncio
+async def test_async_message_pending_then_failed(client: AsyncClient, prepare_database):
+    response = await client.post("/message/async", json={"message": "Hello"}, headers={'Authorization': 'Bearer valid_token'})
+    message_id = response.json()["id"]
+
+    # Nothing is consuming the queue yet
+    response = await client.get(f"/message/{message_id}/reply", headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 202
+    assert response.headers["Retry-After"] == "1"
+    assert response.json()["status"] == "queued"
+
+    queue = GenerationQueue(TestingSessionLocal, workers=1, poll_interval=0.05)
+    with patch("llm_service.client.chat.completions.create", side_effect=Exception("OpenAI is down")):
+        queue.start()
+        await queue.wait_for(message_id, 5)
+        await queue.stop()
+
+    response = await client.get(f"/message/{message_id}/reply", headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 500
+
+    async with TestingSessionLocal() as session:
+        assert (await session.get(MessageModel, message_id)).status == "failed"
+
+@pytest.mark.asyncio
+async def test_abandoned_jobs_are_claimed_again(client: AsyncClient, prepare_database):
+    response = await client.post("/message/async", json={"message": "Hello"}, headers={'Authorization': 'Bearer valid_token'})
+    message_id = response.json()["id"]
+
+    # Claimed by a worker that then went away
+    async with TestingSessionLocal() as session:
+        assert (await claim_job(session)).id == message_id
+        assert await claim_job(session) is None
+        assert (await claim_job(session, lease=-1)).id == message_id
+
+    queue = GenerationQueue(TestingSessionLocal, workers=1, poll_interval=0.05)
+    async with TestingSessionLocal() as session:
+        message = await session.get(MessageModel, message_id)
+        message.claimed_at = datetime.now(timezone.utc) - timedelta(seconds=JOB_LEASE_SECONDS + 1)
+        await session.commit()
+    queue.start()
+    try:
+        response = await client.get(f"/message/{message_id}/reply?wait=5", headers={'Authorization': 'Bearer valid_token'})
+    finally:
+        await queue.stop()
+    assert response.status_code == 200
+    assert response.json()["message"] == "Mock LLM Response"
+
+@pytest.mark.asyncio
+async def test_claim_job_reads_only_the_job_index(prepare_database):
+    async with TestingSessionLocal() as session:
+        async with query_plans("status IN") as plans:
+            assert await claim_job(session) is None
+    assert plans and all("ix_message_jobs" in plan for plan in plans)
+
+@pytest.mark.asyncio
+async def test_wait_for_wakes_every_waiter_and_rechecks():
+    queue = GenerationQueue(TestingSessionLocal, workers=0)
+
+    async def done():
+        return True
+
+    # A job that finished before the wait was registered is not waited on
+    start = time.perf_counter()
+    await queue.wait_for(1, 5, done)
+    assert time.perf_counter() - start < 1
+
+    waiters = [asyncio.create_task(queue.wait_for(1, 5)) for _ in range(2)]
+    await asyncio.sleep(0)
+    assert len(queue._waiters[1]) == 2
+    for event in queue._waiters[1]:
+        event.set()
+    await asyncio.wait_for(asyncio.gather(*waiters), 1)
+    assert queue._waiters == {}
+
+######## Response Cache Tests ###########
+
+@pytest.mark.asyncio
+async def test_response_cache_hit_skips_openai(client: AsyncClient, mock_openai_create, prepare_database, monkeypatch):
+    cache = ResponseCache(InProcessResponseCacheBackend(maxsize=10, ttl=60), ttl=60)
+    monkeypatch.setattr(llm_service, "response_cache", cache)
+
+    await client.post("/message", json={"message": "What does Artisan do?"}, headers={'Authorization': 'Bearer valid_token'})
+    assert mock_openai_create.call_count == 1
+
+    response = await client.post("/message", json={"message": "  what does artisan DO? "}, headers={'Authorization': 'Bearer valid_token'})
+    assert mock_openai_create.call_count == 1
+    assert cache.hits == 1
+
+    # Hits are still persisted as a normal exchange
+    data = response.json()
+    assert data["exchange"][1]["message"] == "Mock LLM Response"
+    response = await client.get(f"/conversations/{data['exchange'][0]['conversation_id']}/messages", headers={'Authorization': 'Bearer valid_token'})
+    assert len(response.json()["messages"]) == 2
+
+@pytest.mark.asyncio
+async def test_response_cache_is_keyed_on_the_answering_model(client: AsyncClient, mock_openai_create, prepare_database, monkeypatch):
+    cache = ResponseCache(InProcessResponseCacheBackend(maxsize=10, ttl=60), ttl=60)
+    monkeypatch.setattr(llm_service, "response_cache", cache)
+
+    # Short prompts are answered by the fast model
+    await client.post("/message", json={"message": "Hi"}, headers={'Authorization': 'Bearer valid_token'})
+    assert mock_openai_create.call_args.kwargs["model"] == llm_service.FAST_MODEL
+    assert await cache.get("Hi", llm_service.SYSTEM_PROMPT, llm_service.FAST_MODEL) == "Mock LLM Response"
+    assert await cache.get("Hi", llm_service.SYSTEM_PROMPT, llm_service.MODEL) is None
+
+class FakeKnowledgeBase:
+    def __init__(self, snippets=None, error=None):
+        self.snippets = snippets or []
+        self.error = error
+
+    async def retrieve(self, queries, k, min_score=None):
+        if self.error is not None:
+            raise self.error
+        return [[MagicMock(text=text) for text in self.snippets] for _ in queries]
+
+@pytest.mark.asyncio
+async def test_response_cache_is_keyed_on_the_knowledge_used(client: AsyncClient, mock_openai_create, prepare_database, monkeypatch):
+    cache = ResponseCache(InProcessResponseCacheBackend(maxsize=10, ttl=60), ttl=60)
+    monkeypatch.setattr(llm_service, "response_cache", cache)
+    headers = {'Authorization': 'Bearer valid_token'}
+
+    monkeypatch.setattr(llm_service, "knowledge_base", FakeKnowledgeBase(["Artisan was founded in 2023."]), raising=False)
+    await client.post("/message", json={"message": "When was Artisan founded?"}, headers=headers)
+    await client.post("/message", json={"message": "When was Artisan founded?"}, headers=headers)
+    assert mock_openai_create.call_count == 1
+
+    # A rebuilt index grounds the same prompt in other snippets
+    monkeypatch.setattr(llm_service, "knowledge_base", FakeKnowledgeBase(["Artisan was founded in 2022."]), raising=False)
+    await client.post("/message", json={"message": "When was Artisan founded?"}, headers=headers)
+    assert mock_openai_create.call_count == 2
+
+    # Replies written without the knowledge base are neither served from nor stored in the cache
+    monkeypatch.setattr(llm_service, "knowledge_base", FakeKnowledgeBase(error=OSError("index unreadable")), raising=False)
+    await client.post("/message", json={"message": "When was Artisan founded?"}, headers=headers)
+    await client.post("/message", json={"message": "When was Artisan founded?"}, headers=headers)
+    assert mock_openai_create.call_count == 4
+    assert cache.hits == 1
+
+######## Streaming Tests ###########
+
+def parse_sse(body: str):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+@pytest.mark.asyncio
+async def test_stream_message_success(client: AsyncClient, prepare_database):
+    response = await client.post("/message/stream", json={"message": "Test message"}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+
+    events = parse_sse(response.text)
+    tokens = [data["token"] for event, data in events if event == "token"]
+    assert "".join(tokens) == "Mock LLM Response"
+
+    event, data = events[-1]
+    assert event == "done"
+    assert data["exchange"][0]["message"] == "Test message"
+    assert data["exchange"][1]["message"] == "Mock LLM Response"
+
+    # Both messages were persisted
+    response = await client.put(f"/message/{data['exchange'][1]['id']}", json={"message": "Edited"}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 200
+
+@pytest.mark.asyncio
+async def test_stream_empty_message(client: AsyncClient, prepare_database):
+    response = await client.post("/message/stream", json={"message": "  "}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_stream_persists_partial_reply_on_error(client: AsyncClient, prepare_database):
+    class FailingStream(MockStream):
+        async def __aiter__(self):
+            async for chunk in super().__aiter__():
+                yield chunk
+            raise Exception("Upstream connection reset")
+
+    async def failing_create(model="", messages="", stream=False):
+        return FailingStream(["Partial "])
+
+    with patch("llm_service.client.chat.completions.create", side_effect=failing_create):
+        response = await client.post("/message/stream", json={"message": "Test message"}, headers={'Authorization': 'Bearer valid_token'})
+
+    events = parse_sse(response.text)
+    assert events[-1][0] == "error"
+
+    response = await client.put("/message/2", json={"message": "Edited"}, headers={'Authorization': 'Bearer valid_token'})
+    assert response.status_code == 200
+
+@pytest.mark.asyncio
+async def test_stream_message_websocket(mock_token_verifier, mock_openai_create, prepare_database):
+    app.dependency_overrides[get_session] = override_get_session
+    try:
+        with TestClient(app) as test_client:
+            with pytest.raises(WebSocketDisconnect):
+                with test_client.websocket_connect("/message/ws?token=invalid_token") as websocket:
+                    websocket.receive_json()
+
+            with test_client.websocket_connect("/message/ws?token=valid_token") as websocket:
+                websocket.send_json({"message": "Test message"})
+                frames = []
+                while not frames or frames[-1]["type"] == "token":
+                    frames.append(websocket.receive_json())
+    finally:
+        app.dependency_overrides.clear()
+
+    assert "".join(f["token"] for f in frames[:-1]) == "Mock LLM Response"
+    assert frames[-1]["type"] == "done"
+    assert frames[-1]["exchange"][0]["message"] == "Test message"
+
+@pytest.mark.asyncio
+async def test_websocket_turns_see_edits_made_between_them(mock_token_verifier, mock_openai_create, prepare_database):
+    app.dependency_overrides[get_session] = override_get_session
+    headers = {'Authorization': 'Bearer valid_token'}
+
+    def send(websocket, message):
+        websocket.send_json(message)
+        frames = []
+        while not frames or frames[-1]["type"] == "token":
+            frames.append(websocket.receive_json())
+        return frames[-1]
+
+    try:
+        with TestClient(app) as test_client:
+            with test_client.websocket_connect("/message/ws?token=valid_token") as websocket:
+                exchange = send(websocket, {"message": "First message"})["exchange"]
+                conversation_id = exchange[0]["conversation_id"]
+                # Reads the conversation into the message cache at its current version
+                send(websocket, {"message": "Second message", "conversation_id": conversation_id})
+
+                response = test_client.put(f"/message/{exchange[0]['id']}", json={"message": "Edited message"}, headers=headers)
+                assert response.status_code == 200
+
+                hits = CACHE_REQUESTS.value(result="hit")
+                send(websocket, {"message": "Third message", "conversation_id": conversation_id})
+    finally:
+        app.dependency_overrides.clear()
+
+    # The turn loaded the conversation's current version, which the cache was kept at
+    assert CACHE_REQUESTS.value(result="hit") == hits + 1
+    contents = [m["content"] for m in mock_openai_create.call_args.kwargs["messages"]]
+    assert "Edited message" in contents
+    assert "First message" not in contents
+
 ####### AUTH Middleware #########
 
 @pytest.mark.asyncio
@@ -296,4 +1093,163 @@ async def test_token_invalid(client: AsyncClient):
     response = await client.delete("/message/1", headers={'Authorization': 'Bearer invalid_token'})
     assert response.status_code == 401
     data = response.json()
-    assert data["detail"] == "Invalid token"
\ No newline at end of file
+    assert data["detail"] == "Invalid token"
+
+####### Metrics #########
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(client: AsyncClient, monkeypatch):
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert "db_pool_checkout_wait_seconds" in response.text
+    assert "db_pool_checked_out" in response.text
+
+    monkeypatch.setenv("METRICS_TOKEN", "scrape-secret")
+    response = await client.get("/metrics")
+    assert response.status_code == 401
+    response = await client.get("/metrics", headers={'Authorization': 'Bearer scrape-secret'})
+    assert response.status_code == 200
+
+@pytest.mark.asyncio
+async def test_metrics_record_request_stages(client: AsyncClient, prepare_database):
+    auth_count = STAGE_DURATION.count(stage="auth")
+    completion_count = STAGE_DURATION.count(stage="llm_completion")
+    # Short prompts are answered by the fast model
+    first_token_count = LLM_TIME_TO_FIRST_TOKEN.count(model=llm_service.FAST_MODEL)
+
+    await client.post("/message", json={"message": "Test message"}, headers={'Authorization': 'Bearer valid_token'})
+    await client.post("/message/stream", json={"message": "Test message"}, headers={'Authorization': 'Bearer valid_token'})
+
+    assert STAGE_DURATION.count(stage="auth") == auth_count + 2
+    assert STAGE_DURATION.count(stage="llm_completion") == completion_count + 1
+    assert LLM_TIME_TO_FIRST_TOKEN.count(model=llm_service.FAST_MODEL) == first_token_count + 1
+
+    response = await client.get("/metrics")
+    assert 'request_stage_duration_seconds_count{stage="llm_stream"}' in response.text
+    assert 'llm_tokens_total{model="gpt-4o-mini",kind="completion"}' in response.text
+    assert 'llm_routed_total{backend="openai",model="gpt-4o-mini"}' in response.text
+
+####### Benchmarks #########
+
+class LegacyAuthMiddleware(BaseHTTPMiddleware):
+    """The BaseHTTPMiddleware-based AuthMiddleware that the pure ASGI one replaced."""
+    async def dispatch(self, request, call_next):
+        if request.method == "OPTIONS":
+            return await call_next(request)
+        token = request.headers.get("Authorization")
+        if not token:
+            return JSONResponse(status_code=401, content={"detail": "Authorization token missing"}, headers=cors_headers)
+        try:
+            request.state.user = await verifier.verify(token.split(" ")[-1])
+        except JWTError:
+            return JSONResponse(status_code=401, content={"detail": "Invalid token"}, headers=cors_headers)
+        return await call_next(request)
+
+def build_legacy_app() -> FastAPI:
+    legacy_app = FastAPI()
+    legacy_app.include_router(app.router)
+    legacy_app.dependency_overrides = app.dependency_overrides
+    legacy_app.exception_handlers.update(app.exception_handlers)
+    legacy_app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+    legacy_app.add_middleware(LegacyAuthMiddleware)
+    return legacy_app
+
+async def measure_put_requests_per_second(asgi_app, requests: int) -> float:
+    async with AsyncClient(transport=ASGITransport(app=asgi_app), base_url="http://test") as test_client:
+        response = await test_client.post("/message", json={"message": "Test message"}, headers={'Authorization': 'Bearer valid_token'})
+        message_id = response.json()["exchange"][0]["id"]
+
+        # Warm up
+        for _ in range(20):
+            await test_client.put(f"/message/{message_id}", json={"message": "Warm up"}, headers={'Authorization': 'Bearer valid_token'})
+
+        start = time.perf_counter()
+        for i in range(requests):
+            response = await test_client.put(f"/message/{message_id}", json={"message": f"Edit {i}"}, headers={'Authorization': 'Bearer valid_token'})
+            assert response.status_code == 200
+        return requests / (time.perf_counter() - start)
+
+@pytest.mark.asyncio
+async def test_benchmark_auth_middleware_put_message(client: AsyncClient, prepare_database):
+    requests = 300
+    legacy_rps = await measure_put_requests_per_second(build_legacy_app(), requests)
+    asgi_rps = await measure_put_requests_per_second(app, requests)
+    # Generous margin so the assertion only trips on a real regression, not on noise
+    assert asgi_rps > legacy_rps * 0.9, f"PUT /message/{{id}}: BaseHTTPMiddleware {legacy_rps:.0f} req/s, pure ASGI {asgi_rps:.0f} req/s"
+
+async def seed_conversation(user_id: str, message_count: int) -> int:
+    async with TestingSessionLocal() as session:
+        conversation = Conversation(user_id=user_id)
+        session.add(conversation)
+        await session.flush()
+        start = datetime.now(timezone.utc) - timedelta(seconds=message_count)
+        await session.execute(insert(MessageModel), [
+            {
+                "author": "user" if i % 2 == 0 else "chatbot",
+                "content": f"Message {i}",
+                "conversation_id": conversation.id,
+                "user_id": user_id,
+                "created_at": start + timedelta(seconds=i),
+            }
+            for i in range(message_count)
+        ])
+        await session.commit()
+        return conversation.id
+
+@pytest.mark.asyncio
+async def test_benchmark_history_page_latency_is_flat(client: AsyncClient, prepare_database, monkeypatch):
+    message_count = 100_000
+    conversation_id = await seed_conversation("test_user", message_count)
+    # The newest pages are served by the conversation cache; time the database query at both depths
+    monkeypatch.setattr(message_cache, "get", lambda conversation_id, version: None)
+
+    async with TestingSessionLocal() as session:
+        rows = (await session.scalars(
+            select(MessageModel).where(MessageModel.conversation_id == conversation_id).order_by(MessageModel.id.desc())
+        )).all()
+
+    async def page_latency(depth: int) -> float:
+        params = {"limit": 50, "cursor": encode_cursor(rows[depth - 1])}
+        timings = []
+        for _ in range(10):
+            start = time.perf_counter()
+            response = await client.get(f"/conversations/{conversation_id}/messages", params=params, headers={'Authorization': 'Bearer valid_token'})
+            timings.append(time.perf_counter() - start)
+            assert response.status_code == 200
+            assert len(response.json()["messages"]) == 50
+        return statistics.median(timings)
+
+    latencies = {depth: await page_latency(depth) for depth in (50, 1_000, 50_000, 99_000)}
+    # Keyset pagination: the deepest page costs about the same as the second one
+    assert latencies[99_000] < latencies[50] * 3, "History page latency by depth: " + ", ".join(f"{d}: {t * 1000:.1f}ms" for d, t in latencies.items())
+
+def test_benchmark_message_page_serialization():
+    messages = [
+        MessageModel(id=i, author="user" if i % 2 else "chatbot", content=f"Message number {i} " * 5, conversation_id=1, status="complete")
+        for i in range(10_000)
+    ]
+    # What FastAPI does with a returned model: validate it against the response model, then serialize it
+    response_field = create_model_field(name="Response_page", type_=MessagePage, mode="serialization")
+
+    def legacy() -> bytes:
+        page = MessagePage(messages=[MessageContract(
+            id=m.id, author=m.author, message=m.content, conversation_id=m.conversation_id, status=m.status
+        ) for m in messages], next_cursor=None)
+        value, _ = response_field.validate(page, {}, loc=("response",))
+        return JSONResponse(response_field.serialize(value, mode="json")).body
+
+    def lean() -> bytes:
+        return ORJSONResponse(MessagePage.dump_models(messages, None)).body
+
+    assert json.loads(legacy()) == json.loads(lean())
+
+    def best_of(serialize) -> float:
+        timings = []
+        for _ in range(5):
+            start = time.perf_counter()
+            serialize()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    legacy_time, lean_time = best_of(legacy), best_of(lean)
+    assert lean_time * 2 < legacy_time, f"10k message page: legacy {legacy_time * 1000:.1f}ms, lean {lean_time * 1000:.1f}ms"
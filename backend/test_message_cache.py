@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from crud_conversation import bump_versions
+from message_cache import CACHE_REQUESTS, ConversationCache
+from models import Base, Conversation, MessageModel
+
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest_asyncio.fixture
+async def session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)() as session:
+        yield session
+    await engine.dispose()
+
+
+async def seed(session, count):
+    conversation = Conversation(user_id="user")
+    session.add(conversation)
+    await session.flush()
+    session.add_all([
+        MessageModel(author="user", content=f"Message {i}", conversation_id=conversation.id, created_at=START + timedelta(seconds=i))
+        for i in range(count)
+    ])
+    await session.commit()
+    return conversation
+
+
+def message(message_id, conversation_id, seconds, content="New"):
+    return MessageModel(id=message_id, author="user", content=content, conversation_id=conversation_id, status="complete", created_at=START + timedelta(seconds=seconds))
+
+
+@pytest.mark.asyncio
+async def test_recent_loads_the_window_once_per_version(session):
+    conversation = await seed(session, 5)
+    cache = ConversationCache(maxsize=10, window=3, ttl=60)
+    hits, misses, stale = (CACHE_REQUESTS.value(result=r) for r in ("hit", "miss", "stale"))
+
+    entry = await cache.recent(conversation.id, 0, session)
+    assert [m.content for m in entry.messages] == ["Message 4", "Message 3", "Message 2"]
+    assert not entry.complete
+    assert await cache.recent(conversation.id, 0, session) is entry
+
+    # A newer version means another worker wrote to the conversation
+    entry = await cache.recent(conversation.id, 1, session)
+    assert entry.version == 1
+
+    assert CACHE_REQUESTS.value(result="hit") == hits + 1
+    assert CACHE_REQUESTS.value(result="miss") == misses + 1
+    assert CACHE_REQUESTS.value(result="stale") == stale + 1
+
+
+@pytest.mark.asyncio
+async def test_write_through_applies_the_next_version_only(session):
+    conversation = await seed(session, 2)
+    cache = ConversationCache(maxsize=10, window=3, ttl=60)
+    entry = await cache.recent(conversation.id, 0, session)
+    assert entry.complete
+    first, second = entry.messages[1].id, entry.messages[0].id
+
+    cache.write_through(conversation.id, 1, upserts=[message(100, conversation.id, 10)], removed_ids=[first])
+    entry = cache.get(conversation.id, 1)
+    assert [m.id for m in entry.messages] == [100, second]
+    assert entry.complete
+
+    # Edits replace the cached copy
+    cache.write_through(conversation.id, 2, upserts=[message(second, conversation.id, 1, content="Edited")])
+    assert [m.content for m in cache.get(conversation.id, 2).messages] == ["New", "Edited"]
+
+    # A write that skipped a version leaves nothing to serve
+    cache.write_through(conversation.id, 4, upserts=[message(101, conversation.id, 11)])
+    assert cache.get(conversation.id, 4) is None
+
+
+@pytest.mark.asyncio
+async def test_write_through_keeps_incomplete_windows_a_prefix(session):
+    conversation = await seed(session, 5)
+    cache = ConversationCache(maxsize=10, window=3, ttl=60)
+    await cache.recent(conversation.id, 0, session)
+
+    # Messages older than the window are not cached, newer ones push the oldest out
+    cache.write_through(conversation.id, 1, upserts=[message(100, conversation.id, -10), message(101, conversation.id, 10)])
+    entry = cache.get(conversation.id, 1)
+    assert [m.content for m in entry.messages] == ["New", "Message 4", "Message 3"]
+    assert not entry.complete
+
+
+@pytest.mark.asyncio
+async def test_bump_versions_updates_loaded_conversations(session):
+    conversation = await seed(session, 1)
+    other = await seed(session, 1)
+
+    assert await bump_versions([conversation.id, other.id, None], session) == {conversation.id: 1, other.id: 1}
+    assert await bump_versions([conversation.id], session) == {conversation.id: 2}
+    await session.commit()
+    assert (conversation.version, other.version) == (2, 1)
@@ -0,0 +1,137 @@
+import pytest
+import pytest_asyncio
+from fastapi import HTTPException
+from sqlalchemy import event, inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+import migrations
+from migrations import MIGRATIONS, migrate
+from crud_message import delete_message, update_message
+from models import Base, Conversation, MessageModel
+from search import search_messages
+
+# The message table as the first deployment created it
+LEGACY_SCHEMA = """
+CREATE TABLE message (
+    id INTEGER NOT NULL PRIMARY KEY,
+    author VARCHAR NOT NULL,
+    content VARCHAR NOT NULL,
+    created_at DATETIME DEFAULT (CURRENT_TIMESTAMP) NOT NULL,
+    updated_at DATETIME,
+    deleted_at DATETIME
+)
+"""
+
+
+@pytest_asyncio.fixture
+async def engine(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'migrations.db'}")
+
+    # Makes DDL transactional, as it is on Postgres; the driver otherwise commits it right away
+    @event.listens_for(engine.sync_engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine.sync_engine, "begin")
+    def begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+    yield engine
+    await engine.dispose()
+
+
+def describe(conn):
+    """
+    Columns, indexes and foreign keys of every table the models declare.
+    """
+    inspector = inspect(conn)
+    return {
+        table: (
+            sorted(c["name"] for c in inspector.get_columns(table)),
+            sorted(i["name"] for i in inspector.get_indexes(table)),
+            # Read directly, since reflection misses ON DELETE on column-level references
+            sorted(
+                (fk["from"], fk["table"], fk["to"], fk["on_delete"])
+                for fk in conn.exec_driver_sql(f"PRAGMA foreign_key_list({table})").mappings()
+            ),
+        )
+        for table in Base.metadata.tables
+    }
+
+
+async def legacy_database(engine, *messages):
+    async with engine.begin() as conn:
+        await conn.execute(text(LEGACY_SCHEMA))
+        for author, content in messages:
+            await conn.execute(text("INSERT INTO message (author, content) VALUES (:author, :content)"), {"author": author, "content": content})
+
+
+@pytest.mark.asyncio
+async def test_fresh_database_gets_the_model_schema(engine):
+    assert await migrate(engine) == []
+    # Already up to date
+    assert await migrate(engine) == []
+
+    async with engine.connect() as conn:
+        names = (await conn.execute(text("SELECT name FROM schema_migration ORDER BY name"))).scalars().all()
+    assert names == [name for name, _ in MIGRATIONS]
+
+
+@pytest.mark.asyncio
+async def test_legacy_database_is_brought_up_to_the_model_schema(engine, tmp_path, monkeypatch):
+    monkeypatch.setattr(migrations, "LEGACY_MESSAGES_USER_ID", "owner")
+    await legacy_database(engine, ("user", "Hello"), ("chatbot", "Hi there"))
+
+    assert await migrate(engine) == [name for name, _ in MIGRATIONS]
+    assert await migrate(engine) == []
+
+    fresh = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'fresh.db'}")
+    async with fresh.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        expected = await conn.run_sync(describe)
+    await fresh.dispose()
+    async with engine.connect() as conn:
+        assert await conn.run_sync(describe) == expected
+
+        # Every legacy message now belongs to the owner, in one conversation of theirs
+        messages = (await conn.execute(select(MessageModel.user_id, MessageModel.conversation_id, MessageModel.status))).all()
+        conversation = (await conn.execute(select(Conversation.id, Conversation.user_id))).one()
+    assert messages == [("owner", conversation.id, "complete")] * 2
+    assert conversation.user_id == "owner"
+
+    # Legacy messages are searchable, and so are new ones
+    async with AsyncSession(engine) as session:
+        session.add(MessageModel(author="user", content="Hello again", conversation_id=conversation.id, user_id="owner"))
+        await session.commit()
+        found, _ = await search_messages("hello", "owner", session)
+    assert sorted(m.content for m in found) == ["Hello", "Hello again"]
+
+
+@pytest.mark.asyncio
+async def test_legacy_messages_can_be_changed_by_their_owner_only(engine, monkeypatch):
+    monkeypatch.setattr(migrations, "LEGACY_MESSAGES_USER_ID", "owner")
+    await legacy_database(engine, ("user", "Hello"), ("chatbot", "Hi there"))
+    await migrate(engine)
+
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        for attempt in (update_message(1, "Hijacked", "other", session), delete_message(2, "other", session)):
+            with pytest.raises(HTTPException) as e:
+                await attempt
+            assert e.value.status_code == 404
+
+        assert (await update_message(1, "Hello, edited", "owner", session)).content == "Hello, edited"
+        assert await delete_message(2, "owner", session)
+
+
+@pytest.mark.asyncio
+async def test_legacy_messages_need_an_owner(engine, monkeypatch):
+    monkeypatch.setattr(migrations, "LEGACY_MESSAGES_USER_ID", None)
+    await legacy_database(engine, ("user", "Hello"))
+
+    with pytest.raises(RuntimeError, match="LEGACY_MESSAGES_USER_ID"):
+        await migrate(engine)
+
+    # Nothing was changed
+    async with engine.connect() as conn:
+        tables = await conn.run_sync(lambda c: inspect(c).get_table_names())
+    assert tables == ["message"]
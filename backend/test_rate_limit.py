@@ -0,0 +1,64 @@
+import pytest
+
+from rate_limit import InProcessRateLimitBackend, RateLimiter, RateLimitExceeded
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.asyncio
+async def test_request_bucket_allows_bursts_then_refills():
+    clock = FakeClock()
+    limiter = RateLimiter(InProcessRateLimitBackend(clock=clock), requests_per_second=2, burst=3)
+
+    for _ in range(3):
+        await limiter.check("user")
+    with pytest.raises(RateLimitExceeded) as e:
+        await limiter.check("user")
+    assert e.value.limit == "requests"
+    assert e.value.retry_after == pytest.approx(0.5)
+    assert e.value.retry_after_header == "1"
+
+    # Other users have their own buckets
+    await limiter.check("other_user")
+
+    clock.now += 0.5
+    await limiter.check("user")
+
+
+@pytest.mark.asyncio
+async def test_token_quota_blocks_llm_requests_once_used_up():
+    clock = FakeClock()
+    limiter = RateLimiter(InProcessRateLimitBackend(clock=clock), tokens_per_day=8640)
+
+    await limiter.check("user", uses_llm=True)
+    await limiter.charge_tokens("user", 8650)
+
+    with pytest.raises(RateLimitExceeded) as e:
+        await limiter.check("user", uses_llm=True)
+    assert e.value.limit == "tokens"
+    assert e.value.retry_after == pytest.approx(100)
+
+    # Requests that do not call the LLM are unaffected
+    await limiter.check("user")
+
+    clock.now += 100
+    await limiter.check("user", uses_llm=True)
+
+
+@pytest.mark.asyncio
+async def test_full_buckets_are_not_stored():
+    backend = InProcessRateLimitBackend()
+    await backend.acquire("key", 0, 10, 1)
+    assert len(backend._buckets) == 0
+    await backend.acquire("key", 1, 10, 1)
+    assert len(backend._buckets) == 1
+
+
+def test_disabled_by_default():
+    assert not RateLimiter(InProcessRateLimitBackend()).enabled
@@ -0,0 +1,54 @@
+import pytest
+
+from response_cache import InProcessResponseCacheBackend, ResponseCache, ResponseCacheBackend, normalize_prompt
+
+SYSTEM_PROMPT = "You are a chatbot."
+
+
+def test_normalize_prompt():
+    assert normalize_prompt("  What does\tArtisan   DO?\n") == "what does artisan do?"
+
+
+def test_key_covers_system_prompt_and_model():
+    key = ResponseCache.key("Hello", SYSTEM_PROMPT, "gpt-4o")
+    assert key == ResponseCache.key("  hello ", SYSTEM_PROMPT, "gpt-4o")
+    assert key != ResponseCache.key("Hello", "Another system prompt", "gpt-4o")
+    assert key != ResponseCache.key("Hello", SYSTEM_PROMPT, "gpt-4o-mini")
+
+
+@pytest.mark.asyncio
+async def test_response_cache_hits_and_misses():
+    cache = ResponseCache(InProcessResponseCacheBackend(maxsize=2, ttl=60), ttl=60)
+    assert await cache.get("Hello", SYSTEM_PROMPT, "gpt-4o") is None
+
+    await cache.set("Hello", SYSTEM_PROMPT, "gpt-4o", "Hi there")
+    assert await cache.get("HELLO", SYSTEM_PROMPT, "gpt-4o") == "Hi there"
+
+    # Least recently used entries are evicted once the cache is full
+    await cache.set("One", SYSTEM_PROMPT, "gpt-4o", "1")
+    await cache.set("Two", SYSTEM_PROMPT, "gpt-4o", "2")
+    assert await cache.get("Hello", SYSTEM_PROMPT, "gpt-4o") is None
+
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+@pytest.mark.asyncio
+async def test_response_cache_expires_entries():
+    cache = ResponseCache(InProcessResponseCacheBackend(maxsize=10, ttl=0), ttl=0)
+    await cache.set("Hello", SYSTEM_PROMPT, "gpt-4o", "Hi there")
+    assert await cache.get("Hello", SYSTEM_PROMPT, "gpt-4o") is None
+
+
+@pytest.mark.asyncio
+async def test_response_cache_backend_errors_are_misses():
+    class BrokenBackend(ResponseCacheBackend):
+        async def get(self, key):
+            raise ConnectionError("cache is down")
+
+        async def set(self, key, value, ttl):
+            raise ConnectionError("cache is down")
+
+    cache = ResponseCache(BrokenBackend(), ttl=60)
+    await cache.set("Hello", SYSTEM_PROMPT, "gpt-4o", "Hi there")
+    assert await cache.get("Hello", SYSTEM_PROMPT, "gpt-4o") is None
+    assert cache.misses == 1
@@ -0,0 +1,15 @@
+import os
+
+from serve import worker_count
+
+
+def test_worker_count_from_env(monkeypatch):
+    monkeypatch.setenv("WEB_CONCURRENCY", "3")
+    assert worker_count() == 3
+    monkeypatch.setenv("WEB_CONCURRENCY", "0")
+    assert worker_count() == 1
+
+
+def test_worker_count_defaults_to_available_cpus(monkeypatch):
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    assert 1 <= worker_count() <= (os.cpu_count() or 1)
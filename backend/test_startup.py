@@ -0,0 +1,43 @@
+"""
+Cold start budget. Autoscaled and sleeping dynos import the app before they can serve their
+first request, so heavy imports at module level show up directly as request latency.
+"""
+import os
+import subprocess
+import sys
+
+# Cumulative `python -X importtime` of `import main`, best of a few runs
+IMPORT_TIME_BUDGET_SECONDS = float(os.getenv("IMPORT_TIME_BUDGET_SECONDS", 2))
+# Imported on first use (or at startup) only, never by `import main`
+DEFERRED_MODULES = ("openai", "supabase", "gotrue", "realtime", "storage3", "postgrest", "httpx", "uvicorn", "numpy")
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_main():
+    """
+    Import main in a fresh interpreter, returning its import time in seconds and the
+    modules it loaded.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import sys, main; print(' '.join(sys.modules))"],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith("import time:") and line.rsplit("|", 1)[-1].strip() == "main":
+            return int(line.split("|")[1]) / 1_000_000, set(result.stdout.split())
+    raise AssertionError("main was not imported")
+
+
+def test_import_main_defers_heavy_clients():
+    _, modules = import_main()
+    assert not modules.intersection(DEFERRED_MODULES)
+
+
+def test_benchmark_import_time_budget():
+    seconds = min(import_main()[0] for _ in range(3))
+    assert seconds < IMPORT_TIME_BUDGET_SECONDS, f"import main: {seconds * 1000:.0f} ms"
@@ -1,13 +1,24 @@
 const host = "https://nathans-chatbot-server-7d392ec059e8.herokuapp.com";
 
-export async function postMessage(messageText: string, session_token: string) {
+// Omit conversationId to start a new conversation. Pass the same idempotencyKey when
+// retrying a message, so the server answers it only once
+export async function postMessage(
+  messageText: string,
+  session_token: string,
+  conversationId: number | null = null,
+  idempotencyKey: string = crypto.randomUUID()
+) {
   const response = await fetch(`${host}/message`, {
     method: "POST",
     headers: {
       "Content-Type": "application/json",
       Authorization: `Bearer ${session_token}`,
+      "Idempotency-Key": idempotencyKey,
     },
-    body: JSON.stringify({ message: messageText }),
+    body: JSON.stringify({
+      message: messageText,
+      conversation_id: conversationId,
+    }),
   });
 
   if (!response.ok) {
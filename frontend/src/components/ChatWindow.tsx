@@ -9,13 +9,18 @@ export type Message = {
   id: number;
   author: string;
   message: string;
+  conversation_id?: number;
 };
 
 const ChatWindow = ({ session }: { session: Session }) => {
   const [messages, setMessages] = useState<Message[]>([]);
   const [loading, setLoading] = useState<boolean>(false);
   const [errorMessage, setErrorMessage] = useState<string | null>();
+  // Set by the first exchange, so later messages continue the same conversation
+  const [conversationId, setConversationId] = useState<number | null>(null);
   const prevMessageCountRef = useRef<number | undefined>(undefined);
+  // The last message that has not been answered yet, so sending it again is not answered twice
+  const pendingSendRef = useRef<{ message: string; idempotencyKey: string } | null>(null);
 
   const messagesEndRef = useRef<HTMLDivElement>(null);
   const scrollToBottom = () => {
@@ -23,6 +28,14 @@ const ChatWindow = ({ session }: { session: Session }) => {
   };
 
   const handleSendMessage = async (userInput: string) => {
+    if (pendingSendRef.current?.message !== userInput) {
+      pendingSendRef.current = {
+        message: userInput,
+        idempotencyKey: crypto.randomUUID(),
+      };
+    }
+    const { idempotencyKey } = pendingSendRef.current;
+
     try {
       setErrorMessage(null);
       setLoading(true);
@@ -40,8 +53,14 @@ const ChatWindow = ({ session }: { session: Session }) => {
 
       const responseBody = await api.postMessage(
         userInput,
-        session.access_token
+        session.access_token,
+        conversationId,
+        idempotencyKey
       );
+      if (pendingSendRef.current?.idempotencyKey === idempotencyKey) {
+        pendingSendRef.current = null;
+      }
+      setConversationId(responseBody.exchange[0].conversation_id);
 
       setMessages((prevMessages) => {
         return [